@@ -13,4 +13,6 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
+# Served by an ASGI server (e.g. uvicorn backend.asgi:application) so that the
+# processing progress stream (documents/progress/<id>/) can hold connections open.
 application = get_asgi_application()
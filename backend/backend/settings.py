@@ -191,3 +191,30 @@ CELERY_TASK_DEFAULT_QUEUE = 'default'
 CELERY_TASK_SOFT_TIME_LIMIT = 600  # 单任务最大运行时间（秒）
 CELERY_TASK_ACKS_LATE = True
 CELERYD_PREFETCH_MULTIPLIER = 1
+
+# 分阶段流水线各任务的队列(见 documents/tasks.py)，detect 阶段按模型类型发往 ner 或 llm 队列
+CELERY_TASK_ROUTES = {
+    'documents.tasks.process_document_task': {'queue': 'default'},
+    'documents.tasks.render_stage_task': {'queue': 'render'},
+    'documents.tasks.ocr_stage_task': {'queue': 'ocr'},
+    'documents.tasks.detect_stage_task': {'queue': 'ner'},
+    'documents.tasks.mask_stage_task': {'queue': 'render'},
+    'documents.tasks.assemble_stage_task': {'queue': 'render'},
+    'documents.tasks.pipeline_failed_task': {'queue': 'default'},
+}
+# True: 按阶段拆分为 chain/chord 分发到各队列；False: default 队列上单个任务完成整个流程
+FADE_SPLIT_PIPELINE = os.environ.get('FADE_SPLIT_PIPELINE', '1') == '1'
+FADE_MASK_BATCH_PAGES = 8  # 每个 mask 任务处理的页数
+
+# 模型注册表：worker进程启动时按其消费的队列（-Q）预加载 (模型名, 设备)，
+# 其余队列（default、render）不预加载，模型在首次使用时加载
+FADE_QUEUE_MODELS = {
+    'ocr': [('ocr', 'cpu')],
+    'ner': [('ner', 'cpu')],
+    'llm': [('llm', 'cpu')],
+}
+# 环境变量可覆盖按队列推断的结果，例如 FADE_WARMUP_MODELS=ner:cpu，或 none 表示不预加载
+FADE_WARMUP_MODELS = None
+if os.environ.get('FADE_WARMUP_MODELS'):
+    FADE_WARMUP_MODELS = [tuple(item.split(':')) for item in os.environ['FADE_WARMUP_MODELS'].split(',')
+                          if item and item != 'none']
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Document, ProcessedDocument, ProcessingLog
+from .models import Document, ProcessedDocument, ProcessingLog, UploadSession
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
@@ -24,3 +24,11 @@ class ProcessingLogAdmin(admin.ModelAdmin):
     search_fields = ['field_name', 'error_message']
     readonly_fields = ['created_at']
     ordering = ['-created_at']
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['upload_id', 'user', 'filename', 'file_size', 'received', 'status', 'updated_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['upload_id', 'filename', 'user__username']
+    readonly_fields = ['upload_id', 'created_at', 'updated_at']
+    ordering = ['-created_at']
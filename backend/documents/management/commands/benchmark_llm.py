@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from documents.utils.llm import LLM, LLM_BASE_URL, LLM_CONCURRENCY, LLM_RATE
+from concurrent.futures import ThreadPoolExecutor
+import random
+import statistics
+import time
+
+SAMPLE_TEXT = "甲方：北京星辰科技有限公司，地址：北京市海淀区中关村大街27号。联系人王先生，电话13800138000。"
+
+class Command(BaseCommand):
+    help = '对 LLM 接口做并发压测（可配合 mock_llm_server.py 离线运行）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default=LLM_BASE_URL, help='OpenAI 兼容接口地址')
+        parser.add_argument('--documents', type=int, default=8, help='同时处理的文档数')
+        parser.add_argument('--chars', type=int, default=3000, help='每个文档的字符数')
+        parser.add_argument('--concurrency', type=int, default=LLM_CONCURRENCY, help='同时进行的请求数上限')
+        parser.add_argument('--rate', type=float, default=LLM_RATE, help='每秒发起的请求数上限')
+        parser.add_argument('--cache', action='store_true', help='启用文本块缓存（默认关闭，每个文本块都请求接口）')
+
+    def handle(self, *args, **options):
+        llm = LLM(base_url=options['base_url'], concurrency=options['concurrency'], rate=options['rate'],
+                  cache=options['cache'])
+        texts = []
+        for _ in range(options['documents']):
+            text = ''
+            while len(text) < options['chars']:
+                text += SAMPLE_TEXT[random.randrange(len(SAMPLE_TEXT)):] + SAMPLE_TEXT
+            texts.append(text[:options['chars']])
+
+        def run(text):
+            start = time.perf_counter()
+            try:
+                llm.extract_sensitive(text)
+                return time.perf_counter() - start, None
+            except Exception as e:
+                return time.perf_counter() - start, e
+
+        # Documents run from separate threads, as concurrent tasks of one worker would
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['documents']) as executor:
+            results = list(executor.map(run, texts))
+        elapsed = time.perf_counter() - start
+        llm.close()
+
+        times = sorted(t for t, _ in results)
+        failed = [e for _, e in results if e is not None]
+        stats = llm.stats
+        self.stdout.write(f"文档: {len(texts)}, 失败: {len(failed)}, 总耗时: {elapsed:.2f}s")
+        self.stdout.write(f"单文档耗时 p50: {statistics.median(times):.2f}s, "
+                          f"p95: {times[min(len(times) - 1, int(len(times) * 0.95))]:.2f}s")
+        self.stdout.write(f"请求: {stats['requests']} ({stats['requests'] / elapsed:.1f}/s), 重试: {stats['retries']}, "
+                          f"限流: {stats['rate_limited']}, 失败: {stats['failures']}")
+        if options['cache']:
+            self.stdout.write(f"文本块缓存: {llm.cache_stats()}")
+        for e in failed[:3]:
+            self.stdout.write(self.style.ERROR(f"失败: {e}"))
+        self.stdout.write(self.style.SUCCESS('压测完成'))
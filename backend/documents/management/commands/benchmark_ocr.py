@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from documents.utils.ocr import make_ocr_processor, OCR_BACKENDS
+from documents.utils.ocrstore import load_ocr_result
+from documents.utils.render import iter_pages, page_count, OCR_DPI
+import os
+import tempfile
+import time
+
+class Command(BaseCommand):
+    help = '比较各 OCR 后端（http / shm / local）的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pdf_path', help='用于测试的PDF文件')
+        parser.add_argument('--backends', nargs='+', choices=list(OCR_BACKENDS), default=list(OCR_BACKENDS),
+                            help='参与比较的后端（http/shm 需先启动 ocr_server.py）')
+        parser.add_argument('--pages', type=int, default=10, help='最多测试的页数')
+        parser.add_argument('--gpu', action='store_true', help='使用 GPU')
+        parser.add_argument('--cache', action='store_true', help='允许使用页面缓存（默认关闭，每页都真正识别）')
+
+    def handle(self, *args, **options):
+        pdf_path = os.path.abspath(options['pdf_path'])
+        n_pages = min(options['pages'], page_count(pdf_path))
+        start = time.perf_counter()
+        pages = list(iter_pages(pdf_path, OCR_DPI, list(range(n_pages))))
+        render_s = time.perf_counter() - start
+        self.stdout.write(f"{n_pages} 页, 渲染 {OCR_DPI} dpi 耗时 {render_s:.2f}s; 整份PDF共 {page_count(pdf_path)} 页")
+        self.stdout.write(f"{'后端':<8}{'预热(s)':>10}{'已渲染页(s)':>14}{'页/秒':>8}{'整份PDF(s)':>13}  结果")
+        reference = None
+        for backend in options['backends']:
+            try:
+                processor = make_ocr_processor(backend, cache=options['cache'])
+                # The first page builds engines / opens connections; it is timed separately
+                start = time.perf_counter()
+                processor.ocr_image(pages[0][1], pages[0][0], options['gpu'], OCR_DPI)
+                warmup_s = time.perf_counter() - start
+                with tempfile.TemporaryDirectory() as tmp:
+                    # Pages rendered by the worker, as in the pipeline: OCR, save and read back the result
+                    start = time.perf_counter()
+                    processor.process_images(iter(pages), os.path.join(tmp, 'pages'), options['gpu'], OCR_DPI)
+                    texts = load_ocr_result(os.path.join(tmp, 'pages')).texts
+                    pages_s = time.perf_counter() - start
+                    # Whole PDF: rendering included (done by the server for http/shm)
+                    start = time.perf_counter()
+                    processor.process_pdf(pdf_path, os.path.join(tmp, 'pdf'), options['gpu'])
+                    load_ocr_result(os.path.join(tmp, 'pdf'))
+                    pdf_s = time.perf_counter() - start
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"{backend:<8}失败: {e}"))
+                continue
+            text = "".join(texts)
+            reference = reference if reference is not None else text
+            same = '一致' if text == reference else '与第一个后端不一致'
+            self.stdout.write(f"{backend:<8}{warmup_s:>10.2f}{pages_s:>14.2f}{n_pages / pages_s:>8.1f}{pdf_s:>13.2f}  {same}")
+        self.stdout.write(self.style.SUCCESS('测试完成'))
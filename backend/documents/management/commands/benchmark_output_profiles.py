@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from documents.utils.encode import OutputProfile, OUTPUT_PROFILES
+from documents.utils.pdfwriter import PDFStreamWriter
+from documents.utils.render import iter_pages, page_count, RENDER_DPI
+import io
+import time
+
+class Command(BaseCommand):
+    help = '比较各输出格式的文件大小与编码耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pdf_path', help='用于测试的PDF文件')
+        parser.add_argument('--pages', type=int, default=10, help='最多测试的页数')
+        parser.add_argument('--quality', type=int, default=75, help='JPEG 质量')
+        parser.add_argument('--dpi', type=int, nargs='+', default=[RENDER_DPI, 150], help='输出分辨率')
+
+    def handle(self, *args, **options):
+        page_indices = list(range(min(options['pages'], page_count(options['pdf_path']))))
+        pages = [img for _, img in iter_pages(options['pdf_path'], RENDER_DPI, page_indices)]
+        self.stdout.write(f"{len(pages)} 页, 渲染分辨率 {RENDER_DPI} dpi")
+        self.stdout.write(f"{'格式':<10}{'dpi':>6}{'大小(KB)':>12}{'每页(KB)':>10}{'编码(ms/页)':>14}")
+        baseline = None
+        for profile in OUTPUT_PROFILES:
+            for dpi in options['dpi']:
+                output = OutputProfile(profile, options['quality'], dpi)
+                buffer = io.BytesIO()
+                writer = PDFStreamWriter(buffer)
+                encode_s = 0.0
+                for img in pages:
+                    start = time.perf_counter()
+                    encoded = output.encode(img.copy(), RENDER_DPI)
+                    encode_s += time.perf_counter() - start
+                    writer.add_encoded(encoded, output.dpi)
+                writer.close()
+                size = buffer.tell()
+                baseline = baseline or size
+                self.stdout.write(
+                    f"{profile:<10}{output.dpi:>6}{size / 1024:>12.0f}{size / 1024 / max(len(pages), 1):>10.0f}"
+                    f"{encode_s * 1000 / max(len(pages), 1):>14.1f}   x{baseline / size:.1f}")
+        self.stdout.write(self.style.SUCCESS('测试完成'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from documents.utils.ocrstore import convert_json, ocr_result_exists
+import os
+
+class Command(BaseCommand):
+    help = '将旧的 ocr_result.json 转换为列式二进制OCR结果格式'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='转换后保留原JSON文件',
+        )
+
+    def handle(self, *args, **options):
+        converted = 0
+        for dirpath, dirnames, filenames in os.walk(settings.MEDIA_ROOT):
+            if 'ocr_result.json' not in filenames:
+                continue
+            json_path = os.path.join(dirpath, 'ocr_result.json')
+            ocr_path = os.path.join(dirpath, 'ocr_result')
+            if ocr_result_exists(ocr_path):
+                self.stdout.write(f'已存在，跳过: {ocr_path}')
+                continue
+            try:
+                convert_json(json_path, ocr_path, remove=not options['keep'])
+                converted += 1
+                self.stdout.write(f'已转换: {json_path}')
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'转换失败 {json_path}: {e}'))
+        self.stdout.write(self.style.SUCCESS(f'OCR结果转换完成，共 {converted} 个'))
@@ -0,0 +1,36 @@
+# Generated manually for resumable chunked uploads
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0003_alter_processeddocument_config_hash_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(default=uuid.uuid4, max_length=50, unique=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField()),
+                ('file_hash', models.CharField(blank=True, max_length=32, null=True)),
+                ('received', models.BigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('active', '上传中'), ('completed', '已完成'), ('aborted', '已取消')], default='active', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('document', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.document')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated manually for per-stage processing metrics
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0004_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processeddocument',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated manually: confidence is the mean detection score, empty when there is none
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_uploadsession_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='processinglog',
+            name='confidence',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.conf import settings
 import uuid
 import os
 
@@ -66,6 +67,7 @@ class ProcessedDocument(models.Model):
     processed_fields = models.IntegerField(default=0)
     failed_fields = models.IntegerField(default=0)
     processing_time = models.FloatField(default=0.0)  # 处理耗时(秒)
+    metrics = models.JSONField(default=dict, blank=True)  # 分阶段耗时、计数器和逐页统计
     
     class Meta:
         ordering = ['-process_time']
@@ -85,7 +87,7 @@ class ProcessingLog(models.Model):
         ('failed', '失败'),
         ('skipped', '跳过')
     ])
-    confidence = models.FloatField(default=0.0)  # 识别置信度
+    confidence = models.FloatField(blank=True, null=True)  # 识别置信度，检测结果的平均分数；无分数时为空
     processing_time = models.FloatField(default=0.0)  # 单个字段处理时间
     error_message = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -95,3 +97,31 @@ class ProcessingLog(models.Model):
     
     def __str__(self):
         return f"{self.field_name} - {self.status}"
+
+class UploadSession(models.Model):
+    """分片上传会话 - 记录可续传上传的进度"""
+    upload_id = models.CharField(max_length=50, unique=True, default=uuid.uuid4)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()  # 文件总大小(bytes)
+    file_hash = models.CharField(max_length=32, blank=True, null=True)  # 客户端提供的MD5(可选)
+    received = models.BigIntegerField(default=0)  # 已接收的连续字节数
+    claimed_at = models.DateTimeField(blank=True, null=True)  # 正在写入分片或完成上传的请求的认领时间
+    status = models.CharField(max_length=20, choices=[
+        ('active', '上传中'),
+        ('completed', '已完成'),
+        ('aborted', '已取消')
+    ], default='active')
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.file_size})"
+
+    def get_part_path(self):
+        """获取分片暂存文件路径"""
+        return os.path.join(settings.MEDIA_ROOT, '.uploads', f'{self.upload_id}.part')
@@ -0,0 +1,264 @@
+"""
+Stages of the processing pipeline, run as a Celery chain (see tasks.start_processing):
+
+    render -> ocr -> detect -> mask (one task per page batch, in parallel) -> assemble
+
+Each stage runs on its own queue so the worker pools can be sized independently. Stages pass a
+small JSON-serialisable context dict along the chain; rendered pages, OCR results, detections and
+masked pages go through a working directory next to the document, which therefore has to be on
+storage shared by all workers (as MEDIA_ROOT already is).
+
+process.process() runs the same steps in one process, streaming pages between them.
+"""
+import json
+import os
+import shutil
+import time
+from .process import group_boxes, mask_pages, redact_vector_page, build_metrics, _no_progress, _report_pages
+from .utils.detector import Detector
+from .utils.encode import OutputProfile, save_encoded, load_encoded
+from .utils.img import ImageProcessor
+from .utils.pdfwriter import PDFStreamWriter
+from .utils.render import iter_pages, page_count, PageSpool, RENDER_DPI, OCR_DPI
+from .utils.timing import StageTimer
+from .utils.vector import extract_text_layer, VectorRedactor
+
+def work_dir(root_path, config_hash):
+    return os.path.join(root_path, f'.work_{config_hash}')
+
+def new_context(root_path, config, config_hash, file_hash='', **extra):
+    """
+    Context passed along the chain. It does not open the PDF: the page count and start time are
+    filled in by render_stage on a worker, so dispatching costs nothing and a broken PDF fails
+    a task (and reaches the error callback) instead of the request that dispatched it.
+    """
+    return {
+        'root_path': root_path,
+        'pdf_path': os.path.join(root_path, 'origin.pdf'),
+        'config': config,
+        'config_hash': config_hash,
+        'file_hash': file_hash,
+        'work_dir': work_dir(root_path, config_hash),
+        'total_pages': None,
+        'started': None,
+        'metrics': {'stages': {}, 'counters': {}},
+        **extra,
+    }
+
+def page_batches(total_pages, batch_size):
+    """
+    Page index batches for the mask stage. A document without pages still gets one empty batch,
+    so the chord feeding assemble_stage never has an empty header.
+    """
+    return [list(range(i, min(i + batch_size, total_pages))) for i in range(0, total_pages, batch_size)] or [[]]
+
+def _detector(ctx):
+    compute_mode = ctx['config'].get('compute_mode', 'cpu')
+    detector = Detector(gpu=(compute_mode == 'gpu'), model_type=ctx['config'].get('model_type', 'ner'))
+    detector.ocr_path = os.path.join(ctx['root_path'], 'ocr_result')
+    return detector
+
+def _detection_path(ctx, detector):
+    return detector.detection_path(ctx['root_path'], ctx['file_hash'])
+
+def _merge_metrics(metrics, stages, counters):
+    for name, t in stages.items():
+        metrics['stages'][name] = round(metrics['stages'].get(name, 0.0) + t, 4)
+    for name, n in counters.items():
+        metrics['counters'][name] = metrics['counters'].get(name, 0) + n
+
+def _record(ctx, timer):
+    timings = timer.as_dict()
+    _merge_metrics(ctx['metrics'], timings['stages'], timings['counters'])
+
+def _spool(ctx):
+    return PageSpool(ctx['root_path'], os.path.join(ctx['work_dir'], 'pages'))
+
+def _text_layer_path(ctx):
+    return os.path.join(ctx['work_dir'], 'text_layer.json')
+
+def _masked_path(ctx, page_index):
+    return os.path.join(ctx['work_dir'], 'masked', f'{page_index:05d}.bin')
+
+def render_stage(ctx, progress=_no_progress):
+    """
+    Count the pages, check the detection cache; if detection has to run, read the text layer and
+    render the scanned pages into the working directory for OCR (and later masking).
+    """
+    ctx['started'] = time.time()
+    ctx['total_pages'] = page_count(ctx['pdf_path'])
+    progress('started', total=ctx['total_pages'])
+    timer = StageTimer()
+    detector = _detector(ctx)
+    detector.timer = timer
+    ctx['cached'] = detector.load_detections(_detection_path(ctx, detector)) is not None
+    if ctx['cached']:
+        print(f"[INFO] Using cached detection results for {ctx['pdf_path']}")
+        timer.count('detections_cached')
+    elif not detector.has_ocr_result():
+        os.makedirs(ctx['work_dir'], exist_ok=True)
+        with timer.stage('text_layer'):
+            text_layer = extract_text_layer(ctx['pdf_path'], OCR_DPI)
+        with open(_text_layer_path(ctx), 'w', encoding='utf-8') as f:
+            json.dump({str(k): v for k, v in text_layer.items()}, f, ensure_ascii=False)
+        scan_pages = [i for i in range(ctx['total_pages']) if i not in text_layer]
+        spool = _spool(ctx)
+        for done, _ in enumerate(timer.iter('render', spool.tee(iter_pages(ctx['pdf_path'], RENDER_DPI, scan_pages))), 1):
+            progress('render', done=done, total=len(scan_pages))
+    _record(ctx, timer)
+    return ctx
+
+def ocr_stage(ctx, progress=_no_progress):
+    """OCR the spooled pages and store the result with the text-layer pages (see ocrstore)."""
+    if ctx['cached']:
+        return ctx
+    timer = StageTimer()
+    detector = _detector(ctx)
+    detector.timer = timer
+    if not detector.has_ocr_result():
+        text_layer = {}
+        if os.path.exists(_text_layer_path(ctx)):
+            with open(_text_layer_path(ctx), 'r', encoding='utf-8') as f:
+                text_layer = {int(k): v for k, v in json.load(f).items()}
+        spool = _spool(ctx)
+        pages = _report_pages(timer.iter('render', spool.pages()), progress, 'ocr', len(spool.indices))
+        detector.get_text_from_pdf(ctx['pdf_path'], pages, RENDER_DPI, text_layer)
+    _record(ctx, timer)
+    return ctx
+
+def detect_stage(ctx, progress=_no_progress):
+    """Run NER/LLM on the OCR text, locate the sensitive phrases and store the detections."""
+    if ctx['cached']:
+        return ctx
+    progress('detect')
+    timer = StageTimer()
+    detector = _detector(ctx)
+    detector.timer = timer
+    sens_info_locs = detector.get_sens_info_loc(ctx['pdf_path'])
+    detector.save_detections(_detection_path(ctx, detector), sens_info_locs)
+    _record(ctx, timer)
+    return ctx
+
+def mask_stage(ctx, page_indices, advance=None):
+    """
+    Mask and encode a batch of rasterised pages into the working directory.
+    Born-digital pages are skipped, they are redacted in the assemble stage.
+    Args:
+        advance (callable): Optional advance(stage, n, total) callback counting pages across all batches.
+    Returns:
+        dict: The context, with timings, per-page milliseconds and per-category cover time of the batch.
+    """
+    timer = StageTimer()
+    detector = _detector(ctx)
+    sens_info_locs = detector.load_detections(_detection_path(ctx, detector), allow_fallback=True)
+    page_boxes, processing_results = group_boxes(sens_info_locs, ctx['config'])
+    zoom = RENDER_DPI / detector.ocr_dpi
+    raster = [i for i in page_indices if i not in detector.vector_pages]
+    spool = _spool(ctx)
+    page_ms = {}
+    os.makedirs(os.path.dirname(_masked_path(ctx, 0)), exist_ok=True)
+    masked = mask_pages(timer.iter('render', _batch_pages(ctx, spool, raster)), page_boxes, ctx['config'], zoom)
+    for page_index, encoded, mask_s, encode_s, field_time in masked:
+        timer.add('mask', mask_s)
+        timer.add('encode', encode_s)
+        for k, t in field_time.items():
+            processing_results[k]['time'] += t
+        page_ms[page_index] = round((mask_s + encode_s) * 1000)
+        with timer.stage('write'):
+            path = _masked_path(ctx, page_index)
+            save_encoded(path + '.tmp', encoded)
+            os.replace(path + '.tmp', path)
+    if advance is not None and raster:
+        advance('mask', len(raster), ctx['total_pages'] - len(detector.vector_pages))
+    timings = timer.as_dict()
+    return {
+        'ctx': ctx,
+        'stages': timings['stages'],
+        'counters': timings['counters'],
+        'page_ms': sorted(page_ms.items()),
+        'field_time': {k: r['time'] for k, r in processing_results.items()},
+    }
+
+def _batch_pages(ctx, spool, page_indices):
+    """Pages of a batch in order, from the spool when rendered for OCR, otherwise rendered now."""
+    missing = [i for i in page_indices if i not in spool]
+    rendered = iter_pages(ctx['pdf_path'], RENDER_DPI, missing) if missing else iter(())
+    for page_index in page_indices:
+        if page_index in spool:
+            yield page_index, spool.read(page_index)
+        else:
+            yield next(rendered)
+
+def assemble_stage(batches, progress=_no_progress):
+    """
+    Write the output PDF from the masked pages, redacting born-digital pages in the original PDF.
+    Args:
+        batches (list): Results of mask_stage for all page batches.
+    Returns:
+        dict: Same fields as process.process().
+    """
+    ctx = batches[0]['ctx']
+    config = ctx['config']
+    for batch in batches:
+        _merge_metrics(ctx['metrics'], batch['stages'], batch['counters'])
+    timer = StageTimer()
+    detector = _detector(ctx)
+    sens_info_locs = detector.load_detections(_detection_path(ctx, detector), allow_fallback=True)
+    page_boxes, processing_results = group_boxes(sens_info_locs, config, detector.scores)
+    for batch in batches:
+        for k, t in batch['field_time'].items():
+            processing_results[k]['time'] += t
+    total_pages = ctx['total_pages']
+    page_ms = [0] * total_pages
+    for batch in batches:
+        for page_index, ms in batch['page_ms']:
+            page_ms[page_index] = ms
+
+    vector_pages = detector.vector_pages
+    raster_pages = [i for i in range(total_pages) if i not in vector_pages]
+    processed_pdf_path = os.path.join(ctx['root_path'], f"processed_{ctx['config_hash']}.pdf")
+    raster_pdf_path = processed_pdf_path if not vector_pages else os.path.join(ctx['root_path'], f".raster_{ctx['config_hash']}.pdf")
+    output = OutputProfile.from_config(config)
+    progress('assemble')
+    with timer.stage('write'), open(raster_pdf_path, "wb") as f:
+        writer = PDFStreamWriter(f)
+        for page_index in raster_pages:
+            writer.add_encoded(load_encoded(_masked_path(ctx, page_index)), output.dpi)
+        writer.close()
+
+    if vector_pages:
+        # Redact born-digital pages in place and splice in the masked scanned pages
+        img_processor = ImageProcessor()
+        redactor = VectorRedactor(ctx['pdf_path'], RENDER_DPI)
+        for page_index in sorted(vector_pages):
+            page_start = time.perf_counter()
+            with timer.stage('mask'):
+                redact_vector_page(redactor, page_index, page_boxes.get(page_index, []), config,
+                                   detector.ocr_dpi, img_processor, processing_results)
+            page_ms[page_index] = round((time.perf_counter() - page_start) * 1000)
+        with timer.stage('write'):
+            if raster_pages:
+                redactor.replace_pages(raster_pdf_path, raster_pages)
+            redactor.save(processed_pdf_path)
+        os.remove(raster_pdf_path)
+    cleanup(ctx['work_dir'])
+
+    _record(ctx, timer)
+    timer.totals = dict(ctx['metrics']['stages'])
+    timer.counters = dict(ctx['metrics']['counters'])
+    metrics = build_metrics(timer, total_pages, vector_pages, page_boxes, page_ms, processing_results,
+                            time.time() - ctx['started'])
+    return {
+        'success': True,
+        'metrics': metrics,
+        'processing_results': processing_results,
+        'total_pages': total_pages,
+        'processed_pages': total_pages,
+        'processed_pdf_path': processed_pdf_path,
+        'compute_mode': config.get('compute_mode', 'cpu'),
+        'model_type': config.get('model_type', 'ner'),
+    }
+
+def cleanup(path):
+    """Remove a pipeline working directory."""
+    shutil.rmtree(path, ignore_errors=True)
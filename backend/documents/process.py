@@ -1,60 +1,247 @@
 from .utils.detector import Detector
-import img2pdf
-from pdf2image import convert_from_path
+from .utils.encode import OutputProfile
 from .utils.img import ImageProcessor
+from .utils.pdfwriter import PDFStreamWriter
+from .utils.render import iter_pages, page_count, PageSpool, RENDER_DPI, OCR_DPI
+from .utils.timing import StageTimer
+from .utils.vector import extract_text_layer, VectorRedactor
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import cv2
 import os
+import time
 
 # todo: Use GUI to modify those hyperparameters
 MOSAIC_SIZE = 10
 BLUR_KERNEL = (51, 51)
 
-def process(root_path, config, config_hash):
+# Pages masked and encoded concurrently (1: sequential). OpenCV releases the GIL while
+# encoding and filtering, so threads use several cores without copying pages between processes.
+MASK_WORKERS = int(os.environ.get('FADE_MASK_WORKERS', min(4, os.cpu_count() or 1)))
+
+def set_cover_params(img_processor, config, k):
+    """Configure the image processor for sensitive information type k."""
+    img_processor.set_mosaic_size(config.get(f'{k}_mosaic_size', MOSAIC_SIZE))
+    img_processor.set_blur_kernel(config.get(f'{k}_blur_kernel', BLUR_KERNEL))
+    img_processor.set_color(config.get(f'{k}_color', '#000000'))
+
+def group_boxes(sens_info_locs, config, scores=None):
+    """
+    Args:
+        scores (dict): Optional {category: mean detection score}, see Detector.scores.
+    Returns:
+        page_boxes (dict): {page_index: [(category, x, y, w, h), ...]}, keeping the category order
+                           so covers are applied as before.
+        processing_results (dict): {category: {'boxes', 'method', 'time', 'confidence'}}, time is filled in
+                                   by mask_page; confidence is None for categories without a score.
+    """
+    scores = scores or {}
+    page_boxes = defaultdict(list)
+    processing_results = {}
+    for k, v in sens_info_locs.items():
+        for page_index, x, y, w, h in v:
+            page_boxes[page_index].append((k, x, y, w, h))
+        processing_results[k] = {'boxes': len(v), 'method': config.get(k, 'blur'), 'time': 0.0,
+                                 'confidence': scores.get(k)}
+    return page_boxes, processing_results
+
+def mask_page(img, boxes, config, zoom, img_processor, processing_results):
+    """Cover the boxes (in OCR coordinates, scaled by zoom) of a rendered page in place, one batch per category."""
+    rects = defaultdict(list)
+    for k, x, y, w, h in boxes:
+        rects[k].append((x, y, w, h))
+    for k, v in rects.items():
+        cover_start = time.perf_counter()
+        set_cover_params(img_processor, config, k)
+        # Apply the appropriate covering method based on the type
+        img_processor.cover_rects(img, (np.asarray(v, dtype=np.float64) * zoom).astype(np.int64),
+                                  method=config.get(k, 'blur'))
+        processing_results[k]['time'] += time.perf_counter() - cover_start
+
+def mask_and_encode(img, boxes, config, zoom, output):
+    """
+    Mask a rendered page in place and encode it with an OutputProfile. Safe to run in worker threads.
+    Returns:
+        (EncodedImage, mask seconds, encode seconds, {category: cover seconds})
+    """
+    results = {k: {'time': 0.0} for k, *_ in boxes}
+    start = time.perf_counter()
+    mask_page(img, boxes, config, zoom, ImageProcessor(), results)
+    masked = time.perf_counter()
+    encoded = output.encode(img, RENDER_DPI)
+    done = time.perf_counter()
+    return encoded, masked - start, done - masked, {k: r['time'] for k, r in results.items()}
+
+def mask_pages(pages, page_boxes, config, zoom, workers=MASK_WORKERS):
+    """
+    Mask and encode (page_index, img) pairs with up to 2 * workers pages in flight.
+    Yields:
+        (page_index, EncodedImage, mask seconds, encode seconds, {category: cover seconds}), in input order.
+    """
+    output = OutputProfile.from_config(config)
+    if workers <= 1:
+        for page_index, img in pages:
+            yield (page_index, *mask_and_encode(img, page_boxes.get(page_index, []), config, zoom, output))
+        return
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for page_index, img in pages:
+            if len(pending) >= workers * 2:
+                j, future = pending.popleft()
+                yield (j, *future.result())
+            pending.append((page_index, executor.submit(mask_and_encode, img, page_boxes.get(page_index, []),
+                                                        config, zoom, output)))
+        while pending:
+            j, future = pending.popleft()
+            yield (j, *future.result())
+
+def redact_vector_page(redactor, page_index, boxes, config, ocr_dpi, img_processor, processing_results):
+    """Redact the boxes (in OCR coordinates) of a born-digital page in the original PDF."""
+    to_points = 72 / ocr_dpi
+    for k, x, y, w, h in boxes:
+        cover_start = time.perf_counter()
+        set_cover_params(img_processor, config, k)
+        method = config.get(k, 'blur')
+        rect = (x * to_points, y * to_points, (x + w) * to_points, (y + h) * to_points)
+        cover = lambda img, x, y, w, h, method=method: img_processor.cover(img, x, y, w, h, method=method)
+        redactor.redact(page_index, rect, method, img_processor.color, cover)
+        processing_results[k]['time'] += time.perf_counter() - cover_start
+
+def build_metrics(timer, total_pages, vector_pages, page_boxes, page_ms, processing_results, elapsed):
+    """Stage timings, counters and compact per-page figures of a run, as stored in ProcessedDocument.metrics."""
+    timer.count('pages', total_pages)
+    timer.count('pages_text_layer', len(vector_pages))
+    timer.count('boxes', sum(r['boxes'] for r in processing_results.values()))
+    metrics = timer.as_dict()
+    metrics['total'] = round(elapsed, 4)
+    # 't'/'o' for text-layer/OCR pages, masked boxes, masking + encoding milliseconds
+    metrics['pages'] = {
+        'source': ''.join('t' if i in vector_pages else 'o' for i in range(total_pages)),
+        'boxes': [len(page_boxes.get(i, ())) for i in range(total_pages)],
+        'ms': page_ms,
+    }
+    return metrics
+
+def _no_progress(stage, **fields):
+    pass
+
+def _report_pages(pages, progress, stage, total):
+    """Pass pages through, reporting (done, total) after each one."""
+    for done, item in enumerate(pages, 1):
+        yield item
+        progress(stage, done=done, total=total)
+
+def process(root_path, config, config_hash, file_hash='', progress=None):
+    """
+    Args:
+        progress (callable): Optional progress(stage, **fields) callback, e.g. a ProgressReporter.
+    Returns:
+        dict: Includes 'metrics', the time spent per stage (render, text_layer, ocr, ner/llm, locate,
+              mask, encode, write) with counters and per-page figures, and 'processing_results',
+              {category: {'boxes', 'method', 'time'}}.
+    """
+    progress = progress or _no_progress
+    timer = StageTimer()
+    start_time = time.perf_counter()
     # 从配置中提取处理选项
     compute_mode = config.get('compute_mode', 'cpu')
     model_type = config.get('model_type', 'ner')
     
     # Initialize the detector with specified options
     detector = Detector(gpu=(compute_mode=='gpu'), model_type=model_type)
+    detector.timer = timer
     pdf_file = 'origin.pdf'
     pdf_path = os.path.join(root_path, pdf_file)
     print(f"[INFO] Processing {pdf_path} with compute_mode={compute_mode}, model_type={model_type}")
     
     # 存储处理结果
     processing_results = {}
-    total_pages = 0
+    total_pages = page_count(pdf_path)
     processed_pages = 0
 
-    detector.ocr_path = os.path.join(root_path, 'ocr_result.json')
-    sens_info_locs = detector.get_sens_info_loc(pdf_path)
+    detector.ocr_path = os.path.join(root_path, 'ocr_result')
+    # Detection results only depend on the document and detector settings; re-renders with another
+    # cover method reuse them and skip OCR and NER/LLM entirely.
+    detection_path = detector.detection_path(root_path, file_hash)
+    sens_info_locs = detector.load_detections(detection_path)
+    if sens_info_locs is not None:
+        print(f"[INFO] Using cached detection results {detection_path}")
+        timer.count('detections_cached')
+    # Pages are streamed one at a time. Born-digital pages are read from the text layer and never
+    # rasterised. Scanned pages are rendered once for OCR and spooled to disk, so the masking pass
+    # below can reuse them without rendering again.
+    spool = None
+    pages = None
+    text_layer = None
+    if sens_info_locs is None and not detector.has_ocr_result():
+        with timer.stage('text_layer'):
+            text_layer = extract_text_layer(pdf_path, OCR_DPI)
+        print(f"[INFO] {len(text_layer)}/{total_pages} pages have a usable text layer")
+        spool = PageSpool(root_path)
+        scan_pages = [i for i in range(total_pages) if i not in text_layer]
+        pages = timer.iter('render', spool.tee(iter_pages(pdf_path, RENDER_DPI, scan_pages)))
+        pages = _report_pages(pages, progress, 'ocr', len(scan_pages))
+    try:
+        if sens_info_locs is None:
+            progress('detect')
+            sens_info_locs = detector.get_sens_info_loc(pdf_path, pages, RENDER_DPI, text_layer)
+            detector.save_detections(detection_path, sens_info_locs)
+        vector_pages = detector.vector_pages
+        raster_pages = [i for i in range(total_pages) if i not in vector_pages]
+        zoom = RENDER_DPI / detector.ocr_dpi   # OCR coordinates -> render coordinates
 
-    # Convert PDF pages to numpy type images
-    imgs = convert_from_path(pdf_path, dpi=300, fmt="png", thread_count=10, use_pdftocairo=True)
-    imgs_bin = [cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR) for image in imgs]
-    total_pages = len(imgs_bin)
-    img_processor = ImageProcessor()
-    for k, v in sens_info_locs.items():
-        img_processor.set_mosaic_size(config.get(f'{k}_mosaic_size', MOSAIC_SIZE))
-        img_processor.set_blur_kernel(config.get(f'{k}_blur_kernel', BLUR_KERNEL))
-        img_processor.set_color(config.get(f'{k}_color', '#000000'))
-        for page_index, x, y, w, h in v:
-            # Apply the appropriate covering method based on the type
-            zoom =2
-            x, y, w, h = int(x * zoom), int(y * zoom), int(w * zoom), int(h * zoom)
-            img_processor.cover(imgs_bin[page_index], x, y, w, h, method=config.get(k, 'blur'))
-    imgs = []
-    # Save the processed images as a PDF
-    for img in imgs_bin:
-        _, buffer = cv2.imencode(".png", img)
-        imgs.append(buffer.tobytes())
-    processed_pdf_path = os.path.join(root_path, f'processed_{config_hash}.pdf')
-    print(f"[INFO] Saving processed images to {processed_pdf_path}")
-    with open(processed_pdf_path, "wb") as f:
-        f.write(img2pdf.convert(imgs))
+        page_boxes, processing_results = group_boxes(sens_info_locs, config, detector.scores)
+        page_ms = [0] * total_pages     # Masking + encoding time of each page
+
+        processed_pdf_path = os.path.join(root_path, f'processed_{config_hash}.pdf')
+        raster_pdf_path = processed_pdf_path if not vector_pages else os.path.join(root_path, f'.raster_{config_hash}.pdf')
+        print(f"[INFO] Saving processed images to {processed_pdf_path}")
+        img_processor = ImageProcessor()
+        output = OutputProfile.from_config(config)
+        with open(raster_pdf_path, "wb") as f:
+            writer = PDFStreamWriter(f)
+            source = spool.pages() if spool else iter_pages(pdf_path, RENDER_DPI, raster_pages)
+            # Mask and encode times are summed over the worker threads
+            masked = mask_pages(timer.iter('render', source), page_boxes, config, zoom)
+            for done, (page_index, encoded, mask_s, encode_s, field_time) in enumerate(masked, 1):
+                timer.add('mask', mask_s)
+                timer.add('encode', encode_s)
+                for k, t in field_time.items():
+                    processing_results[k]['time'] += t
+                page_ms[page_index] = round((mask_s + encode_s) * 1000)
+                with timer.stage('write'):
+                    writer.add_encoded(encoded, output.dpi)
+                processed_pages += 1
+                progress('mask', done=done, total=len(raster_pages))
+            with timer.stage('write'):
+                writer.close()
+
+        if vector_pages:
+            progress('assemble')
+            # Redact born-digital pages in place and splice in the masked scanned pages
+            redactor = VectorRedactor(pdf_path, RENDER_DPI)
+            for page_index in sorted(vector_pages):
+                page_start = time.perf_counter()
+                with timer.stage('mask'):
+                    redact_vector_page(redactor, page_index, page_boxes.get(page_index, []), config,
+                                       detector.ocr_dpi, img_processor, processing_results)
+                page_ms[page_index] = round((time.perf_counter() - page_start) * 1000)
+                processed_pages += 1
+            with timer.stage('write'):
+                if raster_pages:
+                    redactor.replace_pages(raster_pdf_path, raster_pages)
+                redactor.save(processed_pdf_path)
+            os.remove(raster_pdf_path)
+    finally:
+        if spool:
+            spool.close()
+
+    metrics = build_metrics(timer, total_pages, vector_pages, page_boxes, page_ms, processing_results,
+                            time.perf_counter() - start_time)
 
     return {
         'success': True,
+        'metrics': metrics,
         'processing_results': processing_results,
         'total_pages': total_pages,
         'processed_pages': processed_pages,
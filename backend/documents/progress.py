@@ -0,0 +1,107 @@
+"""
+处理进度推送：Celery 任务通过 Redis pub/sub 发布进度事件，SSE 视图订阅后推送给浏览器，
+前端不再轮询 processed-info 接口。
+"""
+import json
+import logging
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_REDIS_URL = getattr(settings, 'FADE_PROGRESS_REDIS_URL', 'redis://localhost:6379/2')
+CHANNEL_PREFIX = 'fade:progress:'
+LAST_EVENT_TTL = 3600   # 最近一次事件保留时间(秒)，晚连接的客户端可立即拿到当前进度
+TERMINAL_STAGES = ('completed', 'failed')
+
+_client = None
+
+def channel_name(processed_id):
+    return f'{CHANNEL_PREFIX}{processed_id}'
+
+def last_event_key(processed_id):
+    return f'{CHANNEL_PREFIX}last:{processed_id}'
+
+def get_client():
+    global _client
+    if _client is None:
+        import redis
+        _client = redis.Redis.from_url(PROGRESS_REDIS_URL)
+    return _client
+
+def publish(processed_id, stage, **fields):
+    """
+    发布一条进度事件。进度推送是尽力而为的，Redis 不可用时只记录日志，不影响处理任务。
+    Args:
+        stage (str): 阶段名，如 started / ocr / detect / mask / assemble / completed / failed。
+        fields: 附加字段，如 done、total。
+    """
+    event = json.dumps({'processed_id': processed_id, 'stage': stage, 'time': time.time(), **fields},
+                       ensure_ascii=False)
+    try:
+        client = get_client()
+        pipe = client.pipeline()
+        pipe.set(last_event_key(processed_id), event, ex=LAST_EVENT_TTL)
+        pipe.publish(channel_name(processed_id), event)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"[PROGRESS] 进度事件发布失败: {e}")
+
+def advance(processed_id, stage, n, total):
+    """
+    累加某阶段的完成数并发布 (done, total)。计数保存在 Redis 中，
+    由并行处理同一文档不同页面的多个任务共享。
+    """
+    key = f'{CHANNEL_PREFIX}count:{processed_id}:{stage}'
+    try:
+        client = get_client()
+        pipe = client.pipeline()
+        pipe.incrby(key, n)
+        pipe.expire(key, LAST_EVENT_TTL)
+        done = pipe.execute()[0]
+    except Exception as e:
+        logger.warning(f"[PROGRESS] 进度计数失败: {e}")
+        return
+    publish(processed_id, stage, done=done, total=total)
+
+class ProgressReporter:
+    """绑定到一个处理任务的进度发布器，传给 process() 使用"""
+    def __init__(self, processed_id):
+        self.processed_id = processed_id
+
+    def __call__(self, stage, **fields):
+        publish(self.processed_id, stage, **fields)
+
+    def advance(self, stage, n, total):
+        advance(self.processed_id, stage, n, total)
+
+async def subscribe(processed_id, keepalive=15):
+    """
+    订阅进度事件的异步生成器。先产出最近一次事件（如有），之后逐条产出新事件，
+    收到终止阶段后结束；超过 keepalive 秒没有事件时产出 None，供调用方发送心跳。
+    """
+    import redis.asyncio as aioredis
+    client = aioredis.Redis.from_url(PROGRESS_REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        # 先订阅再读取最近事件，避免两者之间发布的事件丢失
+        await pubsub.subscribe(channel_name(processed_id))
+        last = await client.get(last_event_key(processed_id))
+        if last is not None:
+            event = json.loads(last)
+            yield event
+            if event['stage'] in TERMINAL_STAGES:
+                return
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+            if message is None:
+                yield None
+                continue
+            event = json.loads(message['data'])
+            yield event
+            if event['stage'] in TERMINAL_STAGES:
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from .models import Document, ProcessedDocument, ProcessingLog
+from .utils.encode import OUTPUT_PROFILES, DEFAULT_OUTPUT, MIN_OUTPUT_DPI
+from .utils.render import RENDER_DPI
 from django.contrib.auth.models import User
 
 class DocumentSerializer(serializers.ModelSerializer):
@@ -72,6 +74,25 @@ class DocumentUploadSerializer(serializers.Serializer):
         
         return value
 
+class UploadInitSerializer(serializers.Serializer):
+    """分片上传初始化序列化器"""
+    filename = serializers.CharField(max_length=255)
+    file_size = serializers.IntegerField(min_value=1)
+    file_hash = serializers.RegexField(r'^[0-9a-fA-F]{32}$', required=False, allow_blank=True)
+
+    def validate_filename(self, value):
+        if not value.lower().endswith('.pdf'):
+            raise serializers.ValidationError("只支持PDF文件上传")
+        return value
+
+    def validate_file_size(self, value):
+        if value > 50 * 1024 * 1024:
+            raise serializers.ValidationError("文件大小不能超过50MB")
+        return value
+
+    def validate_file_hash(self, value):
+        return value.lower() or None
+
 class DocumentConfigSerializer(serializers.Serializer):
     """文档处理配置序列化器"""
     document_code = serializers.CharField()
@@ -87,6 +108,21 @@ class DocumentConfigSerializer(serializers.Serializer):
         allowed_compute_modes = ['cpu', 'gpu']
         allowed_model_types = ['ner', 'llm']
         
+        # 输出编码选项：与默认值相同的项不写入配置，已有结果的 config_hash 保持不变
+        value = dict(value)
+        for field_name, default in DEFAULT_OUTPUT.items():
+            if value.get(field_name) == default or value.get(field_name) is None:
+                value.pop(field_name, None)
+        profile = value.get('output_profile')
+        if profile is not None and profile not in OUTPUT_PROFILES:
+            raise serializers.ValidationError(f"不支持的输出格式: {profile} (仅支持: {list(OUTPUT_PROFILES)})")
+        quality = value.get('output_quality')
+        if quality is not None and (not isinstance(quality, int) or isinstance(quality, bool) or not 10 <= quality <= 95):
+            raise serializers.ValidationError("输出质量必须是 10-95 之间的整数")
+        dpi = value.get('output_dpi')
+        if dpi is not None and (not isinstance(dpi, int) or isinstance(dpi, bool) or not MIN_OUTPUT_DPI <= dpi <= RENDER_DPI):
+            raise serializers.ValidationError(f"输出分辨率必须是 {MIN_OUTPUT_DPI}-{RENDER_DPI} 之间的整数")
+        
         for field_name, method in value.items():
             if method is None or isinstance(method, int):
                 continue
@@ -1,31 +1,177 @@
-from celery import shared_task
-from .models import Document, ProcessedDocument
+from celery import current_app, shared_task, chain, chord, group
+from celery.signals import worker_process_init, worker_process_shutdown
+from django.conf import settings
+from .models import Document, ProcessedDocument, ProcessingLog
 from .process import process
+from .progress import ProgressReporter
+from .utils.registry import registry
+from . import pipeline
+import logging
+
+logger = logging.getLogger(__name__)
+
+def warmup_targets(queues):
+    """worker 需要预加载的模型：FADE_WARMUP_MODELS 优先，否则按消费的队列推断"""
+    configured = getattr(settings, 'FADE_WARMUP_MODELS', None)
+    if configured is not None:
+        return list(configured)
+    targets = []
+    for queue in queues:
+        for model in getattr(settings, 'FADE_QUEUE_MODELS', {}).get(queue, []):
+            if model not in targets:
+                targets.append(model)
+    return targets
+
+@worker_process_init.connect
+def warmup_models(**kwargs):
+    """每个Celery worker进程启动时预加载模型，避免首个任务承担加载延迟"""
+    # 子进程由 worker 主进程 fork 而来，-Q 选中的队列已记录在 app.amqp.queues 中
+    registry.warmup(warmup_targets(current_app.amqp.queues.consume_from))
+
+@worker_process_shutdown.connect
+def report_model_stats(**kwargs):
+    print(f"[INFO] Model registry stats: {registry.stats()}")
+    if ('llm', 'cpu') in registry.loaded():
+        print(f"[INFO] LLM chunk cache stats: {registry.get('llm').cache_stats()}")
+    registry.evict()
+
+def save_field_logs(processed_doc, processing_results):
+    """每类敏感信息写一条处理日志，并更新字段统计"""
+    ProcessingLog.objects.filter(processed_document=processed_doc).delete()
+    ProcessingLog.objects.bulk_create([
+        ProcessingLog(
+            processed_document=processed_doc,
+            field_name=field,
+            field_type=field,
+            processing_method=r['method'],
+            status='success' if r['boxes'] else 'skipped',
+            confidence=r.get('confidence'),
+            processing_time=r['time'],
+        )
+        for field, r in processing_results.items()
+    ])
+    processed_doc.total_fields = sum(r['boxes'] for r in processing_results.values())
+    processed_doc.processed_fields = sum(r['boxes'] for r in processing_results.values() if r['method'] != 'empty')
+    processed_doc.failed_fields = 0
+
+def complete_processed_document(processed_doc, result, elapsed):
+    """保存处理结果，标记处理完成并推送完成事件"""
+    doc = processed_doc.document
+    processed_pdf_name = f"processed_{processed_doc.config_hash}.pdf"
+    processed_doc.processed_file.name = f"{doc.user.username}/{doc.document_code}/{processed_pdf_name}"
+    processed_doc.status = 'completed'
+    processed_doc.processing_time = elapsed
+    processed_doc.metrics = result['metrics']
+    save_field_logs(processed_doc, result['processing_results'])
+    processed_doc.save()
+    ProgressReporter(processed_doc.id)('completed', processing_time=elapsed)
+
+def fail_processed_document(processed_doc, error):
+    processed_doc.status = 'failed'
+    processed_doc.save()
+    ProgressReporter(processed_doc.id)('failed', error=str(error))
 
 @shared_task(bind=True)
 def process_document_task(self, document_id, config, config_hash):
-    import logging
-    logger = logging.getLogger(__name__)
     logger.warning(f"[CELERY TASK] 收到参数: document_id={document_id}, config={config}, config_hash={config_hash}")
     try:
         doc = Document.objects.get(id=document_id)
         root_path = doc.get_storage_path()
+        # 查找对应的ProcessedDocument
+        processed_doc = ProcessedDocument.objects.get(document=doc, config_hash=config_hash)
+        progress = ProgressReporter(processed_doc.id)
+        progress('started', total=doc.page_count)
         import time
         start_time = time.time()
-        process(root_path, config, config_hash)
+        result = process(root_path, config, config_hash, doc.file_hash or '', progress)
         end_time = time.time()
         elapsed = end_time - start_time
-        # 查找对应的ProcessedDocument
-        processed_doc = ProcessedDocument.objects.get(document=doc, config_hash=config_hash)
-        processed_pdf_name = f"processed_{config_hash}.pdf"
-        processed_doc.processed_file.name = f"{doc.user.username}/{doc.document_code}/{processed_pdf_name}"
-        processed_doc.status = 'completed'
-        processed_doc.processing_time = elapsed
-        processed_doc.save()
+        complete_processed_document(processed_doc, result, elapsed)
+        logger.warning(f"[CELERY TASK] 模型加载/推理耗时: {registry.stats()}")
         return {'status': 'success', 'document_id': document_id}
     except Exception as e:
         processed_doc = ProcessedDocument.objects.filter(document_id=document_id, config_hash=config_hash).first()
         if processed_doc:
-            processed_doc.status = 'failed'
-            processed_doc.save()
-        return {'status': 'failed', 'error': str(e), 'document_id': document_id} 
\ No newline at end of file
+            fail_processed_document(processed_doc, e)
+        return {'status': 'failed', 'error': str(e), 'document_id': document_id}
+
+# 分阶段流水线：render -> ocr -> detect(ner/llm) -> 按页批次并行 mask -> assemble
+# 各阶段的队列见 settings.CELERY_TASK_ROUTES，可按队列分别启动和扩缩 worker，例如：
+#   celery -A backend worker -Q render -c 8
+#   celery -A backend worker -Q ocr -c 4
+#   celery -A backend worker -Q ner -c 2
+#   celery -A backend worker -Q llm -c 16 -P threads
+
+def start_processing(document, processed_doc, config, config_hash):
+    """
+    分发文档处理任务。FADE_SPLIT_PIPELINE 开启时按阶段拆分为 Celery chain/chord，
+    否则在 default 队列上用单个任务完成整个流程。
+    Returns:
+        AsyncResult
+    """
+    if not getattr(settings, 'FADE_SPLIT_PIPELINE', False):
+        return process_document_task.apply_async(args=[document.id, config, config_hash])
+    # 页数在 render 阶段才读取，分发时不打开PDF；mask 批次由 detect 阶段结束后再展开
+    ctx = pipeline.new_context(document.get_storage_path(), config, config_hash, document.file_hash or '',
+                               processed_id=processed_doc.id)
+    detect_queue = 'llm' if config.get('model_type', 'ner') == 'llm' else 'ner'
+    on_error = pipeline_on_error(processed_doc.id)
+    workflow = chain(
+        render_stage_task.s(ctx).on_error(on_error),
+        ocr_stage_task.s().on_error(on_error),
+        detect_stage_task.s().set(queue=detect_queue).on_error(on_error),
+    )
+    return workflow.apply_async()
+
+def pipeline_on_error(processed_id):
+    # 失败回调挂在每个任务上：chain 级别的 link_error 不一定传到嵌套 chord 的 header 任务，
+    # 分片失败时文档会一直停留在 processing。pipeline_failed_task 可重复调用。
+    return pipeline_failed_task.s(processed_id=processed_id)
+
+def mask_workflow(ctx):
+    """按页批次并行 mask，全部完成后 assemble"""
+    on_error = pipeline_on_error(ctx['processed_id'])
+    batch_size = getattr(settings, 'FADE_MASK_BATCH_PAGES', 8)
+    return chord(
+        group(mask_stage_task.s(ctx, pages).on_error(on_error)
+              for pages in pipeline.page_batches(ctx['total_pages'], batch_size)),
+        assemble_stage_task.s().on_error(on_error)
+    )
+
+@shared_task
+def render_stage_task(ctx):
+    ProcessedDocument.objects.filter(id=ctx['processed_id']).update(status='processing')
+    return pipeline.render_stage(ctx, ProgressReporter(ctx['processed_id']))
+
+@shared_task
+def ocr_stage_task(ctx):
+    return pipeline.ocr_stage(ctx, ProgressReporter(ctx['processed_id']))
+
+@shared_task(bind=True)
+def detect_stage_task(self, ctx):
+    ctx = pipeline.detect_stage(ctx, ProgressReporter(ctx['processed_id']))
+    logger.warning(f"[CELERY TASK] 模型加载/推理耗时: {registry.stats()}")
+    # 页数到 render 阶段才知道，在此展开 mask 批次
+    return self.replace(mask_workflow(ctx))
+
+@shared_task
+def mask_stage_task(ctx, page_indices):
+    return pipeline.mask_stage(ctx, page_indices, ProgressReporter(ctx['processed_id']).advance)
+
+@shared_task
+def assemble_stage_task(batches):
+    ctx = batches[0]['ctx']
+    result = pipeline.assemble_stage(batches, ProgressReporter(ctx['processed_id']))
+    processed_doc = ProcessedDocument.objects.select_related('document__user').get(id=ctx['processed_id'])
+    complete_processed_document(processed_doc, result, result['metrics']['total'])
+    return {'status': 'success', 'document_id': processed_doc.document_id}
+
+@shared_task
+def pipeline_failed_task(request, exc, traceback, processed_id=None):
+    """流水线任一阶段失败时调用：标记失败并清理工作目录"""
+    logger.warning(f"[CELERY TASK] 流水线任务 {request.id} 失败: {exc}")
+    processed_doc = ProcessedDocument.objects.filter(id=processed_id).select_related('document').first()
+    if processed_doc is None or processed_doc.status == 'failed':
+        return
+    fail_processed_document(processed_doc, exc)
+    pipeline.cleanup(pipeline.work_dir(processed_doc.document.get_storage_path(), processed_doc.config_hash)) 
\ No newline at end of file
@@ -1,3 +1,1347 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+from django.test import SimpleTestCase, TestCase
+from .models import Document, UploadSession
+from .utils.llm import LLM, LLMError, find_phrase
 
-# Create your tests here.
+
+def _stub_llm(answer):
+    """LLM client without network: every chunk is answered by answer(chunk text)."""
+    llm = LLM.__new__(LLM)
+    llm.cache = None
+    llm.base_url = 'http://llm.test/v1'
+    llm.max_retries = 2
+    llm.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failures': 0}
+
+    async def arequest(prompt):
+        return json.dumps(answer(prompt.split("\n\n")[0]), ensure_ascii=False)
+    llm.arequest = arequest
+    return llm
+
+
+class LLMSpanTests(SimpleTestCase):
+    def test_find_phrase_across_line_break(self):
+        chunk = "地址北京市海淀区\n中关村大街1号"
+        self.assertEqual(find_phrase(chunk, "北京市海淀区中关村大街1号"), [(2, len(chunk))])
+        self.assertEqual(find_phrase("张三和张三", "张三"), [(0, 2), (3, 5)])
+
+    def test_entity_wrapped_onto_next_line_is_located(self):
+        text = "联系人张三，地址北京市海淀区\n中关村大街1号。"
+        llm = _stub_llm(lambda chunk: {"company": [], "address": ["北京市海淀区中关村大街1号"], "name": ["张三"]})
+        spans = asyncio.run(llm.aextract_spans(text))
+        found = {(name, text[start:end]) for start, end, name, _ in spans}
+        self.assertEqual(found, {("name", "张三"), ("address", "北京市海淀区\n中关村大街1号")})
+
+    def test_answer_without_json_is_asked_again(self):
+        answers = iter(["文本中没有敏感信息。", None, '{"company": [], "address": [], "name": ["张三"]}'])
+        llm = _stub_llm(None)
+
+        async def arequest(prompt):
+            return next(answers)
+        llm.arequest = arequest
+        spans = asyncio.run(llm.aextract_spans("联系人张三"))
+        self.assertEqual([(name, start, end) for start, end, name, _ in spans], [("name", 3, 5)])
+        self.assertEqual(llm.stats['retries'], 2)
+
+        llm.arequest = lambda prompt: asyncio.sleep(0, "无")
+        with self.assertRaises(LLMError):
+            asyncio.run(llm.aextract_spans("联系人张三"))
+
+    def test_chunks_are_answered_from_the_cache(self):
+        import tempfile
+        from unittest import mock
+        from .utils.cache import DiskCache
+        text = "联系人张三，，" * 40  # 7 characters, so chunks every 70 repeat
+        requests = []
+        llm = _stub_llm(lambda chunk: requests.append(chunk) or {"name": ["张三"]})
+        with tempfile.TemporaryDirectory() as tmp, mock.patch('documents.utils.cache.CACHE_ROOT', tmp):
+            llm.cache = DiskCache('llm_chunks', ttl=3600)
+            counters = {}
+            first = asyncio.run(llm.aextract_spans(text, counters))
+            misses = len(requests)
+            self.assertGreater(counters['llm_chunks'], misses)  # Repeated chunks are asked once
+            self.assertEqual(counters['llm_cache_misses'], misses)
+
+            counters = {}
+            second = asyncio.run(llm.aextract_spans(text, counters))
+            self.assertEqual(len(requests), misses)
+            self.assertEqual((counters['llm_cache_hits'], counters['llm_cache_misses']), (counters['llm_chunks'], 0))
+            self.assertEqual(list(second), list(first))
+
+            # Another model or prompt must not reuse the answers
+            with mock.patch('documents.utils.llm.LLM_MODEL_NAME', 'other-model'):
+                asyncio.run(llm.aextract_spans(text))
+            self.assertEqual(len(requests), 2 * misses)
+
+    def test_failed_chunk_cancels_the_others(self):
+        cancelled = []
+        llm = _stub_llm(None)
+
+        async def arequest(prompt):
+            if prompt.startswith("坏"):
+                raise LLMError("failed")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+        llm.arequest = arequest
+        text = "好" * 150 + "坏" * 100
+        with self.assertRaises(LLMError):
+            asyncio.run(asyncio.wait_for(llm.aextract_spans(text), 5))
+        self.assertEqual(len(cancelled), 3)     # Chunks at 0, 70 and 140; the one at 210 failed
+
+
+def _baseline_locate(texts, boxes, sens_info):
+    """The per-phrase regex search that locate_phrases replaced, for comparison."""
+    import re
+    sentence = "".join(texts)
+    nl_nums, newline_num = [], 0
+    for text in texts:
+        if text != '\n':
+            nl_nums.append(newline_num)
+        else:
+            newline_num += 1
+    n_sentence = sentence.replace('\n', '')
+    occurrences = {p: [m.start() for m in re.finditer(re.escape(p), n_sentence)]
+                   for phrases in sens_info.values() for p in phrases}
+    locs = sorted(((start, start + len(p)) for phrases in sens_info.values() for p in phrases
+                   for start in occurrences[p]), key=lambda x: x[0])
+    merged_locs, merged = set(), {}
+    i = 0
+    while i < len(locs):
+        loc, keys = locs[i], [locs[i]]
+        for j in range(i + 1, len(locs)):
+            if locs[j][0] >= loc[1]:
+                break
+            loc = (min(loc[0], locs[j][0]), max(loc[1], locs[j][1]))
+            keys.append(locs[j])
+        i += len(keys)
+        merged_locs.update(keys)
+        merged[keys[0]] = loc
+
+    def box(first, last):
+        a, b = boxes[first + nl_nums[first]], boxes[last + nl_nums[last]]
+        return [a[0], a[1], a[2], b[3] - a[1], b[4] - a[2]]
+
+    result = {}
+    for key, phrases in sens_info.items():
+        result[key] = []
+        for phrase in phrases:
+            for n_start in occurrences[phrase]:
+                n_end = n_start + len(phrase)
+                if (n_start, n_end) in merged_locs:
+                    if (n_start, n_end) not in merged:
+                        continue
+                    n_start, n_end = merged[(n_start, n_end)]
+                first = n_start
+                for i in range(n_start + 1, n_end):
+                    if nl_nums[i] != nl_nums[i - 1]:
+                        result[key].append(box(first, i - 1))
+                        first = i
+                result[key].append(box(first, n_end - 1))
+    return result
+
+
+class LocatePhrasesTests(SimpleTestCase):
+    def test_phrase_matcher_finds_overlapping_occurrences(self):
+        from .utils.locate import PhraseMatcher, non_overlapping
+        matcher = PhraseMatcher(['aa', 'a', 'aba', 'b'])
+        self.assertEqual(matcher.find_all('aabaa'), [[0, 3], [0, 1, 3, 4], [1], [2]])
+        self.assertEqual(non_overlapping([0, 1, 2, 4], 2), [0, 2, 4])
+
+    def test_same_boxes_as_baseline_search(self):
+        import random
+        from .utils.locate import locate_phrases
+        rng = random.Random(0)
+        for _ in range(500):
+            texts = [rng.choice('abc\n') for _ in range(rng.randint(1, 40))]
+            boxes = [[i // 20, i, i % 7, i + 1, i % 7 + 3] for i in range(len(texts))]
+            sens_info = {key: {''.join(rng.choice('abc') for _ in range(rng.randint(1, 4)))
+                               for _ in range(rng.randint(0, 3))}
+                         for key in ('name', 'address', 'sens_number')}
+            located = locate_phrases(texts, boxes, sens_info)
+            located = {k: [[int(c) for c in box] for box in v] for k, v in located.items()}
+            self.assertEqual(located, _baseline_locate(texts, boxes, sens_info), (texts, sens_info))
+
+
+class OCRClientRetryTests(SimpleTestCase):
+    def test_busy_server_is_retried(self):
+        from unittest import mock
+        from .utils import ocr
+
+        class Response:
+            def __init__(self, status_code):
+                self.status_code = status_code
+                self.headers = {'Retry-After': '0'}
+
+            def raise_for_status(self):
+                if self.status_code >= 400:
+                    raise RuntimeError(self.status_code)
+
+        class Session:
+            def __init__(self, codes):
+                self.codes = list(codes)
+
+            def post(self, url, **kwargs):
+                return Response(self.codes.pop(0))
+
+        processor = ocr.OCRProcessor.__new__(ocr.OCRProcessor)
+        processor.base_url = 'http://ocr'
+        with mock.patch.object(ocr.OCRProcessor, 'session', Session([503, 503, 200])), \
+                mock.patch.object(ocr.time, 'sleep') as sleep:
+            self.assertEqual(processor.post('/ocr_page').status_code, 200)
+        self.assertEqual(sleep.call_count, 2)
+        with mock.patch.object(ocr.OCRProcessor, 'session', Session([500])):
+            with self.assertRaises(RuntimeError):
+                processor.post('/ocr_page')
+
+
+class CoverColorTests(SimpleTestCase):
+    def test_scanned_and_born_digital_pages_get_the_same_color(self):
+        import os
+        import tempfile
+        import fitz
+        import numpy as np
+        from .utils.img import ImageProcessor
+        from .utils.vector import VectorRedactor
+
+        processor = ImageProcessor()
+        processor.set_color('#ff8000')
+        img = np.full((20, 20, 3), 255, np.uint8)
+        processor.cover_rects(img, np.array([[0, 0, 10, 10]]), 'black')
+        self.assertEqual(img[5, 5].tolist(), [0, 128, 255])   # BGR
+        self.assertEqual(img[15, 15].tolist(), [255, 255, 255])
+        img = np.full((20, 20, 3), 255, np.uint8)
+        processor.cover(img, 0, 0, 10, 10, 'black')
+        self.assertEqual(img[5, 5].tolist(), [0, 128, 255])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            src, out = os.path.join(tmp, 'in.pdf'), os.path.join(tmp, 'out.pdf')
+            with fitz.open() as doc:
+                doc.new_page(width=100, height=100)
+                doc.save(src)
+            redactor = VectorRedactor(src, 72)
+            redactor.redact(0, (0, 0, 50, 50), 'black', processor.color)
+            redactor.save(out)
+            with fitz.open(out) as doc:
+                self.assertEqual(doc[0].get_pixmap(dpi=72).pixel(25, 25), (255, 128, 0))   # RGB
+
+
+def _baseline_covered(text):
+    """Characters masked by the regexes the rule engine replaced (tokens with 5+ digits, emails)."""
+    import re
+    covered = set()
+    for m in re.finditer(r'[a-zA-Z0-9-]+', text):
+        if len(re.findall(r'\d', m.group())) >= 5:
+            covered.update(range(m.start(), m.end()))
+    for m in re.finditer(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z0-9]{2,}', text):
+        covered.update(range(m.start(), m.end()))
+    return covered
+
+
+class RuleEngineTests(SimpleTestCase):
+    def scan(self, text):
+        from .utils.rules import RULES
+        return [(text[s.start:s.end], s.rule) for s in RULES.scan(text)]
+
+    def test_checksums(self):
+        from .utils.rules import id_card_valid, luhn_valid
+        self.assertTrue(id_card_valid('11010519491231002X'))
+        self.assertTrue(id_card_valid('11010519491231002x'))
+        self.assertFalse(id_card_valid('110105194912310021'))
+        self.assertTrue(luhn_valid('4111 1111 1111 1111'))
+        self.assertFalse(luhn_valid('4111-1111-1111-1112'))
+
+    def test_rules(self):
+        self.assertEqual(self.scan('身份证11010519491231002X，电话 +86 138-1234-5678'),
+                         [('11010519491231002X', 'id_card'), ('+86 138-1234-5678', 'phone')])
+        # Failing the checksum, a number is still masked by the generic rule
+        self.assertEqual(self.scan('卡号 4111111111111112'), [('4111111111111112', 'sens_number')])
+        self.assertEqual(self.scan('卡号 4111111111111111'), [('4111111111111111', 'bank_card')])
+        self.assertEqual(self.scan('邮箱 a.b@c.com，编号 AB-1234'), [('a.b@c.com', 'email')])
+
+    def test_email_does_not_cut_a_number_token(self):
+        self.assertEqual(self.scan('7@4.86-X75-0'), [('7@4.86-X75-0', 'email')])
+
+    def test_prefilter_class(self):
+        import re
+        from .utils.rules import RULES, char_class_parts
+        self.assertEqual(char_class_parts('A-Z._%+-'), ['A-Z', '.', '_', '%', '+', r'\-'])
+        first = re.compile(f'[{RULES.first_chars}]')
+        for c in 'aZ09._%+-':
+            self.assertTrue(first.fullmatch(c), c)
+        for c in ',/ @':
+            self.assertFalse(first.fullmatch(c), c)
+
+    def test_covers_baseline(self):
+        import random
+        from .utils.rules import RULES
+        rng = random.Random(0)
+        samples = ['6@.-9-.04.8.@60.54566', '4.6@a.04_%3@-38.80-52+', '订单号 A-12345-B 与 12-34']
+        samples += [''.join(rng.choice('0123456789aX-@.+ %,_') for _ in range(rng.randint(1, 25)))
+                    for _ in range(20000)]
+        for text in samples:
+            covered = {i for s in RULES.scan(text) for i in range(s.start, s.end)}
+            self.assertLessEqual(_baseline_covered(text), covered, text)
+
+
+class CoverRectsTests(SimpleTestCase):
+    def page(self):
+        import cv2
+        import numpy as np
+        rng = np.random.default_rng(0)
+        img = np.full((400, 600, 3), 255, np.uint8)
+        for x, y in rng.integers(0, 380, (60, 2)).tolist():
+            cv2.putText(img, '1234', (x * 3 // 2, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+        return img
+
+    def test_batch_blur_close_to_blurring_each_rectangle(self):
+        import numpy as np
+        from .utils.img import ImageProcessor, HALF_RES_BLUR_KERNEL
+        img = self.page()
+        rects = np.array([[20, 30, 120, 30], [140, 30, 80, 30], [300, 200, 150, 40], [50, 300, 60, 25],
+                          [200, 100, 40, 40], [590, 390, 30, 30]])
+        inside = np.zeros(img.shape[:2], bool)
+        for x, y, w, h in rects.tolist():
+            inside[y:y + h, x:x + w] = True
+        for kernel in (5, HALF_RES_BLUR_KERNEL, 51):
+            processor = ImageProcessor()
+            processor.set_blur_kernel(kernel)
+            batch, single = img.copy(), img.copy()
+            processor.cover_rects(batch, rects, 'blur')
+            for rect in rects.tolist():
+                processor.blur(single, *rect)
+            diff = np.abs(batch.astype(int) - single.astype(int))[inside]
+            self.assertLess(diff.mean(), 5, kernel)
+            self.assertLess(np.percentile(diff, 99), 32, kernel)
+            self.assertTrue(np.array_equal(batch[~inside], img[~inside]), kernel)
+
+    def test_page_wide_blur_leaves_outside_untouched(self):
+        import numpy as np
+        from .utils.img import ImageProcessor
+        img = self.page()
+        rects = np.array([[x, y, 50, 20] for x in range(0, 600, 60) for y in range(0, 400, 30)])
+        inside = np.zeros(img.shape[:2], bool)
+        for x, y, w, h in rects.tolist():
+            inside[y:y + h, x:x + w] = True
+        batch = img.copy()
+        ImageProcessor().cover_rects(batch, rects, 'blur')
+        self.assertTrue(np.array_equal(batch[~inside], img[~inside]))
+        self.assertFalse(np.array_equal(batch[inside], img[inside]))
+
+
+class ZipStreamTests(SimpleTestCase):
+    def archive_files(self, tmp):
+        import os
+        files = []
+        for name, data in (('报告/processed.pdf', b'%PDF' + bytes(range(256)) * 300), ('empty.txt', b''),
+                           ('origin.pdf', b'x' * 5000)):
+            path = os.path.join(tmp, f'{len(files)}.bin')
+            with open(path, 'wb') as f:
+                f.write(data)
+            files.append((name, path, data))
+        return files
+
+    def check_round_trip(self, files):
+        import io
+        import zipfile
+        from .utils.zipstream import ZipStream
+        archive = ZipStream([(name, path) for name, path, _ in files])
+        data = b''.join(archive)
+        self.assertEqual(len(data), archive.size)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual([(i.filename, i.compress_type) for i in z.infolist()],
+                             [(name, zipfile.ZIP_STORED) for name, _, _ in files])
+            for name, _, content in files:
+                self.assertEqual(z.read(name), content)
+        return data
+
+    def test_round_trip(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_round_trip(self.archive_files(tmp))
+
+    def test_zip64_records(self):
+        import tempfile
+        from unittest import mock
+        from .utils import zipstream
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(zipstream, 'ZIP64_LIMIT', 1000):
+            self.check_round_trip(self.archive_files(tmp))
+
+    def test_iter_range(self):
+        import random
+        import tempfile
+        from .utils.zipstream import ZipStream
+        rng = random.Random(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [(name, path) for name, path, _ in self.archive_files(tmp)]
+            data = b''.join(ZipStream(files))
+            for _ in range(200):
+                first = rng.randrange(len(data))
+                last = rng.randrange(first, len(data))
+                # A fresh archive each time: ranges starting after a file's data compute its CRC separately
+                self.assertEqual(b''.join(ZipStream(files).iter_range(first, last)), data[first:last + 1],
+                                 (first, last))
+
+
+class OCRStoreTests(SimpleTestCase):
+    def test_legacy_json_is_converted(self):
+        import os
+        import tempfile
+        from .utils.ocrstore import convert_json, load_ocr_result, ocr_result_exists
+        boxes = [[0, 1.5, 2, 10, 20], [0, 10, 2, 18.25, 20], [0, 0, 0, 0, 0], [1, 3, 4, 5, 6]]
+        txts = ['张', 'a', '\n', '三']
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path, ocr_path = os.path.join(tmp, 'ocr_result.json'), os.path.join(tmp, 'ocr_result')
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump({'boxes': boxes, 'txts': txts}, f, ensure_ascii=False)
+            convert_json(json_path, ocr_path, remove=True)
+            self.assertFalse(os.path.exists(json_path))
+            self.assertTrue(ocr_result_exists(ocr_path))
+            result = load_ocr_result(ocr_path)
+            self.assertEqual(result.dpi, 150)   # Legacy results carry no dpi
+            self.assertEqual(result.vector_pages, set())
+            self.assertEqual(list(result.texts), txts)
+            self.assertEqual([result.boxes[i] for i in range(len(result.boxes))], boxes)
+
+            # Entries of several characters come back as a list
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump({'boxes': boxes[:2], 'txts': ['张三', 'ab'], 'dpi': 300, 'vector_pages': [0]}, f)
+            convert_json(json_path, ocr_path)
+            result = load_ocr_result(ocr_path)
+            self.assertEqual((result.dpi, result.vector_pages, result.texts), (300, {0}, ['张三', 'ab']))
+
+    def test_result_is_replaced_as_a_whole(self):
+        import os
+        import tempfile
+        from unittest import mock
+        import numpy as np
+        from .utils import ocrstore
+        with tempfile.TemporaryDirectory() as tmp:
+            ocr_path = os.path.join(tmp, 'ocr_result')
+            ocrstore.save_ocr_result(ocr_path, [[0, 1, 2, 3, 4]], ['a'], 150)
+            old = ocrstore.load_ocr_result(ocr_path)
+            ocrstore.save_ocr_result(ocr_path, [[0, 1, 2, 3, 4], [1, 5, 6, 7, 8]], ['b', 'c'], 300)
+            # Arrays mapped from the previous result stay intact
+            self.assertEqual((old.dpi, old.texts, old.boxes[0]), (150, 'a', [0, 1, 2, 3, 4]))
+            self.assertEqual(ocrstore.load_ocr_result(ocr_path).texts, 'bc')
+            self.assertEqual(os.listdir(tmp), ['ocr_result'])
+
+            # A failed write leaves the previous result in place and no temporary directory
+            with mock.patch.object(ocrstore.np, 'save', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    ocrstore.save_ocr_result(ocr_path, [[0, 0, 0, 1, 1]], ['d'], 150)
+            self.assertEqual(ocrstore.load_ocr_result(ocr_path).texts, 'bc')
+            self.assertEqual(os.listdir(tmp), ['ocr_result'])
+
+
+class OutputEncodingTests(SimpleTestCase):
+    def pages(self):
+        import cv2
+        import numpy as np
+        text = np.full((300, 240, 3), 255, np.uint8)
+        cv2.putText(text, '123', (20, 150), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 5)
+        color = text.copy()
+        color[20:80, 20:200] = (0, 0, 255)
+        gray = np.tile(np.linspace(0, 255, 240, dtype=np.uint8)[None, :, None], (300, 1, 3))
+        return {'bilevel': text, 'color': color, 'gray': gray}
+
+    def test_classify(self):
+        from .utils.encode import classify
+        for kind, img in self.pages().items():
+            self.assertEqual(classify(img), kind)
+
+    def test_bool_quality_and_dpi_are_rejected(self):
+        from .serializers import DocumentConfigSerializer
+        from .utils.encode import OutputProfile
+        for options in ({'output_quality': True}, {'output_dpi': True}, {'output_dpi': False}):
+            with self.assertRaises(ValueError):
+                OutputProfile.from_config(options)
+            serializer = DocumentConfigSerializer(data={'document_code': 'x', 'config': dict(options, name='black')})
+            self.assertFalse(serializer.is_valid(), options)
+        serializer = DocumentConfigSerializer(data={'document_code': 'x', 'config': {'output_quality': 50}})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+
+    def test_round_trip_through_pdf(self):
+        import os
+        import tempfile
+        import cv2
+        import fitz
+        import numpy as np
+        from .utils.encode import OutputProfile, OUTPUT_PROFILES, save_encoded, load_encoded, BILEVEL_THRESHOLD
+        from .utils.pdfwriter import PDFStreamWriter
+        from .utils.render import RENDER_DPI
+        for profile in OUTPUT_PROFILES:
+            for dpi in (RENDER_DPI, RENDER_DPI // 2):
+                output = OutputProfile(profile, 75, dpi)
+                with tempfile.TemporaryDirectory() as tmp:
+                    pages = list(self.pages().items())
+                    with open(os.path.join(tmp, 'out.pdf'), 'wb') as f:
+                        writer = PDFStreamWriter(f)
+                        for i, (_, img) in enumerate(pages):
+                            # Through the working-directory format of the pipeline
+                            save_encoded(os.path.join(tmp, f'{i}.bin'), output.encode(img))
+                            writer.add_encoded(load_encoded(os.path.join(tmp, f'{i}.bin')), output.dpi)
+                        writer.close()
+                    with fitz.open(os.path.join(tmp, 'out.pdf')) as doc:
+                        self.assertEqual(len(doc), len(pages))
+                        for page, (kind, img) in zip(doc, pages):
+                            h, w = img.shape[:2]
+                            self.assertAlmostEqual(page.rect.width, w * 72 / RENDER_DPI, places=3)
+                            self.assertAlmostEqual(page.rect.height, h * 72 / RENDER_DPI, places=3)
+                            pix = fitz.Pixmap(doc, page.get_images()[0][0])
+                            decoded = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, pix.n)
+                            expected = cv2.cvtColor(cv2.resize(img, (pix.width, pix.height), interpolation=cv2.INTER_AREA),
+                                                    cv2.COLOR_BGR2RGB)
+                            self.assertEqual(expected.shape[:2], (h * output.dpi // RENDER_DPI, w * output.dpi // RENDER_DPI))
+                            if pix.n == 1:
+                                expected = cv2.cvtColor(expected, cv2.COLOR_RGB2GRAY)[:, :, None]
+                            if profile == 'png':
+                                self.assertTrue(np.array_equal(decoded, expected), (profile, dpi, kind))
+                            elif profile == 'bilevel' or (profile == 'auto' and kind == 'bilevel'):
+                                thresholded = np.where(expected >= BILEVEL_THRESHOLD, 255, 0)
+                                self.assertTrue(np.array_equal(decoded, thresholded), (profile, dpi, kind))
+                            else:
+                                self.assertEqual(pix.n, 3 if kind == 'color' else 1, (profile, dpi, kind))
+                                self.assertLess(np.abs(decoded.astype(int) - expected).mean(), 3, (profile, dpi, kind))
+
+
+def _pdf_bytes(pages=2):
+    import fitz
+    with fitz.open() as doc:
+        for i in range(pages):
+            doc.new_page().insert_text((72, 72), f'page {i}')
+        return doc.tobytes()
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        import hashlib
+        import shutil
+        import tempfile
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        self.enterContext(self.settings(MEDIA_ROOT=media))
+        self.user = User.objects.create_user('uploader', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = _pdf_bytes()
+        self.md5 = hashlib.md5(self.data).hexdigest()
+
+    def init(self, file_hash=None):
+        body = {'filename': 'a.pdf', 'file_size': len(self.data)}
+        if file_hash:
+            body['file_hash'] = file_hash
+        response = self.client.post('/api/documents/upload/init/', body, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['upload_id']
+
+    def put(self, upload_id, offset, length):
+        return self.client.put(f'/api/documents/upload/{upload_id}/chunk/?offset={offset}',
+                               self.data[offset:offset + length], content_type='application/octet-stream')
+
+    def finalize(self, upload_id):
+        return self.client.post(f'/api/documents/upload/{upload_id}/finalize/')
+
+    def session(self, upload_id):
+        return UploadSession.objects.get(upload_id=upload_id)
+
+    def test_out_of_order_and_duplicate_chunks(self):
+        upload_id = self.init(self.md5)
+        half = len(self.data) // 2
+        # A chunk beyond the received offset is refused with the offset to resume from
+        response = self.put(upload_id, half, len(self.data) - half)
+        self.assertEqual((response.status_code, response.data['offset']), (409, 0))
+        self.assertEqual(self.put(upload_id, 0, half).data, {'success': True, 'offset': half, 'complete': False})
+        # Sending the same chunk again (lost response) does not append it twice
+        response = self.put(upload_id, 0, half)
+        self.assertEqual((response.status_code, response.data['offset']), (409, half))
+        self.assertTrue(self.put(upload_id, half, len(self.data) - half).data['complete'])
+
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 201, response.data)
+        document = Document.objects.get(user=self.user)
+        self.assertEqual((document.file_hash, document.page_count), (self.md5, 2))
+        with document.original_file.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        session = self.session(upload_id)
+        self.assertEqual((session.status, session.document_id), ('completed', document.id))
+        self.assertFalse(os.path.exists(session.get_part_path()))
+        # A finished session takes no more chunks, and the same file is reported as a duplicate
+        self.assertEqual(self.finalize(upload_id).status_code, 409)
+        response = self.client.post('/api/documents/upload/init/',
+                                    {'filename': 'b.pdf', 'file_size': len(self.data), 'file_hash': self.md5},
+                                    format='json')
+        self.assertEqual(response.status_code, 409)
+
+    def test_finalize_before_complete_is_refused(self):
+        upload_id = self.init()
+        self.put(upload_id, 0, 10)
+        response = self.finalize(upload_id)
+        self.assertEqual((response.status_code, response.data['offset']), (409, 10))
+        self.assertIsNone(self.session(upload_id).claimed_at)
+
+    def test_hash_mismatch_discards_the_upload(self):
+        upload_id = self.init('0' * 32)
+        self.put(upload_id, 0, len(self.data))
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 400)
+        session = self.session(upload_id)
+        self.assertEqual(session.status, 'aborted')
+        self.assertFalse(os.path.exists(session.get_part_path()))
+        self.assertFalse(Document.objects.exists())
+
+    def test_claimed_session_is_refused_until_released_or_expired(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .views import claim_upload_session, release_upload_session, UPLOAD_CLAIM_TIMEOUT
+        upload_id = self.init()
+        token = claim_upload_session(upload_id, self.user, received=0)
+        self.assertIsNotNone(token)
+        self.assertIsNone(claim_upload_session(upload_id, self.user, received=0))
+        response = self.put(upload_id, 0, 10)
+        self.assertEqual((response.status_code, response.data['error']), (409, '该会话正在被其他请求处理'))
+        self.assertEqual(self.session(upload_id).received, 0)
+
+        self.assertTrue(release_upload_session(self.session(upload_id), token))
+        self.assertEqual(self.put(upload_id, 0, 10).status_code, 200)
+
+        # A claim left by an interrupted request expires; its late release no longer applies
+        token = claim_upload_session(upload_id, self.user, received=10)
+        UploadSession.objects.filter(upload_id=upload_id).update(
+            claimed_at=timezone.now() - UPLOAD_CLAIM_TIMEOUT - timedelta(seconds=1))
+        self.assertEqual(self.put(upload_id, 10, 10).data['offset'], 20)
+        self.assertFalse(release_upload_session(self.session(upload_id), token, received=10))
+        self.assertEqual(self.session(upload_id).received, 20)
+
+    def test_session_released_after_failed_write(self):
+        from unittest import mock
+        upload_id = self.init()
+        with mock.patch('documents.views.append_chunk', side_effect=OSError('disk full')):
+            self.assertEqual(self.put(upload_id, 0, 10).status_code, 500)
+        session = self.session(upload_id)
+        self.assertEqual((session.received, session.claimed_at), (0, None))
+        self.assertEqual(self.put(upload_id, 0, 10).data['offset'], 10)
+
+        # A client that disconnects mid-chunk leaves the offset where it was
+        with mock.patch('documents.views.append_chunk', return_value=4):
+            self.assertEqual(self.put(upload_id, 10, 10).status_code, 400)
+        session = self.session(upload_id)
+        self.assertEqual((session.received, session.claimed_at), (10, None))
+
+    def test_single_request_upload_is_streamed_to_disk(self):
+        from unittest import mock
+        from django.conf import settings
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .views import spool_upload
+        path, md5, size = spool_upload(SimpleUploadedFile('a.pdf', self.data), chunk_size=7)
+        with open(path, 'rb') as f:
+            self.assertEqual((f.read(), md5, size), (self.data, self.md5, len(self.data)))
+        os.remove(path)
+
+        upload = lambda: self.client.post('/api/documents/upload/', {'file': SimpleUploadedFile('a.pdf', self.data)})
+        response = upload()
+        self.assertEqual(response.status_code, 201)
+        document = Document.objects.get(document_code=response.data['document']['document_code'])
+        self.assertEqual((document.file_hash, document.file_size, document.page_count), (self.md5, len(self.data), 2))
+        with document.original_file.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(upload().status_code, 409)
+
+        # The spooled file is removed whether the upload is stored, a duplicate or fails
+        with mock.patch('documents.views.store_upload', side_effect=OSError('disk full')):
+            self.assertEqual(upload().status_code, 500)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, '.uploads')), [])
+
+
+def _render_with_fitz(pdf_path, dpi=300, page_indices=None):
+    """Stand-in for render.iter_pages (pdftocairo) in tests."""
+    import cv2
+    import fitz
+    import numpy as np
+    with fitz.open(pdf_path) as doc:
+        for i in (range(len(doc)) if page_indices is None else page_indices):
+            pix = doc[i].get_pixmap(dpi=dpi)
+            img = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, pix.n)
+            yield i, cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+
+def _page_count_with_fitz(pdf_path):
+    import fitz
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+
+class _FakeNER:
+    """Finds the name 张三, like the NER model would."""
+    def __init__(self):
+        self.calls = 0
+
+    def extract_spans(self, text):
+        import re
+        from .utils.ner import ENTITY_CATEGORIES
+        from .utils.spans import Spans
+        self.calls += 1
+        return Spans.from_tuples(((m.start(), m.end(), 'name', 0.9) for m in re.finditer('张三', text)),
+                                 ENTITY_CATEGORIES)
+
+
+def _fake_ocr():
+    from .utils.ocr import BaseOCRProcessor
+
+    class FakeOCR(BaseOCRProcessor):
+        """Reads one line '联系人张三' at the top left of every scanned page."""
+        def ocr_image(self, img, page_index, gpu=True, dpi=150):
+            boxes = [[page_index, 20 + 30 * i, 20, 48 + 30 * i, 50] for i in range(5)]
+            return boxes + [boxes[-1]], list('联系人张三') + ['\n']
+    return FakeOCR()
+
+
+class DocumentFixture:
+    """
+    A two-page document (born-digital page 0, scanned page 1) in a temporary storage directory,
+    with NER and OCR replaced by fakes and pages rendered with fitz instead of poppler.
+    """
+    def __init__(self, test):
+        import shutil
+        import tempfile
+        from unittest import mock
+        import fitz
+        import numpy as np
+        from .utils.registry import registry
+        self.root = tempfile.mkdtemp()
+        test.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.pdf_path = os.path.join(self.root, 'origin.pdf')
+        with fitz.open() as doc:
+            doc.new_page().insert_text((72, 72), '联系人张三，电话13812345678。', fontname='china-s', fontsize=12)
+            scan = np.full((200, 300, 3), 230, np.uint8).tobytes()
+            doc.new_page().insert_image(fitz.Rect(0, 0, 300, 200),
+                                        pixmap=fitz.Pixmap(fitz.csRGB, 300, 200, scan, False))
+            doc.save(self.pdf_path)
+        self.ner = _FakeNER()
+        for patch in (
+            mock.patch.dict(registry._models, {('ner', 'cpu'): self.ner, ('ocr', 'cpu'): _fake_ocr()}),
+            mock.patch('documents.process.page_count', _page_count_with_fitz),
+            mock.patch('documents.process.iter_pages', _render_with_fitz),
+            mock.patch('documents.pipeline.page_count', _page_count_with_fitz),
+            mock.patch('documents.pipeline.iter_pages', _render_with_fitz),
+        ):
+            test.enterContext(patch)
+
+    def detector(self, model_type='ner'):
+        from .utils.detector import Detector
+        detector = Detector(gpu=False, model_type=model_type)
+        detector.ocr_path = os.path.join(self.root, 'ocr_result')
+        return detector
+
+
+class DetectionCacheTests(SimpleTestCase):
+    def test_saved_detections_round_trip(self):
+        from .utils.vector import extract_text_layer
+        fixture = DocumentFixture(self)
+        detector = fixture.detector()
+        path = detector.detection_path(fixture.root, 'hash')
+        locs = detector.get_sens_info_loc(fixture.pdf_path, _render_with_fitz(fixture.pdf_path, 300, [1]), 300,
+                                          extract_text_layer(fixture.pdf_path, 150))
+        self.assertEqual(len(locs['name']), 2)  # On both pages
+        detector.save_detections(path, locs)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+        loaded = fixture.detector()
+        self.assertEqual(loaded.load_detections(path), locs)
+        self.assertEqual((loaded.vector_pages, loaded.ocr_dpi, loaded.scores), ({0}, 150, detector.scores))
+
+    def test_detection_path_depends_on_settings(self):
+        from unittest import mock
+        from .utils import detector as detector_module
+        fixture = DocumentFixture(self)
+        path = fixture.detector().detection_path(fixture.root, 'hash')
+        self.assertEqual(fixture.detector().detection_path(fixture.root, 'hash'), path)
+        self.assertNotEqual(fixture.detector().detection_path(fixture.root, 'other'), path)
+        self.assertNotEqual(fixture.detector('llm').detection_path(fixture.root, 'hash'), path)
+        with mock.patch.object(detector_module, 'DETECTOR_VERSION', detector_module.DETECTOR_VERSION + 1):
+            self.assertNotEqual(fixture.detector().detection_path(fixture.root, 'hash'), path)
+
+    def test_fallback_detections_are_not_reused(self):
+        fixture = DocumentFixture(self)
+        detector = fixture.detector('llm')
+        detector.fallback = 'ner'
+        path = detector.detection_path(fixture.root, 'hash')
+        detector.save_detections(path, {'name': []})
+        self.assertIsNone(fixture.detector('llm').load_detections(path))
+        self.assertEqual(fixture.detector('llm').load_detections(path, allow_fallback=True), {'name': []})
+
+    def test_failed_save_keeps_the_previous_file(self):
+        from unittest import mock
+        fixture = DocumentFixture(self)
+        detector = fixture.detector()
+        path = detector.detection_path(fixture.root, 'hash')
+        detector.save_detections(path, {'name': [[0, 1, 2, 3, 4]]})
+        with mock.patch('documents.utils.detector.json.dump', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                detector.save_detections(path, {'name': []})
+        self.assertEqual(fixture.detector().load_detections(path), {'name': [[0, 1, 2, 3, 4]]})
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_cache_hit_skips_ocr_and_detection(self):
+        import shutil
+        from .process import process
+        fixture = DocumentFixture(self)
+        first = process(fixture.root, {'name': 'black'}, 'config', 'hash')
+        self.assertEqual(fixture.ner.calls, 1)
+        self.assertNotIn('detections_cached', first['metrics']['counters'])
+        # Without OCR results nor models, the cached detections are enough
+        shutil.rmtree(os.path.join(fixture.root, 'ocr_result'))
+        fixture.ner.extract_spans = None
+        second = process(fixture.root, {'name': 'blur'}, 'config2', 'hash')
+        self.assertEqual(second['metrics']['counters']['detections_cached'], 1)
+        self.assertEqual(second['processing_results']['name']['boxes'], first['processing_results']['name']['boxes'])
+        self.assertTrue(os.path.exists(second['processed_pdf_path']))
+
+
+class SplitPipelineTests(TestCase):
+    """The Celery chain/chord of tasks.start_processing, run eagerly."""
+    config = {'name': 'black', 'sens_number': 'blur', 'model_type': 'ner'}
+
+    def setUp(self):
+        from unittest import mock
+        from django.contrib.auth.models import User
+        from backend.celery import app
+        # The chord needs a result backend: an in-memory one instead of Redis
+        from celery.backends.cache import CacheBackend
+        saved = {k: app.conf[k] for k in ('task_always_eager', 'task_eager_propagates')}
+        app.conf.update(task_always_eager=True, task_eager_propagates=False)
+        self.addCleanup(app.conf.update, saved)
+        self.enterContext(mock.patch.object(type(app), 'backend', CacheBackend(app=app, backend='memory')))
+        self.enterContext(self.settings(FADE_SPLIT_PIPELINE=True, FADE_MASK_BATCH_PAGES=1))
+        self.fixture = DocumentFixture(self)
+        self.enterContext(mock.patch.object(Document, 'get_storage_path', lambda doc: self.fixture.root))
+        self.events = []
+        reporter = mock.MagicMock()
+        reporter.return_value.side_effect = lambda stage, **fields: self.events.append(stage)
+        self.enterContext(mock.patch('documents.tasks.ProgressReporter', reporter))
+        user = User.objects.create_user('owner', password='x')
+        self.document = Document.objects.create(user=user, filename='a.pdf', file_size=1, file_hash='hash')
+
+    def start(self):
+        from .models import ProcessedDocument
+        from .tasks import start_processing
+        processed = ProcessedDocument.objects.create(document=self.document, config_hash='split',
+                                                     config_data=self.config)
+        try:
+            start_processing(self.document, processed, self.config, 'split')
+        except Exception:
+            # Eager chains raise stage errors to the caller; the stored status is what counts
+            pass
+        processed.refresh_from_db()
+        return processed
+
+    def pixels(self, path):
+        import fitz
+        with fitz.open(path) as doc:
+            return [page.get_pixmap(dpi=72).samples for page in doc]
+
+    def test_same_output_as_single_process(self):
+        from .process import process
+        from .pipeline import work_dir
+        processed = self.start()
+        self.assertEqual(processed.status, 'completed')
+        self.assertEqual(self.events[0], 'started')
+        self.assertEqual(self.events[-1], 'completed')
+        self.assertFalse(os.path.exists(work_dir(self.fixture.root, 'split')))
+
+        # The single-task path on a fresh copy of the document
+        single = DocumentFixture(self)
+        result = process(single.root, self.config, 'single', 'hash')
+        self.assertEqual(self.pixels(os.path.join(self.fixture.root, 'processed_split.pdf')),
+                         self.pixels(result['processed_pdf_path']))
+        self.assertEqual(processed.total_fields, sum(r['boxes'] for r in result['processing_results'].values()))
+        self.assertEqual(processed.metrics['pages']['source'], result['metrics']['pages']['source'])
+        self.assertEqual({log.field_name: log.confidence for log in processed.logs.all()},
+                         {k: r['confidence'] for k, r in result['processing_results'].items()})
+
+    def test_failed_stage_marks_the_document_failed(self):
+        from unittest import mock
+        from .pipeline import work_dir
+        with mock.patch('documents.pipeline.Detector.get_sens_info_loc', side_effect=RuntimeError('model crashed')):
+            processed = self.start()
+        self.assertEqual(processed.status, 'failed')
+        self.assertEqual(self.events[-1], 'failed')
+        self.assertFalse(os.path.exists(work_dir(self.fixture.root, 'split')))
+
+    def test_unreadable_pdf_fails_on_the_worker(self):
+        with open(self.fixture.pdf_path, 'wb') as f:
+            f.write(b'not a pdf')
+        self.assertEqual(self.start().status, 'failed')
+
+
+class ProcessDispatchTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        user = User.objects.create_user('owner', password='x')
+        self.document = Document.objects.create(user=user, filename='a.pdf', file_size=1, file_hash='hash')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def post(self):
+        return self.client.post('/api/documents/process/', {'document_code': self.document.document_code,
+                                                            'config': {'name': 'black'}}, format='json')
+
+    def test_failed_dispatch_is_marked_and_retried(self):
+        from unittest import mock
+        from .models import ProcessedDocument
+        with mock.patch('documents.tasks.start_processing', side_effect=ConnectionError('broker down')), \
+                mock.patch('documents.tasks.ProgressReporter'):
+            self.assertEqual(self.post().status_code, 500)
+        self.assertEqual(ProcessedDocument.objects.get().status, 'failed')
+
+        # A failed record is processed again rather than served as a cached result
+        task = mock.Mock(id='task-1')
+        with mock.patch('documents.tasks.start_processing', return_value=task) as start:
+            response = self.post()
+        self.assertEqual((response.status_code, response.data['status']), (200, 'pending'))
+        self.assertEqual(start.call_count, 1)
+        self.assertEqual(ProcessedDocument.objects.get().status, 'pending')
+
+    def test_status_written_by_the_worker_is_kept(self):
+        from unittest import mock
+        from .models import ProcessedDocument
+
+        def start(document, processed_doc, config, config_hash):
+            ProcessedDocument.objects.filter(id=processed_doc.id).update(status='processing')
+            return mock.Mock(id='task-1')
+        with mock.patch('documents.tasks.start_processing', side_effect=start):
+            self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(ProcessedDocument.objects.get().status, 'processing')
+
+
+class WarmupTargetsTests(SimpleTestCase):
+    def test_models_follow_the_consumed_queues(self):
+        from .tasks import warmup_targets
+        with self.settings(FADE_WARMUP_MODELS=None):
+            self.assertEqual(warmup_targets(['ocr', 'render']), [('ocr', 'cpu')])
+            self.assertEqual(warmup_targets(['ner', 'llm', 'ner']), [('ner', 'cpu'), ('llm', 'cpu')])
+            self.assertEqual(warmup_targets(['default']), [])
+
+    def test_setting_overrides_the_queues(self):
+        from .tasks import warmup_targets
+        with self.settings(FADE_WARMUP_MODELS=[('ner', 'cuda')]):
+            self.assertEqual(warmup_targets(['ocr']), [('ner', 'cuda')])
+        with self.settings(FADE_WARMUP_MODELS=[]):
+            self.assertEqual(warmup_targets(['ocr']), [])
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        import time
+        from .utils.registry import ModelRegistry
+        self.loads = []
+
+        def load(device):
+            time.sleep(0.01)  # Widens the window for concurrent loads
+            self.loads.append(device)
+            return object()
+        self.registry = ModelRegistry()
+        self.registry.register('ner', load)
+
+    def test_get_loads_once_per_device(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(8) as pool:
+            models = list(pool.map(lambda _: self.registry.get('ner'), range(16)))
+        self.assertTrue(all(model is models[0] for model in models))
+        self.assertIsNot(self.registry.get('ner', 'cuda'), models[0])
+        self.assertEqual(sorted(self.loads), ['cpu', 'cuda'])
+        self.assertEqual(self.registry.stats()['ner@cpu']['loads'], 1)
+
+    def test_unknown_model_raises(self):
+        with self.assertRaises(KeyError):
+            self.registry.get('llm')
+
+    def test_evict_reloads_on_next_get(self):
+        first = self.registry.get('ner')
+        self.registry.get('ner', 'cuda')
+        self.registry.evict(device='cpu')
+        self.assertEqual(self.registry.loaded(), [('ner', 'cuda')])
+        self.assertIsNot(self.registry.get('ner'), first)
+        self.assertEqual(self.registry.stats()['ner@cpu']['loads'], 2)
+        self.registry.evict()
+        self.assertEqual(self.registry.loaded(), [])
+
+    def test_failed_warmup_does_not_raise(self):
+        self.registry.register('llm', lambda device: 1 / 0)
+        self.registry.warmup([('llm', 'cpu'), ('ner', 'cpu')])
+        self.assertEqual(self.registry.loaded(), [('ner', 'cpu')])
+
+
+class DiskCacheTests(SimpleTestCase):
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(mock.patch('documents.utils.cache.CACHE_ROOT', tmp))
+
+    def age(self, cache, key, seconds_ago):
+        import time
+        t = time.time() - seconds_ago
+        os.utime(cache._path(key), (t, t))
+
+    def test_make_key(self):
+        from .utils.cache import make_key
+        self.assertEqual(make_key('a', {'x': 1, 'y': 2}), make_key('a', {'y': 2, 'x': 1}))
+        self.assertNotEqual(make_key('ab', 'c'), make_key('a', 'bc'))
+        self.assertNotEqual(make_key(b'1'), make_key('1'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        from .utils.cache import DiskCache, make_key
+        cache = DiskCache('lru')
+        keys = [make_key(i) for i in range(4)]
+        for i, key in enumerate(keys):
+            cache.set(key, 'x' * 100)
+            self.age(cache, key, 100 - i)
+        self.assertEqual(cache.get(keys[0]), 'x' * 100)  # Refreshes the oldest entry
+        entry_size = os.path.getsize(cache._path(keys[0]))
+
+        cache.max_bytes = entry_size * 4
+        cache.set(make_key('new'), 'x' * 100)
+        self.assertEqual([cache.get(key) is not None for key in keys], [True, False, False, True])
+        self.assertLessEqual(cache.stats()['size_bytes'], cache.max_bytes * 0.9)
+
+        # A new instance picks up the size of what is already on disk
+        self.assertEqual(DiskCache('lru').stats()['size_bytes'], cache.stats()['size_bytes'])
+
+    def test_expired_entries_are_misses(self):
+        from .utils.cache import DiskCache, make_key
+        cache = DiskCache('ttl', ttl=60)
+        cache.set(make_key('fresh'), {'v': 1})
+        cache.set(make_key('stale'), {'v': 2})
+        with open(cache._path(make_key('stale')), 'w', encoding='utf-8') as f:
+            json.dump({'t': 0, 'v': {'v': 2}}, f)
+        self.assertEqual(cache.get(make_key('fresh')), {'v': 1})
+        self.assertIsNone(cache.get(make_key('stale')))
+        self.assertFalse(os.path.exists(cache._path(make_key('stale'))))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_corrupt_entry_is_a_miss(self):
+        from .utils.cache import DiskCache, make_key
+        cache = DiskCache('corrupt')
+        cache.set(make_key(1), [1])
+        with open(cache._path(make_key(1)), 'w') as f:
+            f.write('{"t": 1, "v"')
+        self.assertIsNone(cache.get(make_key(1)))
+
+
+class EnginePoolTests(SimpleTestCase):
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(mock.patch('documents.utils.cache.CACHE_ROOT', tmp))
+        import ocr_server
+        self.server = ocr_server
+
+    def test_full_pool_rejects_pages_after_the_admit_timeout(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        import numpy as np
+        server = self.server
+        gate = threading.Event()
+
+        def ocr_page(img, page_index, dpi):
+            gate.wait(5)
+            return [[page_index, 0, 0, 1, 1]], ['x']
+
+        async def scenario():
+            pool = server.EnginePool(False, 1, 1)
+            try:
+                img = np.zeros((4, 4, 3), np.uint8)
+                first = asyncio.ensure_future(pool.submit(img, 0, cache=False))
+                await asyncio.sleep(0.05)
+                with self.assertRaises(server.PoolBusy):
+                    await pool.submit(img, 1, cache=False)
+                gate.set()
+                self.assertEqual(await first, ([[0, 0, 0, 1, 1]], ['x']))
+                # The slot of the finished page is free again
+                self.assertEqual(await pool.submit(img, 2, cache=False), ([[2, 0, 0, 1, 1]], ['x']))
+                return pool.metrics()
+            finally:
+                gate.set()
+                pool.shutdown()
+
+        with mock.patch.object(server.EnginePool, '_executor', lambda pool: ThreadPoolExecutor(pool.workers)), \
+                mock.patch.object(server.rocr, 'ocr_page', ocr_page), \
+                mock.patch.object(server.rocr, 'engine_ready', lambda: True), \
+                mock.patch.object(server, 'OCR_ADMIT_TIMEOUT', 0.05):
+            metrics = asyncio.run(scenario())
+        self.assertEqual((metrics['pages'], metrics['rejected'], metrics['in_flight']), (2, 1, 0))
+
+    def test_busy_pool_answers_503_with_retry_after(self):
+        import io
+        from unittest import mock
+        import numpy as np
+        from fastapi.testclient import TestClient
+        server = self.server
+        pool = mock.Mock()
+        pool.submit = mock.AsyncMock(side_effect=server.PoolBusy('OCR pool cpu is full (1 pages)'))
+        body = io.BytesIO()
+        np.save(body, np.zeros((4, 4, 3), np.uint8))
+        with mock.patch.object(server, 'get_pool', return_value=pool):
+            response = TestClient(server.app).post('/ocr_page?page=0&gpu=false', content=body.getvalue())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(server.OCR_RETRY_AFTER))
+
+        pool.submit.side_effect = RuntimeError('engine crashed')
+        with mock.patch.object(server, 'get_pool', return_value=pool):
+            response = TestClient(server.app).post('/ocr_page?page=0&gpu=false', content=body.getvalue())
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn('Retry-After', response.headers)
+
+    def test_http_and_shared_memory_backends_hand_over_the_same_page(self):
+        from multiprocessing import shared_memory
+        from unittest import mock
+        import numpy as np
+        from fastapi.testclient import TestClient
+        from .utils.ocr import make_ocr_processor
+        server = self.server
+        received = []
+
+        async def submit(img, page_index, dpi, cache):
+            received.append(img)
+            return [[page_index, 1, 2, 3, 4]], ['字']
+        img = np.random.default_rng(0).integers(0, 255, (30, 20, 3), dtype=np.uint8)
+        # Server and worker share this process and its resource tracker entry: leave the tracker out
+        with mock.patch.object(server, 'get_pool', return_value=mock.Mock(submit=submit)), \
+                mock.patch.object(server.resource_tracker, 'register'), \
+                mock.patch.object(server.resource_tracker, 'unregister'), \
+                mock.patch.object(shared_memory.SharedMemory, 'unlink', autospec=True,
+                                  side_effect=shared_memory.SharedMemory.unlink) as unlink:
+            for backend in ('http', 'shm'):
+                processor = make_ocr_processor(backend, base_url='')
+                processor._local.session = TestClient(server.app, base_url='http://testserver')
+                self.assertEqual(processor.ocr_image(img, 3, gpu=False), ([[3, 1, 2, 3, 4]], ['字']), backend)
+        self.assertEqual(len(received), 2)
+        for page in received:
+            self.assertTrue(np.array_equal(page, img))
+        self.assertEqual(unlink.call_count, 1)  # The shared memory block is released by the worker
+
+        with self.assertRaises(ValueError):
+            make_ocr_processor('ftp')
+
+
+class StageTimerTests(SimpleTestCase):
+    def test_nested_stages_are_not_counted_twice(self):
+        from unittest import mock
+        from .utils.timing import StageTimer
+        clock = iter(range(100))
+        timer = StageTimer()
+        with mock.patch('documents.utils.timing.time.perf_counter', lambda: next(clock)):
+            # ocr pulls pages that are rendered lazily: 0 [ocr 1 [render 2] 3 [render 4] 5] 6
+            with timer.stage('ocr'):
+                for _ in timer.iter('render', ['a']):
+                    pass
+        self.assertEqual(timer.totals, {'ocr': 3, 'render': 2})
+        timer.add('mask', 1.5)
+        timer.count('pages', 2)
+        timer.count('pages')
+        self.assertEqual(timer.as_dict(), {'stages': {'ocr': 3, 'render': 2, 'mask': 1.5}, 'counters': {'pages': 3}})
+
+
+class StageStatsTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        self.user = User.objects.create_user('owner', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def processed(self, user, seconds, pages, status='completed', **counters):
+        from .models import ProcessedDocument
+        document = Document.objects.create(user=user, filename='a.pdf', file_size=1)
+        return ProcessedDocument.objects.create(
+            document=document, config_hash=str(seconds), config_data={}, status=status,
+            metrics={'total': seconds, 'stages': {'ocr': seconds / 2}, 'counters': dict(counters, pages=pages)})
+
+    def test_percentiles_over_completed_runs_of_the_user(self):
+        from datetime import timedelta
+        from django.contrib.auth.models import User
+        from django.utils import timezone
+        from .models import ProcessedDocument
+        for seconds in range(1, 21):
+            self.processed(self.user, seconds, pages=2, llm_chunks=4, llm_cache_hits=1)
+        self.processed(self.user, 1000, pages=2, status='failed')
+        old = self.processed(self.user, 1000, pages=2)
+        ProcessedDocument.objects.filter(id=old.id).update(process_time=timezone.now() - timedelta(days=2))
+        self.processed(User.objects.create_user('other', password='x'), 1000, pages=2)
+
+        data = self.client.get('/api/documents/stage_stats/', {'hours': 24}).data
+        self.assertEqual(data['count'], 20)
+        self.assertEqual(data['stages']['total'], {'count': 20, 'p50': 10.5, 'p95': 19.05, 'mean': 10.5})
+        self.assertEqual(data['stages']['ocr']['p50'], 5.25)
+        self.assertEqual(data['per_page']['total']['p50'], 5.25)
+        self.assertEqual(data['llm_cache'], {'chunks': 80, 'hits': 20, 'hit_rate': 0.25})
+
+        # Staff may include every user's runs; others may not
+        self.assertEqual(self.client.get('/api/documents/stage_stats/', {'all': '1'}).data['count'], 20)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get('/api/documents/stage_stats/', {'all': '1'}).data['count'], 21)
+
+
+class ParallelMaskTests(SimpleTestCase):
+    def pages(self, n):
+        import numpy as np
+        rng = np.random.default_rng(1)
+        return [(i, rng.integers(0, 255, (120, 90, 3), dtype=np.uint8)) for i in range(n)]
+
+    def test_same_pages_as_sequential_masking(self):
+        from .process import mask_pages
+        config = {'name': 'mosaic', 'phone': 'blur', 'id': 'black', 'output_profile': 'jpeg'}
+        page_boxes = {i: [('name', 5, 5, 20, 10), ('phone', 10 + i, 30, 30, 12), ('id', 0, 60, 40, 8)]
+                      for i in range(0, 9, 2)}
+        sequential = list(mask_pages(self.pages(9), page_boxes, config, 1.0, workers=1))
+        parallel = list(mask_pages(self.pages(9), page_boxes, config, 1.0, workers=4))
+        self.assertEqual([page[0] for page in parallel], list(range(9)))
+        self.assertEqual([page[1] for page in parallel], [page[1] for page in sequential])
+        self.assertEqual(set(parallel[0][4]), {'name', 'phone', 'id'})
+        self.assertEqual(parallel[1][4], {})
+
+    def test_pages_in_flight_are_bounded(self):
+        from .process import mask_pages
+        pulled = []
+
+        def pages():
+            for page in self.pages(20):
+                pulled.append(page[0])
+                yield page
+        masked = mask_pages(pages(), {}, {}, 1.0, workers=2)
+        next(masked)
+        self.assertLessEqual(len(pulled), 2 * 2 + 1)
+        self.assertEqual(len(list(masked)), 19)
+
+
+class NERBatchTests(SimpleTestCase):
+    def model(self):
+        from unittest import mock
+        from .utils.ner import NERModel
+        model = NERModel.__new__(NERModel)
+        model.sensitive_entities = ["B-name", "I-name"]
+        model.chunk_overlap = 4
+        # Windows of 10 characters overlapping by 4, in place of the langchain splitter
+        model.text_splitter = mock.Mock(split_text=lambda text: [text[i:i + 10] for i in range(0, max(len(text) - 4, 1), 6)])
+        model.batches = []
+
+        def ner(chunks, batch_size):
+            model.batches.append(list(chunks))
+            docs = []
+            for chunk in chunks:
+                tokens = []
+                for start, _ in find_phrase(chunk, '张三'):
+                    tokens.append({'entity': 'B-name', 'word': '张', 'score': 0.95, 'start': start, 'end': start + 1})
+                    tokens.append({'entity': 'I-name', 'word': '三', 'score': 0.95, 'start': start + 1, 'end': start + 2})
+                    tokens.append({'entity': 'O', 'word': '', 'score': 0.99, 'start': start + 2, 'end': start + 2})
+                docs.append(tokens)
+            return docs
+        model.ner = ner
+        return model
+
+    def test_batch_gives_the_spans_of_each_text_alone(self):
+        texts = ['联系人张三，电话一二三四五，张三的同事', '张三', '', '无敏感信息的一段较长的文字内容，再次提到张三。']
+        model = self.model()
+        alone = [list(model.extract_spans(text)) for text in texts]
+        model.batches.clear()
+        batched = model.extract_spans_batch(texts)
+        self.assertEqual(len(model.batches), 1)  # One pipeline call for every chunk of every text
+        self.assertEqual(model.batches[0], sorted(model.batches[0], key=len))
+        self.assertEqual([list(spans) for spans in batched], alone)
+        for text, spans in zip(texts, model.extract_sensitive_batch(texts)):
+            self.assertEqual(spans.get('name', set()), {'张三'} if '张三' in text else set())
+        # Offsets are in the text, also for chunks after the first and entities in the overlaps
+        self.assertEqual([(start, end) for start, end, *_ in alone[0]], [(3, 5), (14, 16)])
+
+
+class PageRenderingTests(SimpleTestCase):
+    def test_scanned_pages_are_rendered_once_for_ocr_and_masking(self):
+        from unittest import mock
+        from .process import process
+        fixture = DocumentFixture(self)
+        rendered = []
+
+        def iter_pages(pdf_path, dpi, page_indices=None):
+            for page_index, img in _render_with_fitz(pdf_path, dpi, page_indices):
+                rendered.append(page_index)
+                yield page_index, img
+        with mock.patch('documents.process.iter_pages', iter_pages):
+            result = process(fixture.root, {'name': 'black'}, 'once', 'hash')
+        # Page 0 has a text layer and is never rasterised; the scanned page 1 is rendered once
+        self.assertEqual(rendered, [1])
+        self.assertEqual(result['processing_results']['name']['boxes'], 2)
+        self.assertEqual([name for name in os.listdir(fixture.root) if name.startswith('.pages_')], [])
+
+    def test_pages_are_rendered_lazily_in_runs_of_consecutive_pages(self):
+        from unittest import mock
+        import numpy as np
+        from .utils.render import iter_pages
+        calls = []
+
+        def convert_from_path(pdf_path, dpi, fmt, first_page, last_page, **kwargs):
+            calls.append((first_page, last_page))
+            return [np.full((2, 2, 3), page, np.uint8) for page in range(first_page, last_page + 1)]
+        pages_wanted = [0, 1, 2, 5, 6, 7, 8, 9, 10]
+        with mock.patch('documents.utils.render.convert_from_path', convert_from_path), \
+                mock.patch('documents.utils.render.RENDER_BATCH', 4):
+            pages = iter_pages('doc.pdf', 150, pages_wanted)
+            page_index, img = next(pages)
+            self.assertEqual(calls, [(1, 3)])  # Nothing rendered ahead of the first run
+            self.assertEqual((page_index, img[0, 0, 0]), (0, 1))
+            rest = list(pages)
+        self.assertEqual(calls, [(1, 3), (6, 9), (10, 11)])
+        self.assertEqual([i for i, _ in rest], pages_wanted[1:])
+        self.assertEqual([int(img[0, 0, 0]) for _, img in rest], [i + 1 for i in pages_wanted[1:]])
+
+    def test_pdf_pages_are_written_as_they_are_added(self):
+        import io
+        import cv2
+        import fitz
+        import numpy as np
+        from .utils.pdfwriter import PDFStreamWriter
+        rng = np.random.default_rng(3)
+        pages = [rng.integers(0, 255, (50, 40, 3), dtype=np.uint8), rng.integers(0, 255, (30, 60), dtype=np.uint8)]
+        f = io.BytesIO()
+        writer = PDFStreamWriter(f)
+        sizes = []
+        for img in pages:
+            writer.add_png(cv2.imencode('.png', img)[1].tobytes(), 150)
+            sizes.append(f.tell())
+        writer.close()
+        self.assertLess(sizes[0], sizes[1])
+        self.assertGreater(sizes[0], pages[0].nbytes // 4)  # The first image is on disk before the second is added
+        with fitz.open(stream=f.getvalue(), filetype='pdf') as doc:
+            self.assertEqual(len(doc), 2)
+            for page, img in zip(doc, pages):
+                self.assertAlmostEqual(page.rect.width, img.shape[1] * 72 / 150, places=3)
+                pix = fitz.Pixmap(doc, page.get_images()[0][0])
+                decoded = np.frombuffer(pix.samples, np.uint8).reshape(img.shape[0], img.shape[1], pix.n)
+                expected = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) if img.ndim == 3 else img[:, :, None]
+                self.assertTrue(np.array_equal(decoded, expected))
+
+    def test_spooled_pages_are_lossless(self):
+        import tempfile
+        import numpy as np
+        from .utils.render import PageSpool
+        img = np.random.default_rng(2).integers(0, 255, (40, 30, 3), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = PageSpool(tmp)
+            self.assertEqual([i for i, _ in spool.tee([(3, img), (5, img[::-1])])], [3, 5])
+            # Another spool on the same directory, like the next task of the pipeline, sees the pages
+            reopened = PageSpool(tmp, spool.dir)
+            self.assertEqual(reopened.indices, [3, 5])
+            self.assertTrue(np.array_equal(reopened.read(5), img[::-1]))
+            self.assertNotIn(4, reopened)
+            spool.close()
+            self.assertFalse(os.path.exists(spool.dir))
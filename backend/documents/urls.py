@@ -4,6 +4,10 @@ from . import views
 urlpatterns = [
     # 文档上传和管理
     path('upload/', views.upload_document, name='upload_document'),
+    path('upload/init/', views.upload_init, name='upload_init'),
+    path('upload/<str:upload_id>/', views.upload_session, name='upload_session'),
+    path('upload/<str:upload_id>/chunk/', views.upload_chunk, name='upload_chunk'),
+    path('upload/<str:upload_id>/finalize/', views.upload_finalize, name='upload_finalize'),
     path('list/', views.get_user_documents, name='get_user_documents'),
     path('detail/<str:document_code>/', views.get_document_detail, name='get_document_detail'),
     path('delete/<str:document_code>/', views.delete_document, name='delete_document'),
@@ -15,6 +19,7 @@ urlpatterns = [
     path('processed_list/', views.get_user_processed_documents, name='get_user_processed_documents'),
     path('preview/<str:document_code>/<int:processed_id>/', views.preview_document, name='preview_document'),
     path('processed-info/<int:processed_id>/', views.processed_document_info, name='processed_document_info'),
+    path('progress/<int:processed_id>/', views.processing_progress_stream, name='processing_progress_stream'),
     path('export_all/', views.export_all_processed_documents, name='export_all_processed_documents'),
     
     # 系统配置
@@ -22,4 +27,5 @@ urlpatterns = [
     
     # 仪表板统计
     path('dashboard_stats/', views.get_dashboard_stats, name='get_dashboard_stats'),
+    path('stage_stats/', views.get_stage_stats, name='get_stage_stats'),
 ] 
\ No newline at end of file
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Local cache root, shared by the Celery workers and the OCR server on the same host
+CACHE_ROOT = os.environ.get(
+    'FADE_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'media', '.cache')
+)
+
+def make_key(*parts):
+    """Stable hex key from strings/bytes/JSON-serialisable parts."""
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+class DiskCache:
+    """
+    Size-bounded, content-addressed JSON cache on local disk with LRU eviction.
+    Entries are files named by key; a hit refreshes the file's mtime, and when the
+    cache grows past max_bytes the least recently used files are removed.
+    Safe to share between processes: entries are written atomically, and
+    eviction races only ever cost a cache miss.
+    """
+    def __init__(self, name, max_bytes=1024 ** 3, ttl=None):
+        self.dir = os.path.join(CACHE_ROOT, name)
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # Seconds an entry stays valid, None for no expiry
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        self._size = self._scan_size()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - entry['t'] > self.ttl:
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['v']
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'t': time.time(), 'v': value}, ensure_ascii=False).encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'size_bytes': self._size,
+        }
+
+    def _path(self, key):
+        return os.path.join(self.dir, key[:2], key + '.json')
+
+    def _entries(self):
+        for sub in os.scandir(self.dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        yield entry.path, entry.stat()
+                    except OSError:
+                        continue
+
+    def _scan_size(self):
+        return sum(st.st_size for _, st in self._entries())
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is at 90% of its limit."""
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        self._size = sum(st.st_size for _, st in entries)
+        target = self.max_bytes * 0.9
+        for path, st in entries:
+            if self._size <= target:
+                break
+            self._remove(path)
+            self._size -= st.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,157 +1,224 @@
 import os
 import json
-import re
-from .ocr import OCRProcessor
-from .llm import LLM
-from .ner import NERModel
+from .cache import make_key
+from .llm import LLM_MODEL_NAME
+from .ner import resolve_device, NER_MODEL_NAME
+from .locate import locate_spans
+from .ocrstore import save_ocr_result, load_ocr_result, ocr_result_exists, convert_json
+from .registry import registry
+from .rules import RULES
+from .spans import Spans
+from .render import downsample, OCR_DPI, RENDER_DPI
+from .timing import StageTimer
+
+# Bump when detection output changes, so that cached detections are recomputed
+DETECTOR_VERSION = 3
 
 class Detector:
     def __init__(self, gpu, model_type='ner'):
-        # OCR module
-        self.ocr = OCRProcessor()
+        # Models are borrowed from the process-wide registry instead of being reloaded per task
         self.gpu = gpu
-        
-        # NLP modules
-        self.ner = NERModel(gpu)
-        self.llm = LLM()
+        self.device = resolve_device(gpu)
 
-        self.ocr_path = ""  # Directory to save OCR results
+        self.ocr_path = ""  # Directory to save OCR results (see ocrstore)
+        self.ocr_dpi = OCR_DPI  # Resolution of the OCR box coordinates
+        self.vector_pages = set()   # Pages whose text came from the PDF text layer
+        self.fallback = None    # Model that produced the entities instead of self.mode after a failure
+        self.scores = {}    # Mean score of the detected spans per category, see get_sens_info_loc
+        self.timer = StageTimer()   # Per-stage timings, replaced by the caller to collect them per task
         
         self.mode = model_type   # should be one of ner, llm
 
+    # Models are looked up on first use, so a worker that only runs some pipeline stages
+    # (see pipeline.py) never loads the models of the others
+
+    @property
+    def ocr(self):
+        return registry.get('ocr')
+
+    @property
+    def ner(self):
+        return registry.get('ner', self.device)
+
+    @property
+    def llm(self):
+        return registry.get('llm')
+
+    def has_ocr_result(self):
+        """Whether OCR results (or legacy ocr_result.json) exist for self.ocr_path."""
+        return ocr_result_exists(self.ocr_path) or os.path.exists(self.ocr_path + '.json')
+
+    def settings(self):
+        """Everything besides the document that determines the detection output."""
+        return {
+            'version': DETECTOR_VERSION,
+            'model_type': self.mode,
+            'ner_model': NER_MODEL_NAME,
+            'llm_model': LLM_MODEL_NAME,
+        }
+
+    def detection_path(self, root_path, file_hash):
+        """
+        Cache file of the detection results, keyed by document hash and detector settings only,
+        so changing the cover method or colors of a document does not run OCR and NER/LLM again.
+        """
+        return os.path.join(root_path, 'detections', f'{make_key(file_hash, self.settings())}.json')
+
+    def load_detections(self, path, allow_fallback=False):
+        """
+        Return cached sens_info_loc (see get_sens_info_loc), or None if there is none.
+        Detections saved after the LLM fell back to NER are not reused by later runs, so the LLM is
+        tried again; allow_fallback=True reads them anyway (later stages of the same run).
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('fallback') and not allow_fallback:
+            print(f"[INFO] Ignoring detections made by the {data['fallback']} fallback: {path}")
+            return None
+        self.ocr_dpi = data['ocr_dpi']
+        self.vector_pages = set(data['vector_pages'])
+        self.scores = data.get('scores', {})
+        return data['sens_info_loc']
+
+    def save_detections(self, path, sens_info_loc):
+        """Write the detections through a temporary file, so readers never see a partial file."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'settings': self.settings(),
+                    'fallback': self.fallback,
+                    'ocr_dpi': self.ocr_dpi,
+                    'vector_pages': sorted(self.vector_pages),
+                    'scores': self.scores,
+                    'sens_info_loc': sens_info_loc,
+                }, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
     def set_mode(self, mode):
         '''Set mode of detector, ner or llm'''
         self.mode = mode
 
-    def get_text_from_pdf(self, pdf_path):
+    def get_text_from_pdf(self, pdf_path, pages=None, dpi=RENDER_DPI, text_layer=None):
+        """
+        Args:
+            pdf_path (str): Path of the PDF file.
+            pages (iterable): Optional (page_index, image) pairs already rendered at `dpi`. When given, OCR
+                              runs on a downsampled view of them instead of rasterising the PDF again.
+                              Pages are consumed one at a time.
+            text_layer (dict): Optional {page_index: (boxes, txts)} read from the PDF text layer
+                               (see vector.extract_text_layer); those pages are not OCR'd.
+        """
+        # Results saved by older versions as ocr_result.json are converted instead of OCR'd again
+        legacy_path = self.ocr_path + '.json'
+        if not ocr_result_exists(self.ocr_path) and os.path.exists(legacy_path):
+            convert_json(legacy_path, self.ocr_path, remove=True)
         # Check if the output directory exists, if not, process the image
-        if not os.path.exists((self.ocr_path)):
+        if not ocr_result_exists(self.ocr_path):
             print(f"[INFO] Processing OCR for {pdf_path}")
-            self.ocr.process_pdf(pdf_path, self.ocr_path, self.gpu)
-        # Read the JSON file to get the text and bounding boxes
+            with registry.timed('ocr'), self.timer.stage('ocr'):
+                if pages is None and not text_layer:
+                    self.ocr.process_pdf(pdf_path, self.ocr_path, self.gpu)
+                else:
+                    self.ocr_pages(pages or (), dpi, text_layer or {})
+        # Memory-map the stored results to get the text and bounding boxes
         print(f"[INFO] Reading OCR results from {self.ocr_path}")
-        with open(self.ocr_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        boxes = data['boxes']
-        texts = data['txts']
-        return texts, boxes
+        result = load_ocr_result(self.ocr_path)
+        self.ocr_dpi = result.dpi
+        self.vector_pages = result.vector_pages
+        return result.texts, result.boxes
+
+    def ocr_pages(self, pages, dpi, text_layer):
+        """OCR the rendered pages, merge them with the text-layer pages and save the result in page order."""
+        results = dict(text_layer)
+        imgs = ((page_index, downsample(img, dpi, OCR_DPI)) for page_index, img in pages)
+        for page_index, result in self.ocr.ocr_images(imgs, self.gpu, OCR_DPI):
+            results[page_index] = result
+        all_boxes, all_txts = [], []
+        for page_index in sorted(results):
+            boxes, txts = results[page_index]
+            all_boxes.extend(boxes)
+            all_txts.extend(txts)
+        save_ocr_result(self.ocr_path, all_boxes, all_txts, OCR_DPI, sorted(text_layer))
     
-    def extract_sensitive(self, text):
+    def extract_entities(self, text):
         """
-        Extracts sensitive information from the given text using spaCy's named entity recognition.
+        Extracts named entities (names, companies, addresses, ...) with the NER or LLM model.
         Args:
             text (str): The input text to analyze.
         Returns:
-            dict: A dictionary with entity labels as keys and lists of corresponding phrases as values.
+            Spans: Entities with their offsets in the text.
         """
-
+        spans = Spans()
         if self.mode == 'ner':
-            sensitive_info = self.ner.extract_sensitive(text)
+            with registry.timed('ner', self.device):
+                spans = self.ner.extract_spans(text)
         elif self.mode == 'llm':
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    sensitive_info = self.llm.extract_sensitive(text)
-                    break
-                except Exception as e:
-                    print(f"[INFO] LLM 第 {attempt + 1} 次尝试失败: {str(e)}")
-                    if attempt == max_retries - 1:
-                        print("[INFO] LLM 三次尝试均失败，回退到 NER")
-                        sensitive_info = self.ner.extract_sensitive(text)
+            # Failed chunks are retried inside the LLM client; only a chunk that still fails falls back to NER
+            counters = {}
+            try:
+                with registry.timed('llm'):
+                    spans = self.llm.extract_spans(text, counters)
+            except Exception as e:
+                print(f"[INFO] LLM 识别失败，回退到 NER: {str(e)}")
+                self.fallback = 'ner'
+                with registry.timed('ner', self.device):
+                    spans = self.ner.extract_spans(text)
+            for name, n in counters.items():
+                self.timer.count(name, n)
         else:
             print(f"[ERROR]: Unrecognized mode {self.mode}. Detector mode should be one of ner and llm.")
-        sensitive_info["sens_number"] = re.findall(r'[a-zA-Z0-9-]+', text)  # Find long numbers (e.g., phone numbers, id numbers, account)
-        filtered_numbers = [text for text in sensitive_info["sens_number"] if re.search(r'\d', text) and len(re.findall(r'\d', text)) >= 5]
-        sensitive_info["sens_number"] = filtered_numbers
-        # \b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b
-        sensitive_info["email"] = re.findall(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z0-9]{2,}', text)  # Find email addresses
-        return sensitive_info
-
-    def get_sens_info_loc(self, pdf_path):
+        return spans
+
+    def extract_spans(self, text):
+        """
+        Returns:
+            Spans: Entities from the model, then numbers and emails from the rules.
+        """
+        with self.timer.stage(self.mode):
+            entities = self.extract_entities(text)
+        with self.timer.stage('rules'):
+            rules = RULES.spans(text)
+        return Spans.concat([entities, rules])
+
+    def extract_sensitive(self, text):
         """
+        Extracts sensitive information: named entities from the model, numbers and emails from the rules.
         Args:
-            sens_info (dict): A dictionary where keys are sensitive information types and values are lists of phrases.
+            text (str): The input text to analyze.
+        Returns:
+            dict: A dictionary with entity labels as keys and sets of corresponding phrases as values.
+        """
+        return self.extract_spans(text).phrases(text)
+
+    def get_sens_info_loc(self, pdf_path, pages=None, dpi=RENDER_DPI, text_layer=None):
+        """
+        Args:
+            pdf_path (str): Path of the PDF file.
+            pages (iterable): Optional (page_index, image) pairs rendered at `dpi`, shared with the OCR step.
+            text_layer (dict): Optional text-layer pages that skip OCR, see get_text_from_pdf.
         Returns:
             sens_info_loc (dict):   A dictionary where keys are sensitive information types,
                                     and values are bounding boxes for the sensitive information phrases found in the image.
+                                    Boxes are in OCR coordinates, see self.ocr_dpi.
+                                    The mean score of the spans of each category is kept in self.scores.
         """
-        texts, boxes = self.get_text_from_pdf(pdf_path)
-        sentence = "".join(texts)
+        texts, boxes = self.get_text_from_pdf(pdf_path, pages, dpi, text_layer)
+        sentence = texts if isinstance(texts, str) else "".join(texts)
         print(f"[INFO] Extracting sensitive information using {self.mode} model.")
-        sens_info = self.extract_sensitive(sentence)
-        # 'n' starting means no '\n' version variables
-        newline_num = 0
-        nl_nums = []    # list of numbers indicating the number of '\n' before each character
-        for text, box in zip(texts, boxes):
-            if text != '\n':
-                nl_nums.append(newline_num)
-            else:
-                newline_num += 1
-        n_sentence = sentence.replace('\n', '')
-        sens_info_loc = {}
-
-        # 处理敏感信息坐标重叠的问题
-        locs = []
-        for key, phrases in sens_info.items():
-            for phrase in phrases:
-                n_indexes = [match.start() for match in re.finditer(re.escape(phrase), n_sentence)]
-                for start in n_indexes:
-                    end = start + len(phrase)
-                    locs.append((start, end))
-        locs.sort(key=lambda x: x[0])  # Sort by start index
-        # Merge overlapping locations
-        merged_locs_dict = {}
-        merged_locs = set()
-        i = 0
-        while i < len(locs):
-            merge_loc = locs[i]
-            keys = [locs[i]]
-            for j in range(i + 1, len(locs)):
-                if locs[j][0] < merge_loc[1]:
-                    merge_loc = (min(merge_loc[0], locs[j][0]), max(merge_loc[1], locs[j][1]))
-                    keys.append(locs[j])
-                else:
-                    break
-            i = i + len(keys)
-            for key in keys:
-                merged_locs.add(key)
-            merged_locs_dict[keys[0]] = merge_loc   # 不同敏感信息只需要保留一个即可，不然会重复处理，对应的种类与图片处理方法就随机选了第一个，标记为“选中”
-
-        for key, phrases in sens_info.items():
-            sens_loc = []
-            for phrase in phrases:
-                n_indexes = [match.start() for match in re.finditer(re.escape(phrase), n_sentence)]
-                for n_start in n_indexes:
-                    nl_pos = [] # positions of the word just before '\n' in the phrase
-                    last_nl = nl_nums[n_start]
-                    
-                    if (n_start, n_start + len(phrase)) in merged_locs:
-                        if (n_start, n_start + len(phrase)) in merged_locs_dict.keys():
-                            n_start, n_end = merged_locs_dict[(n_start, n_start + len(phrase))]   # 是“选中”的敏感信息
-                        else:
-                            continue    # 若此点未被”选中“，则跳过
-                    else:
-                        n_end = n_start + len(phrase)
-                    
-                    for i in range(n_start, n_end):
-                        if nl_nums[i] != last_nl:
-                            last_nl = nl_nums[i]
-                            nl_pos.append(i-1)
-                    n_box_start_i = n_start
-                    for n_box_end_i in nl_pos:
-                        box_start_i = n_box_start_i + nl_nums[n_box_start_i]
-                        box_start = boxes[box_start_i]
-                        box_end_i = n_box_end_i + nl_nums[n_box_end_i]
-                        box_end = boxes[box_end_i]
-                        box = [box_start[0], box_start[1], box_start[2], box_end[3]-box_start[1], box_end[4]-box_start[2]]
-                        sens_loc.append(box)
-                        n_box_start_i = n_box_end_i + 1
-                    box_start_i = n_box_start_i + nl_nums[n_box_start_i]
-                    box_start = boxes[box_start_i]
-                    n_box_end_i = n_end - 1
-                    box_end_i = n_box_end_i + nl_nums[n_box_end_i]
-                    box_end = boxes[box_end_i]
-                    box = [box_start[0], box_start[1], box_start[2], box_end[3]-box_start[1], box_end[4]-box_start[2]]
-                    sens_loc.append(box)
-            sens_info_loc[key] = sens_loc
-        return sens_info_loc
+        # Detections carry their offsets, so only the occurrences found are masked, without searching the text again
+        spans = self.extract_spans(sentence)
+        self.scores = {}
+        for i, name in enumerate(spans.categories):
+            scores = spans.score[spans.category == i]
+            if len(scores):
+                self.scores[name] = round(float(scores.mean()), 4)
+        with self.timer.stage('locate'):
+            return locate_spans(texts, boxes, spans)
@@ -0,0 +1,135 @@
+"""
+Output encodings for rasterised pages of processed PDFs.
+
+Profiles (config key 'output_profile'):
+    png      lossless Flate, as before (the default)
+    jpeg     DCT at 'output_quality'; grayscale pages are stored with one channel
+    bilevel  1-bit CCITT Group 4, for black and white text scans
+    auto     per page: CCITT G4 for bilevel pages, otherwise JPEG (gray or color)
+'output_dpi' lowers the resolution of the embedded images; the page size is unchanged.
+JBIG2 is not offered: there is no JBIG2 encoder among the dependencies, and CCITT G4
+comes close to it on text scans.
+"""
+import io
+import json
+import struct
+from collections import namedtuple
+import cv2
+import numpy as np
+from PIL import Image
+from .pdfwriter import PDFStreamWriter
+from .render import RENDER_DPI, downsample
+
+OUTPUT_PROFILES = ('png', 'jpeg', 'bilevel', 'auto')
+DEFAULT_OUTPUT = {'output_profile': 'png', 'output_quality': 75, 'output_dpi': RENDER_DPI}
+MIN_OUTPUT_DPI = 72
+
+GRAY_TOLERANCE = 12         # Max channel spread of a "gray" pixel
+GRAY_MAX_COLOR = 0.001      # Fraction of colored pixels still treated as a grayscale page
+BILEVEL_MAX_MIDTONE = 0.01  # Fraction of mid-tone pixels still treated as a bilevel page
+BILEVEL_THRESHOLD = 128
+
+# An encoded image stream, as taken by PDFStreamWriter.add_image
+EncodedImage = namedtuple('EncodedImage', 'data width height color_space bits filter params')
+
+class OutputProfile:
+    def __init__(self, profile='png', quality=75, dpi=RENDER_DPI):
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"Unsupported output profile: {profile}")
+        # bool is an int subclass: True would silently become quality/dpi 1
+        if isinstance(quality, bool) or isinstance(dpi, bool):
+            raise ValueError(f"Invalid output quality/dpi: {quality!r}/{dpi!r}")
+        self.profile = profile
+        self.quality = int(quality)
+        self.dpi = min(int(dpi), RENDER_DPI)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('output_profile', DEFAULT_OUTPUT['output_profile']),
+                   config.get('output_quality', DEFAULT_OUTPUT['output_quality']),
+                   config.get('output_dpi', DEFAULT_OUTPUT['output_dpi']))
+
+    def encode(self, img, src_dpi=RENDER_DPI):
+        """Encode a BGR page rendered at src_dpi. Returns an EncodedImage at self.dpi."""
+        if self.profile == 'png':
+            return encode_png(downsample(img, src_dpi, self.dpi))
+        # Classified at full resolution: downsampling turns sharp edges into mid-tones
+        kind = 'bilevel' if self.profile == 'bilevel' else classify(img)
+        img = downsample(img, src_dpi, self.dpi)
+        if kind == 'bilevel' and self.profile != 'jpeg':
+            return encode_ccitt(_to_gray(img))
+        if kind != 'color':
+            img = _to_gray(img)
+        return encode_jpeg(img, self.quality)
+
+def classify(img):
+    """'color', 'gray' or 'bilevel', judged on a subsampled view of a BGR page."""
+    small = img[::4, ::4]
+    spread = small.max(axis=2).astype(np.int16) - small.min(axis=2)
+    if np.count_nonzero(spread > GRAY_TOLERANCE) > GRAY_MAX_COLOR * spread.size:
+        return 'color'
+    gray = small[:, :, 1]
+    midtone = np.count_nonzero((gray > 64) & (gray < 192))
+    return 'bilevel' if midtone <= BILEVEL_MAX_MIDTONE * gray.size else 'gray'
+
+def _to_gray(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+def encode_png(img):
+    _, buffer = cv2.imencode(".png", img)
+    return EncodedImage(*PDFStreamWriter.png_image(buffer.tobytes()))
+
+def encode_jpeg(img, quality):
+    _, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    h, w = img.shape[:2]
+    color_space = b"/DeviceGray" if img.ndim == 2 else b"/DeviceRGB"
+    return EncodedImage(buffer.tobytes(), w, h, color_space, 8, b"/DCTDecode", None)
+
+def encode_ccitt(gray):
+    """1-bit CCITT Group 4 image of a grayscale page (thresholded), encoded by libtiff via Pillow."""
+    h, w = gray.shape
+    bilevel = Image.fromarray(gray).point(lambda v: 255 if v >= BILEVEL_THRESHOLD else 0, mode='1')
+    tiff = io.BytesIO()
+    # A single strip, so the strip data is exactly the G4 stream
+    bilevel.save(tiff, format='TIFF', compression='group4', tiffinfo={278: h})
+    data = _tiff_strip(tiff.getvalue())
+    params = b"<< /K -1 /Columns %d /Rows %d /BlackIs1 true >>" % (w, h)
+    return EncodedImage(data, w, h, b"/DeviceGray", 1, b"/CCITTFaxDecode", params)
+
+def _tiff_strip(tiff):
+    """Data of the single strip of the first image of a TIFF file."""
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    count = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    tags = {}
+    for i in range(count):
+        entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        tag, typ, n = struct.unpack(endian + 'HHI', entry[:8])
+        value = struct.unpack(endian + ('H' if typ == 3 else 'I'), entry[8:10] if typ == 3 else entry[8:12])[0]
+        tags[tag] = (n, value)
+    if tags[273][0] != 1:
+        raise ValueError("Expected a single-strip TIFF")
+    offset, length = tags[273][1], tags[279][1]
+    return tiff[offset:offset + length]
+
+def save_encoded(path, encoded):
+    """Write an EncodedImage to a file (JSON header line followed by the stream)."""
+    header = {
+        'width': encoded.width,
+        'height': encoded.height,
+        'color_space': encoded.color_space.decode('ascii'),
+        'bits': encoded.bits,
+        'filter': encoded.filter.decode('ascii'),
+        'params': encoded.params.decode('ascii') if encoded.params else None,
+    }
+    with open(path, 'wb') as f:
+        f.write(json.dumps(header).encode('ascii') + b'\n')
+        f.write(encoded.data)
+
+def load_encoded(path):
+    with open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        data = f.read()
+    params = header['params'].encode('ascii') if header['params'] else None
+    return EncodedImage(data, header['width'], header['height'], header['color_space'].encode('ascii'),
+                        header['bits'], header['filter'].encode('ascii'), params)
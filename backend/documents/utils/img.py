@@ -1,4 +1,13 @@
 import cv2
+import numpy as np
+
+# Blur the whole page once when blurring the rectangles one group at a time would filter more pixels
+# than this multiple of the page (small regions cost more per pixel than the page)
+PAGE_COVER_COST = 1.0
+MAX_GROUPED_RECTS = 512     # Grouping compares all pairs of rectangles
+# From this kernel size on, batch blur filters at half resolution: about 5x faster, and within a few
+# grey levels of the full-resolution result since the kernel is much wider than a pixel
+HALF_RES_BLUR_KERNEL = 15
 
 class ImageProcessor:
     def __init__(self, mosaic_size=10, blur_kernel=(51, 51), color=(0, 0, 0)):
@@ -13,6 +22,8 @@ class ImageProcessor:
     def set_blur_kernel(self, kernel):
         if kernel is None:
             return
+        if isinstance(kernel, (tuple, list)):
+            kernel = kernel[0]
         if kernel%2 == 0:
             kernel += 1  # Ensure kernel size is odd
         self.blur_kernel = (kernel, kernel)
@@ -35,6 +46,103 @@ class ImageProcessor:
         
         self.COVER_METHODS[method](img, x, y, w, h)
 
+    def cover_rects(self, img, rects, method='blur'):
+        """
+        Apply a covering method to many rectangles of the image at once.
+
+        Rectangles are clipped together. For blur, overlapping or touching rectangles are merged,
+        each group is blurred once over its bounding box and composited back through a mask of
+        its rectangles, so overlaps are not blurred twice. Large kernels are applied at half
+        resolution (see HALF_RES_BLUR_KERNEL). When there are so many rectangles that blurring
+        them separately would cost more than the page, the whole page is blurred once and
+        composited through the mask instead; rectangle edges then blend with their surroundings
+        rather than a mirrored border.
+
+        Args:
+            img: Input image in BGR format (numpy array), modified in place
+            rects: N×4 array of (x, y, w, h)
+            method: Covering method ('blur', 'mosaic', 'black', 'empty')
+        """
+        if method not in self.COVER_METHODS:
+            raise ValueError(f"Unsupported cover method: {method}")
+        boxes = self.clip_rects(rects, img.shape)
+        if method == 'empty' or len(boxes) == 0:
+            return
+        if method == 'black':
+            # Filled cv2.rectangle: same pixels as slice assignment, without numpy's broadcasting cost
+            color = self.bgr_color
+            for x0, y0, x1, y1 in boxes.tolist():
+                cv2.rectangle(img, (x0, y0), (x1 - 1, y1 - 1), color, -1)
+            return
+        if method == 'mosaic':
+            # Pixelating is cheap per rectangle, only clipping is shared
+            for x0, y0, x1, y1 in boxes.tolist():
+                self.mosaic(img, x0, y0, x1 - x0, y1 - y0)
+            return
+        h_img, w_img = img.shape[:2]
+        # Blurring a region also filters a kernel-wide border around it
+        k = self.blur_kernel[0]
+        cost = ((boxes[:, 2] - boxes[:, 0] + k) * (boxes[:, 3] - boxes[:, 1] + k)).sum()
+        if cost > PAGE_COVER_COST * h_img * w_img or len(boxes) > MAX_GROUPED_RECTS:
+            groups, regions = [boxes], [(0, 0, w_img, h_img)]
+        else:
+            labels = self.group_rects(boxes)
+            groups = [boxes[labels == label] for label in np.unique(labels)]
+            regions = [(*members[:, :2].min(axis=0).tolist(), *members[:, 2:].max(axis=0).tolist()) for members in groups]
+        for members, (x0, y0, x1, y1) in zip(groups, regions):
+            roi = img[y0:y1, x0:x1]
+            blurred = self._blur(roi)
+            if len(members) == 1:
+                roi[...] = blurred
+                continue
+            mask = np.zeros(roi.shape[:2], bool)
+            for bx0, by0, bx1, by1 in (members - [x0, y0, x0, y0]).tolist():
+                mask[by0:by1, bx0:bx1] = True
+            np.copyto(roi, blurred, where=mask[:, :, None])
+
+    def _blur(self, roi):
+        k = self.blur_kernel[0]
+        h, w = roi.shape[:2]
+        if k < HALF_RES_BLUR_KERNEL or min(h, w) < 4:
+            return cv2.GaussianBlur(roi, self.blur_kernel, 0)
+        small = cv2.resize(roi, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, ((k // 2) | 1, (k // 2) | 1), 0)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+    @staticmethod
+    def clip_rects(rects, img_shape):
+        """
+        Clip N×4 (x, y, w, h) rectangles to the image.
+
+        Returns:
+            N×4 int array of (x0, y0, x1, y1), without rectangles that are empty after clipping
+        """
+        rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        h_img, w_img = img_shape[:2]
+        boxes = np.empty_like(rects)
+        boxes[:, 0] = np.clip(rects[:, 0], 0, w_img)
+        boxes[:, 1] = np.clip(rects[:, 1], 0, h_img)
+        boxes[:, 2] = np.clip(rects[:, 0] + rects[:, 2], 0, w_img)
+        boxes[:, 3] = np.clip(rects[:, 1] + rects[:, 3], 0, h_img)
+        return boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+
+    @staticmethod
+    def group_rects(boxes, pad=0):
+        """
+        Group labels of (x0, y0, x1, y1) boxes: boxes that overlap or touch once grown by pad
+        share a label (connected components of the overlap graph).
+        """
+        grown = boxes + [-pad, -pad, pad, pad]
+        adjacent = ((grown[:, None, 0] <= grown[None, :, 2]) & (grown[None, :, 0] <= grown[:, None, 2]) &
+                    (grown[:, None, 1] <= grown[None, :, 3]) & (grown[None, :, 1] <= grown[:, None, 3]))
+        labels = np.arange(len(boxes))
+        while True:
+            merged = np.where(adjacent, labels[None, :], len(boxes)).min(axis=1)
+            merged = merged[merged]     # Follow labels to their own label, halving the iterations
+            if np.array_equal(merged, labels):
+                return labels
+            labels = merged
+
     def hex2rgb(self, hex_color):
         """
         Convert hex color to RGB tuple.
@@ -48,12 +156,21 @@ class ImageProcessor:
         hex_color = hex_color.lstrip('#')
         return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))
 
+    @property
+    def bgr_color(self):
+        """
+        The fill color in the channel order of the images (BGR). `color` stays RGB, as given by
+        the user, so it can be passed to fitz for born-digital pages.
+        """
+        r, g, b = (int(c) for c in self.color)
+        return b, g, r
+
     def set_color(self, hex_color):
         """
         Set the color for color covering.
         
         Args:
-            color: Hexadecimal color string (e.g., '#FF5733')
+            hex_color: Hexadecimal color string (e.g., '#FF5733'), RGB
         """
         if hex_color is None:
             return
@@ -121,7 +238,7 @@ class ImageProcessor:
         x, y, w, h = self.get_valid_coordinates(x, y, w, h, img.shape)
         if w <= 0 or h <= 0:
             return img
-        img[y:y + h, x:x + w] = self.color
+        img[y:y + h, x:x + w] = self.bgr_color
 
-    def empty(img, x, y, w, h):
+    def empty(self, img, x, y, w, h):
         pass
\ No newline at end of file
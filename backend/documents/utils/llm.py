@@ -1,63 +1,276 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+import asyncio
+import httpx
 import json
-import concurrent.futures
+import os
+import random
+import threading
 import time
+from .cache import DiskCache, make_key
+from .spans import Spans
+
+LLM_MODEL_NAME = "qwen-plus"
+LLM_BASE_URL = os.environ.get('FADE_LLM_BASE_URL', "https://dashscope.aliyuncs.com/compatible-mode/v1")
+LLM_API_KEY = os.environ.get('FADE_LLM_API_KEY', 'sk-4b70559344e3437ba82a4e4dddcb8cf4')
+# Limits per worker process, shared by all documents it processes
+LLM_CONCURRENCY = int(os.environ.get('FADE_LLM_CONCURRENCY', 8))   # Requests in flight
+LLM_RATE = float(os.environ.get('FADE_LLM_RATE', 10))               # Requests started per second
+LLM_MAX_RETRIES = int(os.environ.get('FADE_LLM_MAX_RETRIES', 4))     # Retries of one chunk
+LLM_TIMEOUT = float(os.environ.get('FADE_LLM_TIMEOUT', 60))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Parsed answers per chunk; FADE_LLM_CACHE=0 disables the cache
+LLM_CACHE = os.environ.get('FADE_LLM_CACHE', '1') == '1'
+LLM_CACHE_BYTES = 256 * 1024 ** 2
+LLM_CACHE_TTL = int(os.environ.get('FADE_LLM_CACHE_TTL', 30 * 24 * 3600))
+
+SYSTEM_PROMPT = "你是一个专业的文本分析助手，擅长从文本中提取敏感信息。"
+CATEGORIES = ['公司名', '地址', '姓名']
+ANSWER_KEYS = ['company', 'address', 'name']    # Keys of the JSON answer, in the order asked for
+PROMPT_TEMPLATE = (
+    "%(text)s\n\n将以上文字中涉及 %(categories)s 的敏感信息部分提取出来。"
+    "其中地址的部分忽略单独的城市名。"
+    '格式要严谨遵循{"company":[<text>], "address":[<text>], "name":[<text>]}'
+    '请不要添加任何其他内容。'
+)
+# Bump when the way answers are parsed changes, to invalidate cached chunk results
+PROMPT_VERSION = 1
+
+# Failures worth retrying: rate limits, server errors, timeouts and dropped connections
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+def find_phrase(chunk, phrase):
+    """
+    (start, end) offsets in chunk of the non-overlapping occurrences of phrase. The chunk is searched
+    without its '\n' line ends, so an entity wrapped onto the next OCR line is found; its span then
+    contains the line end, like the spans of locate_phrases.
+    """
+    phrase = phrase.replace('\n', '')
+    if not phrase:
+        return []
+    kept = [j for j, c in enumerate(chunk) if c != '\n']     # Chunk offset of each non-newline character
+    n_chunk = chunk.replace('\n', '')
+    spans = []
+    start = n_chunk.find(phrase)
+    while start >= 0:
+        spans.append((kept[start], kept[start + len(phrase) - 1] + 1))
+        start = n_chunk.find(phrase, start + len(phrase))
+    return spans
+
+class LLMError(Exception):
+    """A chunk could not be analysed after all retries."""
+
+class RateLimiter:
+    """
+    Concurrency limit plus token bucket for requests started per second.
+    A rate-limit response pauses the bucket, so all requests back off together
+    instead of each one hitting the limit again.
+    """
+    def __init__(self, concurrency, rate, burst=None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        try:
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    wait = self.paused_until - now
+                    if wait <= 0:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return
+                        wait = (1 - self.tokens) / self.rate
+                    await asyncio.sleep(wait)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self):
+        self.semaphore.release()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
 
 class LLM:
-    def __init__(self):
-        self.api_key = 'sk-4b70559344e3437ba82a4e4dddcb8cf4'
-    
-    def request(self, prompt):
-        client = OpenAI(
-            api_key=self.api_key,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        response = client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {"role": "system", "content": "你是一个专业的文本分析助手，擅长从文本中提取敏感信息。"},
-                {"role": "user", "content": prompt},
-            ],
+    """
+    OpenAI-compatible chat client shared by all documents of a worker process (see registry).
+    Requests run on a private event loop thread with one pooled HTTP client, so connections
+    are reused across chunks and documents, and every request goes through one RateLimiter.
+    """
+    def __init__(self, base_url=LLM_BASE_URL, api_key=LLM_API_KEY, concurrency=LLM_CONCURRENCY,
+                 rate=LLM_RATE, max_retries=LLM_MAX_RETRIES, cache=LLM_CACHE):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.cache = DiskCache('llm_chunks', LLM_CACHE_BYTES, ttl=LLM_CACHE_TTL) if cache else None
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failures': 0}
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='llm-client', daemon=True)
+        self._thread.start()
+        self.limiter = RateLimiter(concurrency, rate)
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,  # Retried per chunk below, through the limiter
+            timeout=LLM_TIMEOUT,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency,
+                                                              max_keepalive_connections=concurrency)),
         )
-        return response.choices[0].message.content
-    
-    def extract_sensitive(self, text):
+
+    def run(self, coro):
+        """Run a coroutine on the client's event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def request(self, prompt):
+        return self.run(self.arequest(prompt))
+
+    async def arequest(self, prompt):
+        for attempt in range(self.max_retries + 1):
+            async with self.limiter:
+                self.stats['requests'] += 1
+                try:
+                    response = await self.client.chat.completions.create(
+                        model=LLM_MODEL_NAME,
+                        messages=[
+                            {"role": "system", "content": SYSTEM_PROMPT},
+                            {"role": "user", "content": prompt},
+                        ],
+                    )
+                    return response.choices[0].message.content
+                except RETRYABLE_ERRORS as e:
+                    error = e
+            if attempt == self.max_retries:
+                break
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if isinstance(error, RateLimitError):
+                self.stats['rate_limited'] += 1
+                delay = _retry_after(error) or delay
+                self.limiter.pause(delay)
+            self.stats['retries'] += 1
+            print(f"[INFO] LLM request failed ({error.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        self.stats['failures'] += 1
+        raise LLMError(f"LLM request failed after {self.max_retries + 1} attempts: {error}") from error
+
+    def extract_sensitive(self, text, counters=None):
+        return self.extract_spans(text, counters).phrases(text)
+
+    def extract_spans(self, text, counters=None):
+        return self.run(self.aextract_spans(text, counters))
+
+    def chunk_key(self, chunk):
+        """Cache key of a chunk: its text and everything else that goes into the request."""
+        return make_key('llm_chunk', PROMPT_VERSION, chunk, CATEGORIES, PROMPT_TEMPLATE, SYSTEM_PROMPT,
+                        LLM_MODEL_NAME, self.base_url)
+
+    async def aextract_sensitive(self, text, counters=None):
+        return (await self.aextract_spans(text, counters)).phrases(text)
+
+    async def aextract_spans(self, text, counters=None):
+        """
+        Analyse the text in overlapping chunks, concurrently within the limiter.
+        The model answers with phrases; each is located within the chunk it was found in only,
+        so the spans (score 1) cover the detected occurrences and not every repeat of the phrase.
+        Chunks seen before (in this document or any earlier one) are answered from the cache.
+        Raises LLMError if any chunk still fails after its retries (or keeps getting answers that are not
+        JSON); the other chunks are then cancelled.
+        Args:
+            counters (dict): Optional dict receiving llm_chunks, llm_cache_hits and llm_cache_misses counts.
+        """
         start_time = time.time()
-        categories = ['公司名', '地址', '姓名']
         chunk_size = 100
         overlap = 30
         chunked_text = [
-            text[i:i + chunk_size] 
+            text[i:i + chunk_size]
             for i in range(0, len(text), chunk_size - overlap)
         ]
-        
-        result = {'company': [], 'address': [], 'name': []}
-        
-        def process_chunk(t):
-            prompt = (
-                f"{t}\n\n将以上文字中涉及 {' '.join(categories)} 的敏感信息部分提取出来。"
-                "其中地址的部分忽略单独的城市名。"
-                '格式要严谨遵循{"company":[<text>], "address":[<text>], "name":[<text>]}'
-                '请不要添加任何其他内容。'
-            )
-            response = self.request(prompt)
-            try:
-                response = '{' + response.split('{')[1].split('}')[0] + '}'
-            except Exception as e:
-                return {"company": [], "address": [], "name": []}
-            response = json.loads(response)
-
-            return response
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_chunk, t) for t in chunked_text]
-            for future in concurrent.futures.as_completed(futures):
-                data = future.result()
-                for k, v in data.items():
-                    v = [item for item in v if len(item) > 1]
-                    result[k].extend(v)
-        for k, v in result.items():
-            result[k] = set(v)
+        unique_chunks = list(dict.fromkeys(chunked_text))
+        hits = 0
+
+        async def process_chunk(t):
+            nonlocal hits
+            key = self.chunk_key(t) if self.cache is not None else None
+            if key is not None:
+                cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    hits += 1
+                    return cached
+            prompt = PROMPT_TEMPLATE % {'text': t, 'categories': ' '.join(CATEGORIES)}
+            for attempt in range(self.max_retries + 1):
+                # content is None for refusals and tool-call answers
+                response = await self.arequest(prompt) or ''
+                try:
+                    if '{' not in response:
+                        raise ValueError("no JSON object in the answer")
+                    data = json.loads('{' + response.split('{')[1].split('}')[0] + '}')
+                    break
+                except ValueError as e:
+                    # Malformed answers (json.JSONDecodeError is a ValueError) are asked again, like failed requests
+                    if attempt == self.max_retries:
+                        raise LLMError(f"Malformed LLM response: {e}") from e
+                    self.stats['retries'] += 1
+            if key is not None:
+                await asyncio.to_thread(self.cache.set, key, data)
+            return data
+
+        tasks = [asyncio.ensure_future(process_chunk(t)) for t in unique_chunks]
+        try:
+            answers = dict(zip(unique_chunks, await asyncio.gather(*tasks)))
+        except BaseException:
+            # gather does not cancel the other chunks when one fails: stop their requests and retries
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        found = []
+        for i, t in enumerate(chunked_text):
+            offset = i * (chunk_size - overlap)
+            for k, v in answers[t].items():
+                if k not in ANSWER_KEYS:
+                    continue
+                for item in v:
+                    if not isinstance(item, str) or len(item) <= 1:
+                        continue
+                    found.extend((offset + start, offset + end, k, 1.0) for start, end in find_phrase(t, item))
+        # Chunks overlap, so entities in the overlaps are found twice
+        result = Spans.from_tuples(found, ANSWER_KEYS).unique()
+        if counters is not None:
+            counters['llm_chunks'] = counters.get('llm_chunks', 0) + len(chunked_text)
+            counters['llm_cache_hits'] = counters.get('llm_cache_hits', 0) + hits + len(chunked_text) - len(unique_chunks)
+            counters['llm_cache_misses'] = counters.get('llm_cache_misses', 0) + len(unique_chunks) - hits
         end_time = time.time()
-        print(f"[INFO] LLM processing time: {end_time - start_time:.2f} seconds")
+        print(f"[INFO] LLM processing time: {end_time - start_time:.2f} seconds, "
+              f"{len(chunked_text) - len(unique_chunks) + hits}/{len(chunked_text)} chunks cached")
         return result
+
+    def cache_stats(self):
+        """Hit rate of the chunk cache in this process."""
+        return self.cache.stats() if self.cache is not None else None
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
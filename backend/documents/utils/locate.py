@@ -0,0 +1,185 @@
+import numpy as np
+from collections import deque
+from .spans import Spans
+
+class PhraseMatcher:
+    """
+    Aho–Corasick automaton: finds every occurrence of every phrase in one pass over the text,
+    instead of one regex scan of the whole text per phrase.
+    """
+    def __init__(self, phrases):
+        self.phrases = list(phrases)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [-1]     # Index of the phrase ending at this node, -1 if none
+        self.link = [0]     # Nearest node on the fail chain that ends a phrase (0: none)
+        for pid, phrase in enumerate(self.phrases):
+            node = 0
+            for ch in phrase:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(-1)
+                    self.link.append(0)
+                node = nxt
+            self.out[node] = pid
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[child] = f
+                self.link[child] = f if self.out[f] >= 0 else self.link[f]
+
+    def find_all(self, text):
+        """
+        Returns:
+            list: For each phrase, the sorted start positions of all its (possibly overlapping) occurrences.
+        """
+        starts = [[] for _ in self.phrases]
+        goto, fail, out, link = self.goto, self.fail, self.out, self.link
+        lengths = [len(p) for p in self.phrases]
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            n = node if out[node] >= 0 else link[node]
+            while n:
+                pid = out[n]
+                starts[pid].append(i - lengths[pid] + 1)
+                n = link[n]
+        return starts
+
+def non_overlapping(starts, length):
+    """Keep the occurrences re.finditer would return: scanning left to right, skip overlapping ones."""
+    kept = []
+    end = -1
+    for start in starts:
+        if start >= end:
+            kept.append(start)
+            end = start + length
+    return kept
+
+def merge_spans(locs):
+    """
+    Merge overlapping spans.
+    Args:
+        locs (list): (start, end) spans, already sorted by start.
+    Returns:
+        dict: {first span of each merged group: merged (start, end)}. Only the first span of a group
+              is kept, so a region covered by several sensitive phrases is masked once.
+    """
+    merged = {}
+    i = 0
+    while i < len(locs):
+        leader = locs[i]
+        start, end = leader
+        i += 1
+        while i < len(locs) and locs[i][0] < end:
+            end = max(end, locs[i][1])
+            i += 1
+        merged[leader] = (start, end)
+    return merged
+
+def locate_phrases(texts, boxes, sens_info):
+    """
+    Map sensitive phrases to bounding boxes, masking every occurrence of each phrase.
+    Args:
+        texts: Text entries, one character each ('\n' entries end a line).
+        boxes: [page, x0, y0, x1, y1] per text entry (OCRBoxes or list).
+        sens_info (dict): {category: phrases}.
+    Returns:
+        dict: {category: [[page, x, y, w, h], ...]}, see locate_spans.
+    """
+    sentence = texts if isinstance(texts, str) else "".join(texts)
+    # Phrases are searched for without newlines, so an occurrence may continue on the next line
+    is_nl = _newlines(texts)
+    box_index = np.flatnonzero(~is_nl)
+    n_sentence = sentence.replace('\n', '')
+    # One pass over the text for all phrases of all categories
+    unique = list(dict.fromkeys(p for phrases in sens_info.values() for p in phrases))
+    matcher = PhraseMatcher(unique)
+    occurrences = {p: non_overlapping(starts, len(p)) for p, starts in zip(unique, matcher.find_all(n_sentence))}
+    found = ((box_index[n_start], box_index[n_start + len(phrase) - 1] + 1, key, 1.0)
+             for key, phrases in sens_info.items() for phrase in phrases for n_start in occurrences[phrase])
+    return locate_spans(texts, boxes, Spans.from_tuples(found, list(sens_info)))
+
+def locate_spans(texts, boxes, spans):
+    """
+    Map detected spans to bounding boxes.
+    Args:
+        texts: Text entries, one character each ('\n' entries end a line).
+        boxes: [page, x0, y0, x1, y1] per text entry (OCRBoxes or list).
+        spans (Spans): Detections, offsets in "".join(texts).
+    Returns:
+        dict: {category: [[page, x, y, w, h], ...]} for every category of spans, one box per line of
+              every span. Overlapping spans are merged and reported once, under the category of the
+              first one.
+    """
+    pages, coords = _box_columns(boxes)
+    is_nl = _newlines(texts)
+    # 'n' starting means no '\n' version variables.
+    # box_index[i]: entry of the i-th non-newline character (prefix sum of newlines before it)
+    box_index = np.flatnonzero(~is_nl)
+    line_of = np.cumsum(is_nl)[box_index]
+    line_breaks = np.flatnonzero(np.diff(line_of)) + 1    # First character of each new line
+
+    # Offsets without the newlines before them
+    nl_before = np.concatenate(([0], np.cumsum(is_nl)))
+    n_starts = (spans.start - nl_before[spans.start]).tolist()
+    n_ends = (spans.end - nl_before[spans.end]).tolist()
+    categories = spans.category.tolist()
+
+    # 处理敏感信息坐标重叠的问题
+    locs = sorted(zip(n_starts, n_ends), key=lambda x: x[0])  # Sort by start index (stable, ties keep detection order)
+    merged = merge_spans(locs)
+
+    seg_start = [[] for _ in spans.categories]
+    seg_end = [[] for _ in spans.categories]
+    for n_start, n_end, category in zip(n_starts, n_ends, categories):
+        span = merged.get((n_start, n_end))
+        if span is None:
+            continue    # 若此点未被"选中"，则跳过
+        n_start, n_end = span
+        # Split the span into one segment per line
+        lo = np.searchsorted(line_breaks, n_start, side='right')
+        hi = np.searchsorted(line_breaks, n_end - 1, side='right')
+        for brk in line_breaks[lo:hi].tolist():
+            seg_start[category].append(n_start)
+            seg_end[category].append(brk - 1)
+            n_start = brk
+        seg_start[category].append(n_start)
+        seg_end[category].append(n_end - 1)
+    return {key: _segment_boxes(pages, coords, box_index[seg_start[i]], box_index[seg_end[i]])
+            for i, key in enumerate(spans.categories)}
+
+def _newlines(texts):
+    """Boolean array marking the '\n' entries of texts."""
+    if isinstance(texts, str):
+        return np.frombuffer(texts.encode('utf-32-le'), dtype=np.uint32) == ord('\n')
+    return np.fromiter((t == '\n' for t in texts), dtype=bool, count=len(texts))
+
+def _segment_boxes(pages, coords, first, last):
+    """Boxes spanning from entry `first` to entry `last`, vectorised over all segments."""
+    if len(first) == 0:
+        return []
+    x0, y0 = coords[first, 0], coords[first, 1]
+    w = coords[last, 2] - x0
+    h = coords[last, 3] - y0
+    page = pages[first].tolist()
+    return [[p, a, b, c, d] for p, a, b, c, d in zip(page, x0.tolist(), y0.tolist(), w.tolist(), h.tolist())]
+
+def _box_columns(boxes):
+    """Split boxes into a page index array and an (N, 4) coordinate array."""
+    if hasattr(boxes, 'pages') and hasattr(boxes, 'coords'):
+        return np.asarray(boxes.pages), np.asarray(boxes.coords, dtype=np.float64)
+    arr = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+    return arr[:, 0].astype(np.int64), arr[:, 1:]
@@ -1,18 +1,27 @@
 import torch
 from transformers import pipeline 
-from collections import defaultdict
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import time
+from .spans import Spans
+
+NER_MODEL_NAME = "gyr66/Ernie-3.0-base-chinese-finetuned-ner"
+NER_BATCH_SIZE = 16     # Number of chunks per forward pass
+ENTITY_CATEGORIES = ['name', 'company', 'address']
+
+def resolve_device(gpu):
+    """Map the gpu flag to the device actually used, so CPU fallbacks share one cached model."""
+    return "cuda:0" if torch.cuda.is_available() and gpu else "cpu"
 
 class NERModel:
-    def __init__(self, gpu):
-        device = 0 if torch.cuda.is_available() and gpu else -1
-        self.ner = pipeline("token-classification", model="gyr66/Ernie-3.0-base-chinese-finetuned-ner", device=device)
+    def __init__(self, device="cpu"):
+        self.device = device
+        self.ner = pipeline("token-classification", model=NER_MODEL_NAME, device=0 if device.startswith("cuda") else -1)
         # Sensitive entities to extract
         self.sensitive_entities = ["B-name", "I-name", "B-company", "I-company", "B-address", "I-address"]
+        self.chunk_overlap = 64
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=512,
-            chunk_overlap=64,
+            chunk_overlap=self.chunk_overlap,
             separators=["\n", "。", "，", " ", ""]
         )
     
@@ -24,47 +33,108 @@ class NERModel:
         Returns:
             dict: A dictionary with entity labels as keys and lists of corresponding phrases as values.
         """
+        return self.extract_spans(text).phrases(text)
+
+    def extract_spans(self, text):
+        """
+        Returns:
+            Spans: Entities with their offsets in the text and mean token score.
+        """
+        return self.extract_spans_batch([text])[0]
+
+    def extract_sensitive_batch(self, texts, batch_size=NER_BATCH_SIZE):
+        """Phrase version of extract_spans_batch: one {entity: set(phrases)} dict per input text."""
+        return [spans.phrases(text) for spans, text in zip(self.extract_spans_batch(texts, batch_size), texts)]
+
+    def extract_spans_batch(self, texts, batch_size=NER_BATCH_SIZE):
+        """
+        Batched version of extract_spans for one or several documents.
+        All chunks of all texts are sorted by length so that each pipeline batch holds
+        chunks of similar size (less padding), then results are mapped back per text.
+        Args:
+            texts (list[str]): Texts to analyze, e.g. the OCR text of several queued documents.
+            batch_size (int): Number of chunks fed to the transformer at once.
+        Returns:
+            list[Spans]: One Spans per input text, in input order, offsets in that text.
+        """
         start_time = time.time()
-        chunks = self.text_splitter.split_text(text)
-        sensitive_info = defaultdict(set)
-        for chunk in chunks:
-            doc = self.ner(chunk)
-            phrase = ""
-            entity = ""
-            
-            single_score_threshold = 0.7
-            confidence_threshold = 0.9
-            total_score = 0
-            count = 0
-            for ent in doc:
-                if ent['score'] < single_score_threshold:
-                    continue
-                total_score += ent['score']
-                count += 1
-                if ent["entity"] in self.sensitive_entities:
-                    if ent["entity"].startswith("B-") or entity == "":
-                        if len(phrase) > 1 and total_score/count > confidence_threshold:
-                            total_score = 0
-                            count = 0
-                            sensitive_info[entity].add(phrase)
-                        entity = ent["entity"][2:]
-                        phrase = ent["word"]
-                    elif ent["entity"][2:] == entity:   # If the entity is a continuation of the previous phrase, append it
-                        phrase += ent["word"]
-                    else:   # If new sensitive entity comes, and no "B-" found, then view it as "B-" labeled
-                        if len(phrase) > 1 and total_score/count > confidence_threshold:
-                            total_score = 0
-                            count = 0
-                            sensitive_info[entity].add(phrase)
-                        entity = ent["entity"][2:]
-                        phrase = ent["word"]
-                else:
-                    if len(phrase) > 1 and total_score/count > confidence_threshold:
-                        sensitive_info[entity].add(phrase)
-                        phrase = ""
-                        entity = ""
-            if len(phrase) > 1 and total_score/count > confidence_threshold:
-                sensitive_info[entity].add(phrase)
+        chunks = []     # (text index, offset of the chunk in the text, chunk)
+        for i, text in enumerate(texts):
+            chunks.extend((i, offset, chunk) for offset, chunk in self.split(text))
+        # Length bucketing: neighbouring chunks in a batch have similar lengths
+        order = sorted(range(len(chunks)), key=lambda k: len(chunks[k][2]))
+        docs = self.ner([chunks[k][2] for k in order], batch_size=batch_size) if chunks else []
+        found = [[] for _ in texts]
+        for k, doc in zip(order, docs):
+            i, offset, _ = chunks[k]
+            found[i].extend((start + offset, end + offset, entity, score)
+                            for start, end, entity, score in self._collect_entities(doc))
+        # Chunks overlap, so entities in the overlaps are found twice
+        results = [Spans.from_tuples(spans, ENTITY_CATEGORIES).unique() for spans in found]
         end_time = time.time()
-        print(f"[INFO] NER processing time: {end_time - start_time:.2f} seconds")
-        return sensitive_info
\ No newline at end of file
+        print(f"[INFO] NER processing time: {end_time - start_time:.2f} seconds "
+              f"({len(chunks)} chunks, {len(texts)} texts, batch_size={batch_size})")
+        return results
+
+    def split(self, text):
+        """
+        Yields:
+            (offset, chunk): Chunks of the text splitter with their offset in the text.
+        """
+        # The splitter returns substrings in order, overlapping by at most chunk_overlap characters
+        search_from = 0
+        for chunk in self.text_splitter.split_text(text):
+            offset = text.find(chunk, search_from)
+            if offset < 0:
+                offset = text.find(chunk)
+            yield offset, chunk
+            search_from = max(offset + 1, offset + len(chunk) - self.chunk_overlap)
+
+    def _collect_entities(self, doc):
+        """
+        Merge the token-level pipeline output of one chunk into phrases.
+        Returns:
+            list: (start, end, entity, mean score) per phrase, offsets in the chunk.
+        """
+        found = []
+        phrase = ""
+        entity = ""
+        start = end = 0
+
+        single_score_threshold = 0.7
+        confidence_threshold = 0.9
+        total_score = 0
+        count = 0
+        for ent in doc:
+            if ent['score'] < single_score_threshold:
+                continue
+            total_score += ent['score']
+            count += 1
+            if ent["entity"] in self.sensitive_entities:
+                if ent["entity"].startswith("B-") or entity == "":
+                    if len(phrase) > 1 and total_score/count > confidence_threshold:
+                        found.append((start, end, entity, total_score/count))
+                        total_score = 0
+                        count = 0
+                    entity = ent["entity"][2:]
+                    phrase = ent["word"]
+                    start, end = ent["start"], ent["end"]
+                elif ent["entity"][2:] == entity:   # If the entity is a continuation of the previous phrase, append it
+                    phrase += ent["word"]
+                    end = ent["end"]
+                else:   # If new sensitive entity comes, and no "B-" found, then view it as "B-" labeled
+                    if len(phrase) > 1 and total_score/count > confidence_threshold:
+                        found.append((start, end, entity, total_score/count))
+                        total_score = 0
+                        count = 0
+                    entity = ent["entity"][2:]
+                    phrase = ent["word"]
+                    start, end = ent["start"], ent["end"]
+            else:
+                if len(phrase) > 1 and total_score/count > confidence_threshold:
+                    found.append((start, end, entity, total_score/count))
+                    phrase = ""
+                    entity = ""
+        if len(phrase) > 1 and total_score/count > confidence_threshold:
+            found.append((start, end, entity, total_score/count))
+        return found
@@ -1,15 +1,229 @@
+import io
+import os
+from abc import ABC, abstractmethod
+import queue
+import random
+import threading
+import time
+import numpy as np
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from multiprocessing import shared_memory
+from .ocrstore import save_ocr_result
+from .render import iter_pages, OCR_DPI
 
-class OCRProcessor:
-    def __init__(self):
-        self.base_url = "http://127.0.0.1:30000/ocr"
+OCR_CLIENT_WINDOW = 4   # Pages in flight per document, so the server can OCR them in parallel
+OCR_SERVER_URL = os.environ.get('FADE_OCR_SERVER_URL', "http://127.0.0.1:30000")
+# Where the worker sends pages to OCR (see OCR_BACKENDS):
+#   http   pages are posted to ocr_server.py as .npy bodies (default)
+#   shm    pages are handed to ocr_server.py on the same host through shared memory, only the name is posted
+#   local  pages are OCR'd in the worker process by a pool of RapidOCR engines, no server needed
+OCR_BACKEND = os.environ.get('FADE_OCR_BACKEND', 'http')
+# A full server pool answers 503: the page is sent again after a backoff, this many times
+OCR_BUSY_RETRIES = int(os.environ.get('FADE_OCR_BUSY_RETRIES', 6))
+OCR_BUSY_BACKOFF = 2.0      # Seconds before the first retry, doubled each time
+OCR_BUSY_BACKOFF_MAX = 60.0
+# Engines of the local backend on CPU; a GPU has a single engine
+OCR_LOCAL_WORKERS = int(os.environ.get('FADE_OCR_LOCAL_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+
+class BaseOCRProcessor(ABC):
+    """
+    Common interface of the OCR backends. Subclasses implement ocr_image; whole documents are
+    rendered here and their pages OCR'd with up to `window` pages in flight.
+    """
+    window = OCR_CLIENT_WINDOW
 
     def process_pdf(self, pdf_path, output_dir, gpu=True):
-        response = requests.post(
-            self.base_url,
+        ''' Render the PDF at OCR_DPI, OCR it and save the results (see ocrstore).'''
+        self.process_images(iter_pages(pdf_path, OCR_DPI), output_dir, gpu, OCR_DPI)
+
+    def process_images(self, imgs, output_dir, gpu=True, dpi=OCR_DPI):
+        ''' OCR already rendered (page_index, image) pairs, up to `window` pages at a time (see ocr_images),
+        and save the results, so the PDF is not rasterised a second time.'''
+        all_boxes, all_txts = [], []
+        for i, (boxes, txts) in self.ocr_images(imgs, gpu, dpi):
+            all_boxes.extend(boxes)
+            all_txts.extend(txts)
+        save_ocr_result(output_dir, all_boxes, all_txts, dpi)
+
+    def ocr_images(self, imgs, gpu=True, dpi=OCR_DPI, window=None):
+        ''' OCR (page_index, image) pairs with up to `window` pages in flight.
+        Yields (page_index, (boxes, txts)) in input order; at most `window` pages are held in memory.'''
+        window = window or self.window
+        with ThreadPoolExecutor(window) as executor:
+            pending = deque()
+            for i, img in imgs:
+                if len(pending) >= window:
+                    j, future = pending.popleft()
+                    yield j, future.result()
+                pending.append((i, executor.submit(self.ocr_image, img, i, gpu, dpi)))
+            while pending:
+                j, future = pending.popleft()
+                yield j, future.result()
+
+    @abstractmethod
+    def ocr_image(self, img, page_index, gpu=True, dpi=OCR_DPI):
+        ''' OCR a single page. Returns per-character boxes [page, x0, y0, x1, y1] and texts, one '\\n' per line.'''
+
+class OCRProcessor(BaseOCRProcessor):
+    """OCR on ocr_server.py over HTTP."""
+    def __init__(self, base_url=OCR_SERVER_URL, cache=True):
+        self.base_url = base_url
+        self.cache = cache  # Whether the server may answer from its page cache
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """Keep-alive session reused across pages, one per thread: requests.Session is not thread-safe."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def post(self, path, **kwargs):
+        """
+        POST to the server, retrying with exponential backoff (and jitter) while it answers 503
+        because its engine pool is full. Other errors are raised at once.
+        """
+        for attempt in range(OCR_BUSY_RETRIES + 1):
+            response = self.session.post(f"{self.base_url}{path}", **kwargs)
+            if response.status_code != 503 or attempt == OCR_BUSY_RETRIES:
+                break
+            try:
+                delay = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                delay = min(OCR_BUSY_BACKOFF_MAX, OCR_BUSY_BACKOFF * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+        response.raise_for_status()
+        return response
+
+    def process_pdf(self, pdf_path, output_dir, gpu=True):
+        ''' Let the server render and OCR the PDF and write the results to output_dir.'''
+        response = self.post(
+            "/ocr",
             json={"pdf_path": pdf_path, "output_dir": output_dir, "gpu": gpu},
             headers={"Content-Type": "application/json"}
         )
-        response.raise_for_status()
         return response.json()
 
+    def ocr_image(self, img, page_index, gpu=True, dpi=OCR_DPI):
+        ''' OCR a single page on the server. Returns per-character boxes and texts, like ROCRProcessor.ocr_image.'''
+        buffer = io.BytesIO()
+        np.save(buffer, img)
+        response = self.post(
+            "/ocr_page",
+            params={"page": page_index, "gpu": gpu, "dpi": dpi, "cache": self.cache},
+            data=buffer.getvalue(),
+            headers={"Content-Type": "application/octet-stream"}
+        )
+        data = response.json()
+        return data["boxes"], data["txts"]
+
+class SharedMemoryOCRProcessor(OCRProcessor):
+    """
+    OCR on ocr_server.py running on the same host. Each page raster is copied into a shared memory
+    block and only its name, shape and dtype are posted, instead of encoding the page as .npy and
+    sending it through the socket. The block is unlinked once the server has answered.
+    """
+    def ocr_image(self, img, page_index, gpu=True, dpi=OCR_DPI):
+        img = np.ascontiguousarray(img)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        try:
+            np.ndarray(img.shape, img.dtype, buffer=shm.buf)[...] = img
+            response = self.post(
+                "/ocr_shm",
+                params={"page": page_index, "gpu": gpu, "dpi": dpi, "cache": self.cache},
+                json={"name": shm.name, "shape": list(img.shape), "dtype": str(img.dtype)},
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+        data = response.json()
+        return data["boxes"], data["txts"]
+
+class LocalEnginePool:
+    """
+    RapidOCR engines shared by the threads of a process. Engines are built on first use, up to
+    `workers`, and each page borrows one for the time of its OCR.
+    """
+    def __init__(self, gpu, workers):
+        from . import rocr  # Only the local backend needs rapidocr_paddle
+        self.gpu = gpu
+        self.workers = workers
+        self.engines = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.factory = lambda: rocr.ROCRProcessor(gpu=gpu, cache=False)
+
+    def ocr_image(self, img, page_index, dpi=OCR_DPI):
+        engine = self._borrow()
+        try:
+            return engine.ocr_image(img, page_index, dpi)
+        finally:
+            self.engines.put(engine)
+
+    def _borrow(self):
+        try:
+            return self.engines.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.workers:
+                self.created += 1
+                build = True
+            else:
+                build = False
+        if not build:
+            return self.engines.get()
+        try:
+            return self.factory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+class LocalOCRProcessor(BaseOCRProcessor):
+    """
+    OCR in the worker process: no server, no disk/JSON/HTTP round-trip per document. Pages go to a
+    pool of engines per device (one on GPU), consulting the page cache first like the server does.
+    """
+    def __init__(self, workers=OCR_LOCAL_WORKERS, cache=True):
+        from . import rocr
+        self.rocr = rocr
+        self.workers = workers
+        self.cache = rocr.page_cache() if cache else None
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.window = max(OCR_CLIENT_WINDOW, workers)
+
+    def pool(self, gpu):
+        with self.lock:
+            if gpu not in self.pools:
+                self.pools[gpu] = LocalEnginePool(gpu, 1 if gpu else self.workers)
+            return self.pools[gpu]
+
+    def ocr_image(self, img, page_index, gpu=True, dpi=OCR_DPI):
+        pool = self.pool(gpu)
+        if self.cache is None:
+            return pool.ocr_image(img, page_index, dpi)
+        key = self.rocr.page_cache_key(img, dpi, self.rocr.engine_config(gpu))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self.rocr.from_cache_entry(cached, page_index)
+        boxes, txts = pool.ocr_image(img, page_index, dpi)
+        self.cache.set(key, self.rocr.to_cache_entry(boxes, txts))
+        return boxes, txts
+
+OCR_BACKENDS = {
+    'http': OCRProcessor,
+    'shm': SharedMemoryOCRProcessor,
+    'local': LocalOCRProcessor,
+}
+
+def make_ocr_processor(backend=None, **kwargs):
+    """OCR processor of the given backend name (default: FADE_OCR_BACKEND)."""
+    backend = backend or OCR_BACKEND
+    if backend not in OCR_BACKENDS:
+        raise ValueError(f"Unknown OCR backend {backend}, expected one of {', '.join(OCR_BACKENDS)}")
+    return OCR_BACKENDS[backend](**kwargs)
@@ -0,0 +1,127 @@
+"""
+Columnar on-disk format for OCR results, replacing the single ocr_result.json.
+
+An OCR result is a directory holding:
+    pages.npy    int32   (N,)     page index of each text entry
+    boxes.npy    float32 (N, 4)   x0, y0, x1, y1 of each text entry
+    offsets.npy  int64   (N + 1,) byte offsets of each entry in text.bin
+    text.bin     UTF-8 concatenation of all entries
+    meta.json    dpi, vector_pages; marks the result as complete
+The arrays are memory-mapped when read. A result is written into a temporary sibling directory
+and renamed into place, so readers (and concurrent runs sharing the directory) never see a mix
+of old and new files.
+"""
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+FORMAT_VERSION = 1
+
+def save_ocr_result(ocr_path, boxes, txts, dpi, vector_pages=()):
+    """
+    Save text and per-character boxes of a document.
+    Args:
+        boxes (list): [page, x0, y0, x1, y1] per text entry.
+        txts (list): Text of each entry ('\n' entries end a line).
+        vector_pages: Pages whose text came from the PDF text layer instead of OCR.
+    """
+    ocr_path = os.path.normpath(ocr_path)
+    tmp_path = f'{ocr_path}.tmp-{uuid.uuid4().hex}'
+    os.makedirs(tmp_path)
+    try:
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+        encoded = [t.encode('utf-8') for t in txts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in encoded], out=offsets[1:])
+        np.save(os.path.join(tmp_path, 'pages.npy'), boxes[:, 0].astype(np.int32))
+        np.save(os.path.join(tmp_path, 'boxes.npy'), boxes[:, 1:].astype(np.float32))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_path, 'text.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': FORMAT_VERSION,
+                'dpi': dpi,
+                'vector_pages': list(vector_pages),
+                'single_char': all(len(t) == 1 for t in txts),
+            }, f)
+        _replace_dir(tmp_path, ocr_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+def _replace_dir(src, dst):
+    """
+    Rename directory src to dst, replacing an existing dst. The old directory is moved aside
+    and removed; arrays already memory-mapped from it stay readable. With concurrent writers
+    the last rename wins, each result being complete.
+    """
+    while True:
+        try:
+            os.rename(src, dst)
+            return
+        except OSError:
+            if not os.path.isdir(dst):
+                raise
+        old = f'{dst}.old-{uuid.uuid4().hex}'
+        try:
+            os.rename(dst, old)
+        except FileNotFoundError:
+            continue    # Moved aside by a concurrent writer
+        shutil.rmtree(old, ignore_errors=True)
+
+def ocr_result_exists(ocr_path):
+    return os.path.exists(os.path.join(ocr_path, 'meta.json'))
+
+class OCRBoxes:
+    """Read-only view giving [page, x0, y0, x1, y1] rows over the memory-mapped columns."""
+    def __init__(self, pages, coords):
+        self.pages = pages
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, i):
+        x0, y0, x1, y1 = self.coords[i].tolist()
+        return [int(self.pages[i]), x0, y0, x1, y1]
+
+class OCRResult:
+    def __init__(self, ocr_path):
+        with open(os.path.join(ocr_path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dpi = meta['dpi']
+        self.vector_pages = set(meta.get('vector_pages', []))
+        self.single_char = meta.get('single_char', False)
+        pages = np.load(os.path.join(ocr_path, 'pages.npy'), mmap_mode='r')
+        coords = np.load(os.path.join(ocr_path, 'boxes.npy'), mmap_mode='r')
+        self.boxes = OCRBoxes(pages, coords)
+        self.offsets = np.load(os.path.join(ocr_path, 'offsets.npy'), mmap_mode='r')
+        with open(os.path.join(ocr_path, 'text.bin'), 'rb') as f:
+            self.text = f.read().decode('utf-8')
+
+    @property
+    def texts(self):
+        """
+        Text entries. When every entry is a single character (the usual OCR and text layer output)
+        the decoded text itself is returned, which indexes and iterates like the list of entries.
+        """
+        if self.single_char:
+            return self.text
+        blob = self.text.encode('utf-8')
+        offsets = self.offsets.tolist()
+        return [blob[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])]
+
+def load_ocr_result(ocr_path):
+    return OCRResult(ocr_path)
+
+def convert_json(json_path, ocr_path, remove=False):
+    """Convert a legacy ocr_result.json into the columnar format."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Results written before the dpi was recorded are 150 dpi
+    save_ocr_result(ocr_path, data['boxes'], data['txts'], data.get('dpi', 150), data.get('vector_pages', []))
+    if remove:
+        os.remove(json_path)
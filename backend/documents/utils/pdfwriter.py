@@ -0,0 +1,115 @@
+import struct
+
+class PDFStreamWriter:
+    """
+    Minimal PDF writer that appends one full-page image at a time to an open file.
+    Every page is written to disk as soon as it is added, so memory use does not
+    grow with the number of pages (unlike img2pdf, which builds the whole PDF in memory).
+
+    PNG data is embedded without re-encoding: the IDAT stream is already a
+    FlateDecode stream with PNG predictors.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3    # 1: catalog, 2: page tree
+        self.f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def add_png(self, png, dpi):
+        """
+        Append a page showing a PNG image.
+        Args:
+            png (bytes): 8-bit, non-interlaced grayscale or RGB PNG (as written by cv2.imencode).
+            dpi (int): Resolution of the image, determines the page size.
+        """
+        data, width, height, color_space, bits, filter, params = self.png_image(png)
+        self.add_image(data, width, height, dpi, color_space, bits, filter, params)
+
+    def add_encoded(self, encoded, dpi):
+        """Append a page showing an EncodedImage (see utils.encode)."""
+        self.add_image(encoded.data, encoded.width, encoded.height, dpi, encoded.color_space,
+                       encoded.bits, encoded.filter, encoded.params)
+
+    @classmethod
+    def png_image(cls, png):
+        """Image stream fields (data, width, height, color space, bits, filter, params) of a PNG, without re-encoding."""
+        width, height, bit_depth, color_type, idat = cls._parse_png(png)
+        colors = {0: 1, 2: 3}.get(color_type)
+        if colors is None:
+            raise ValueError(f"Unsupported PNG color type: {color_type}")
+        color_space = b"/DeviceGray" if colors == 1 else b"/DeviceRGB"
+        params = b"<< /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >>" % (colors, bit_depth, width)
+        return idat, width, height, color_space, bit_depth, b"/FlateDecode", params
+
+    def add_image(self, data, width, height, dpi, color_space=b"/DeviceRGB", bits=8, filter=b"/FlateDecode", params=None):
+        """Append a page showing an already encoded image stream."""
+        image_id = self._new_id()
+        header = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d /Filter %s" % (
+            width, height, color_space, bits, filter)
+        if params:
+            header += b" /DecodeParms " + params
+        self._write_stream(image_id, header, data)
+
+        page_w, page_h = width * 72 / dpi, height * 72 / dpi
+        content_id = self._new_id()
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (page_w, page_h)
+        self._write_stream(content_id, b"<<", content)
+
+        page_id = self._new_id()
+        self._begin(page_id)
+        self.f.write(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] "
+                     b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>\nendobj\n" % (
+                         page_w, page_h, image_id, content_id))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        """Write the page tree, catalog, cross-reference table and trailer."""
+        self._begin(2)
+        kids = b" ".join(b"%d 0 R" % i for i in self.page_ids)
+        self.f.write(b"<< /Type /Pages /Kids [%s] /Count %d >>\nendobj\n" % (kids, len(self.page_ids)))
+        self._begin(1)
+        self.f.write(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+
+        xref = self.f.tell()
+        size = self.next_id
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for i in range(1, size):
+            self.f.write(b"%010d 00000 n \n" % self.offsets[i])
+        self.f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref))
+
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _begin(self, obj_id):
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % obj_id)
+
+    def _write_stream(self, obj_id, header, data):
+        self._begin(obj_id)
+        self.f.write(header + b" /Length %d >>\nstream\n" % len(data))
+        self.f.write(data)
+        self.f.write(b"\nendstream\nendobj\n")
+
+    @staticmethod
+    def _parse_png(png):
+        if png[:8] != b"\x89PNG\r\n\x1a\n":
+            raise ValueError("Not a PNG image")
+        pos = 8
+        idat = []
+        width = height = bit_depth = color_type = None
+        while pos < len(png):
+            length, chunk_type = struct.unpack(">I4s", png[pos:pos + 8])
+            chunk = png[pos + 8:pos + 8 + length]
+            if chunk_type == b"IHDR":
+                width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunk)
+                if interlace:
+                    raise ValueError("Interlaced PNG is not supported")
+            elif chunk_type == b"IDAT":
+                idat.append(chunk)
+            elif chunk_type == b"IEND":
+                break
+            pos += 12 + length
+        return width, height, bit_depth, color_type, b"".join(idat)
@@ -0,0 +1,110 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ModelRegistry:
+    """
+    进程级模型注册表：同一个 worker 进程内按 (模型名, 设备) 只加载一次模型，
+    Detector 等调用方从这里借用实例，而不是每个任务重新构建。
+    """
+    def __init__(self):
+        self._models = {}
+        self._loaders = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        """
+        Register a loader for a model name.
+        Args:
+            name (str): Model name, e.g. 'ner', 'llm', 'ocr'.
+            loader (callable): loader(device) -> model instance.
+        """
+        self._loaders[name] = loader
+
+    def get(self, name, device='cpu'):
+        """Return the cached model for (name, device), loading it on first use."""
+        key = (name, device)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                if name not in self._loaders:
+                    raise KeyError(f"No loader registered for model {name}")
+                start_time = time.time()
+                model = self._loaders[name](device)
+                elapsed = time.time() - start_time
+                self._models[key] = model
+                self._stat(key)['load_time'] += elapsed
+                self._stat(key)['loads'] += 1
+                print(f"[INFO] Loaded model {name} on {device} in {elapsed:.2f} seconds")
+        return model
+
+    def warmup(self, models):
+        """
+        Load a list of (name, device) pairs ahead of the first task.
+        Failures are reported but do not stop the worker from starting.
+        """
+        for name, device in models:
+            try:
+                self.get(name, device)
+            except Exception as e:
+                print(f"[ERROR] Warm-up of model {name} on {device} failed: {e}")
+
+    def evict(self, name=None, device=None):
+        """Drop cached models matching name/device (None matches everything)."""
+        with self._lock:
+            for key in list(self._models):
+                if (name is None or key[0] == name) and (device is None or key[1] == device):
+                    del self._models[key]
+                    print(f"[INFO] Evicted model {key[0]} on {key[1]}")
+
+    def loaded(self):
+        return list(self._models.keys())
+
+    @contextmanager
+    def timed(self, name, device='cpu'):
+        """Context manager recording inference time against (name, device)."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            stat = self._stat((name, device))
+            stat['inference_time'] += time.time() - start_time
+            stat['inference_calls'] += 1
+
+    def _stat(self, key):
+        if key not in self._stats:
+            self._stats[key] = {'loads': 0, 'load_time': 0.0, 'inference_calls': 0, 'inference_time': 0.0}
+        return self._stats[key]
+
+    def stats(self):
+        """Load time vs. inference time per model, keyed by 'name@device'."""
+        return {
+            f"{name}@{device}": dict(stat, loaded=(name, device) in self._models)
+            for (name, device), stat in self._stats.items()
+        }
+
+
+def _load_ner(device):
+    from .ner import NERModel
+    return NERModel(device)
+
+
+def _load_llm(device):
+    from .llm import LLM
+    return LLM()
+
+
+def _load_ocr(device):
+    from .ocr import make_ocr_processor
+    return make_ocr_processor()
+
+
+registry = ModelRegistry()
+registry.register('ner', _load_ner)
+registry.register('llm', _load_llm)
+registry.register('ocr', _load_ocr)
@@ -0,0 +1,94 @@
+from pdf2image import convert_from_path, pdfinfo_from_path
+import cv2
+import numpy as np
+import os
+import shutil
+import tempfile
+
+# Rasterisation resolutions. Pages are rendered once at RENDER_DPI for masking,
+# OCR runs on a downsampled view at OCR_DPI. Box coordinates are converted with
+# the ratio of the two instead of a hard-coded zoom factor.
+RENDER_DPI = 300
+OCR_DPI = 150
+RENDER_BATCH = 4    # Pages rendered per pdftocairo call when streaming
+
+def iter_pages(pdf_path, dpi=RENDER_DPI, page_indices=None):
+    """
+    Rasterise a PDF page by page, holding at most RENDER_BATCH pages in memory.
+    Args:
+        page_indices (list): 0-based pages to render, in increasing order (default: all pages).
+    Yields:
+        (page_index, img): img is a BGR numpy array.
+    """
+    if page_indices is None:
+        page_indices = range(page_count(pdf_path))
+    for run in _batches(page_indices):
+        # pdf2image page numbers are 1-based and inclusive
+        imgs = convert_from_path(pdf_path, dpi=dpi, fmt="png", first_page=run[0] + 1, last_page=run[-1] + 1,
+                                 thread_count=len(run), use_pdftocairo=True)
+        for page_index, image in zip(run, imgs):
+            yield page_index, cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+
+def _batches(page_indices):
+    """Split page indices into runs of consecutive pages, at most RENDER_BATCH long."""
+    run = []
+    for i in page_indices:
+        if run and (i != run[-1] + 1 or len(run) == RENDER_BATCH):
+            yield run
+            run = []
+        run.append(i)
+    if run:
+        yield run
+
+def page_count(pdf_path):
+    return pdfinfo_from_path(pdf_path)["Pages"]
+
+def downsample(img, src_dpi, dst_dpi):
+    """Cheap view of a page raster at a lower resolution (e.g. the OCR view of a masking raster)."""
+    if src_dpi == dst_dpi:
+        return img
+    scale = dst_dpi / src_dpi
+    return cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+class PageSpool:
+    """
+    Disk spool for rendered pages, so a page rendered for OCR can be masked later
+    without rendering it again or keeping the whole document in memory.
+    Pages are stored as fast (low compression) lossless PNGs.
+    """
+    def __init__(self, root_path, path=None):
+        """
+        Args:
+            path (str): Fixed spool directory, e.g. one shared by the tasks of a pipeline. Pages already
+                        in it are kept. By default a new temporary directory under root_path is used.
+        """
+        if path is None:
+            self.dir = tempfile.mkdtemp(prefix='.pages_', dir=root_path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.dir = path
+        self.indices = sorted(int(name[:-4]) for name in os.listdir(self.dir) if name.endswith('.png'))
+
+    def tee(self, pages):
+        """Pass (page_index, img) pairs through unchanged while writing each page to the spool."""
+        for page_index, img in pages:
+            cv2.imwrite(self._path(page_index), img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            if page_index not in self.indices:
+                self.indices.append(page_index)
+            yield page_index, img
+
+    def pages(self):
+        for page_index in self.indices:
+            yield page_index, self.read(page_index)
+
+    def read(self, page_index):
+        return cv2.imread(self._path(page_index), cv2.IMREAD_COLOR)
+
+    def __contains__(self, page_index):
+        return os.path.exists(self._path(page_index))
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _path(self, i):
+        return os.path.join(self.dir, f'{i:05d}.png')
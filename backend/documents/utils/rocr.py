@@ -1,36 +1,97 @@
 from rapidocr_paddle import RapidOCR
-import json
-import os
-from pdf2image import convert_from_path
-import cv2
-import numpy as np
+from importlib import metadata
 import time
+from .cache import DiskCache, make_key
+from .ocrstore import save_ocr_result
+from .render import iter_pages, OCR_DPI
+
+OCR_CACHE_BYTES = 2 * 1024 ** 3     # Size bound of the per-page OCR cache
+
+def _engine_version():
+    try:
+        return metadata.version('rapidocr_paddle')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+def engine_config(gpu):
+    """Everything that can change the OCR output of a page; part of the page cache key."""
+    return {'engine': 'rapidocr_paddle', 'version': _engine_version(), 'gpu': gpu, 'word_box': True}
+
+def page_cache_key(img, dpi, config):
+    """Content address of a rendered page: pixel hash + DPI + engine settings."""
+    return make_key(img.tobytes(), img.shape, str(img.dtype), dpi, config)
+
+def page_cache():
+    return DiskCache('ocr_pages', OCR_CACHE_BYTES)
 # 
 class ROCRProcessor:
-    def __init__(self, gpu=True):
+    def __init__(self, gpu=True, cache=True):
         self.engine = RapidOCR(det_use_cuda=gpu, cls_use_cuda=gpu, rec_use_cuda=gpu)
+        self.engine_config = engine_config(gpu)
+        self.cache = page_cache() if cache else None
+
+    def process_pdf(self, pdf_path, ocr_path, dpi=OCR_DPI):
+        ''' Process a PDF file and save OCR results (see ocrstore).'''
+        self.process_images(iter_pages(pdf_path, dpi), ocr_path, dpi)
 
-    def process_pdf(self, pdf_path, ocr_path):
-        ''' Process a PDF file and save OCR results to a JSON file.'''
+    def process_images(self, imgs, ocr_path, dpi=OCR_DPI):
+        ''' OCR rendered BGR page images (any iterable, consumed page by page) and save the results.
+        The DPI of the images is stored with the results so callers can map boxes to other rasters.'''
         start_time = time.time()
         all_boxes, all_txts = [], []
-        # Convert PDF pages to numpy type images
-        imgs = convert_from_path(pdf_path, dpi=150, fmt="png", thread_count=10, use_pdftocairo=True)
-        imgs_bin = [cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR) for image in imgs]
-        for i, img in enumerate(imgs_bin):
-            result = self.engine(img, return_word_box=True)
-            boxes, txts = [], []
-            for line in result[0]:
-                for box in line[3]:
-                    boxes.append(box)
-                for text in line[4]:
-                    txts.append(text)
-                txts.append('\n')
-                boxes.append(box)
-            boxes = [[i, p0[0], p0[1], p2[0], p2[1]] for p0, p1, p2, p3 in boxes]
+        for i, img in imgs:
+            boxes, txts = self.ocr_image(img, i, dpi)
             all_boxes.extend(boxes)
             all_txts.extend(txts)
-        with open(ocr_path, 'w', encoding='utf-8') as f:
-            json.dump({"boxes": all_boxes, "txts": all_txts}, f, ensure_ascii=False)
+        save_ocr_result(ocr_path, all_boxes, all_txts, dpi)
         end_time = time.time()
         print(f"[INFO] RapidOCR processing time: {end_time - start_time:.2f} seconds")
+
+    def ocr_image(self, img, page_index, dpi=OCR_DPI):
+        ''' OCR a single page. Returns per-character boxes [page, x0, y0, x1, y1] and texts, one '\\n' per line.
+        Results are cached by page content, so the same page in another document is not OCR'd again.'''
+        if self.cache is None:
+            return self._run_engine(img, page_index)
+        key = page_cache_key(img, dpi, self.engine_config)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return from_cache_entry(cached, page_index)
+        boxes, txts = self._run_engine(img, page_index)
+        self.cache.set(key, to_cache_entry(boxes, txts))
+        return boxes, txts
+
+    def _run_engine(self, img, page_index):
+        result = self.engine(img, return_word_box=True)
+        boxes, txts = [], []
+        for line in result[0]:
+            for box in line[3]:
+                boxes.append(box)
+            for text in line[4]:
+                txts.append(text)
+            txts.append('\n')
+            boxes.append(box)
+        boxes = [[page_index, float(p0[0]), float(p0[1]), float(p2[0]), float(p2[1])] for p0, p1, p2, p3 in boxes]
+        return boxes, txts
+
+def to_cache_entry(boxes, txts):
+    """Cached pages are stored without their page index, which differs between documents."""
+    return {'boxes': [box[1:] for box in boxes], 'txts': txts}
+
+def from_cache_entry(entry, page_index):
+    return [[page_index] + box for box in entry['boxes']], entry['txts']
+
+# Per-process engine used by OCR worker pools (see ocr_server.py).
+# Each pool process builds its own RapidOCR instance once, in the pool initializer.
+# The server consults the page cache itself before queueing, so pool engines skip it.
+_engine = None
+
+def init_engine(gpu):
+    global _engine
+    _engine = ROCRProcessor(gpu=gpu, cache=False)
+
+def engine_ready():
+    """Run by pool warm-up: the initializer has built the engine once this returns."""
+    return _engine is not None
+
+def ocr_page(img, page_index, dpi=OCR_DPI):
+    return _engine.ocr_image(img, page_index, dpi)
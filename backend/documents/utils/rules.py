@@ -0,0 +1,147 @@
+"""
+Pattern-based detection of sensitive information (numbers, emails, ...).
+
+All rules are alternatives of one compiled pattern, so the text is scanned once whatever the
+number of rules, and every match comes with its offsets, ready to be located without searching
+the text again. Where several rules could match at the same position, the first registered wins.
+Rules may validate a match (checksums); a match that fails validation is kept only if the generic
+rule of the engine matches it as a whole, under that rule's category.
+"""
+import re
+from collections import namedtuple
+from .spans import Spans
+
+# A match: offsets in the scanned text, category (config key) and name of the rule
+Span = namedtuple('Span', 'start end category rule')
+
+TOKEN_CHARS = 'A-Za-z0-9-'
+MIN_DIGITS = 5
+
+def char_class_parts(body):
+    """
+    Ranges ('a-z') and single characters of a character class body, with a literal '-' escaped,
+    so that bodies can be joined without forming new ranges ('+-' followed by '0-9' is not '+-0').
+    """
+    parts, i = [], 0
+    while i < len(body):
+        if body[i] == '\\':
+            parts.append(body[i:i + 2])
+            i += 2
+        elif i + 2 < len(body) and body[i + 1] == '-':
+            parts.append(body[i:i + 3])
+            i += 3
+        else:
+            parts.append(re.escape(body[i]) if body[i] in '-^]' else body[i])
+            i += 1
+    return parts
+
+def whole_token(pattern):
+    """Match pattern only as a whole token, not inside a longer run of letters, digits and '-'."""
+    return rf'(?<![{TOKEN_CHARS}])(?:{pattern})(?![{TOKEN_CHARS}])'
+
+class Rule:
+    def __init__(self, name, category, pattern, validate=None, first_chars=None):
+        """
+        Args:
+            name (str): Rule name, used as the group name in the combined pattern.
+            category (str): Category of the matches, e.g. 'sens_number'.
+            pattern (str): Regular expression; must not contain capturing groups.
+            validate (callable): Optional validate(matched_text) -> bool.
+            first_chars (str): Optional character class body (e.g. 'A-Za-z0-9') containing the first
+                               character of every match. When all rules give one, positions that
+                               cannot start a match are skipped without trying each rule.
+        """
+        if re.compile(pattern).groups:
+            raise ValueError(f"Rule {name}: use non-capturing groups (?:...) in the pattern")
+        self.name = name
+        self.category = category
+        self.pattern = pattern
+        self.validate = validate
+        self.first_chars = first_chars
+
+def id_card_valid(s):
+    """Checksum of an 18-character mainland China resident ID number (GB 11643)."""
+    weights = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+    total = sum(int(c) * w for c, w in zip(s[:17], weights))
+    return '10X98765432'[total % 11] == s[17].upper()
+
+def luhn_valid(s):
+    """Luhn checksum of a bank card number; spaces and '-' are ignored."""
+    digits = [int(c) for c in s if c.isdigit()]
+    total = 0
+    for i, d in enumerate(reversed(digits)):
+        if i % 2:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return total % 10 == 0
+
+class RuleEngine:
+    def __init__(self, rules, generic):
+        """
+        Args:
+            rules (list): Specific rules, in priority order.
+            generic (Rule): Catch-all rule tried last, also used for matches failing validation.
+        """
+        self.rules = list(rules)
+        self.generic = generic
+        self._compile()
+
+    def register(self, rule, index=None):
+        """Add a rule, by default after the other specific rules and before the generic one."""
+        self.rules.insert(len(self.rules) if index is None else index, rule)
+        self._compile()
+
+    @property
+    def categories(self):
+        """Categories of all rules, in registration order."""
+        return list(dict.fromkeys(r.category for r in self.rules + [self.generic]))
+
+    def _compile(self):
+        rules = self.rules + [self.generic]
+        self.by_name = {r.name: r for r in rules}
+        pattern = '|'.join(f'(?P<{r.name}>{r.pattern})' for r in rules)
+        self.first_chars = None
+        if all(r.first_chars for r in rules):
+            self.first_chars = ''.join(dict.fromkeys(p for r in rules for p in char_class_parts(r.first_chars)))
+            pattern = f"(?=[{self.first_chars}])(?:{pattern})"
+        self.pattern = re.compile(pattern)
+        self.generic_pattern = re.compile(self.generic.pattern)
+
+    def scan(self, text):
+        """
+        Returns:
+            list: Spans of all matches, in text order.
+        """
+        spans = []
+        for m in self.pattern.finditer(text):
+            rule = self.by_name[m.lastgroup]
+            if rule.validate is not None and not rule.validate(m.group()):
+                if not self.generic_pattern.fullmatch(m.group()):
+                    continue
+                rule = self.generic
+            spans.append(Span(m.start(), m.end(), rule.category, rule.name))
+        return spans
+
+    def spans(self, text):
+        """Matches as Spans, with a score of 1."""
+        return Spans.from_tuples(((span.start, span.end, span.category, 1.0) for span in self.scan(text)),
+                                 self.categories)
+
+RULES = RuleEngine(
+    [
+        # A match ending inside a token ('7@4.86-X75-0') runs to the end of the token, so the rest of it
+        # is not left unmasked. No lookbehind on the start: an address may begin where the previous match ended
+        Rule('email', 'email', rf'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z0-9]{{2,}}[{TOKEN_CHARS}]*',
+             first_chars='A-Za-z0-9._%+-'),
+        Rule('id_card', 'sens_number', whole_token(r'\d{17}[\dXx]'), id_card_valid, first_chars='0-9'),
+        Rule('bank_card', 'sens_number', whole_token(r'[3-6]\d{3}(?:[ -]?\d{4}){3}(?:[ -]?\d{1,3})?'), luhn_valid,
+             first_chars='3-6'),
+        Rule('phone', 'sens_number', whole_token(r'(?:(?:\+|00)86[ -]?)?1[3-9]\d(?:[ -]?\d{4}){2}'),
+             first_chars='+01'),
+    ],
+    # Letters, digits and '-' with at least MIN_DIGITS digits (account numbers, landlines, ...)
+    Rule('sens_number', 'sens_number', rf'(?=(?:[A-Za-z-]*\d){{{MIN_DIGITS}}})[{TOKEN_CHARS}]+',
+         first_chars=TOKEN_CHARS),
+)
@@ -0,0 +1,91 @@
+"""
+Detections as character-offset spans.
+
+Detectors report where each entity was found instead of the set of phrases, so locating them is
+proportional to the number of detections, and only the occurrences actually detected are masked
+(not every occurrence of a short phrase anywhere in the document).
+"""
+import numpy as np
+
+class Spans:
+    """
+    Spans in columns: start and end (exclusive) character offsets, category index into
+    `categories`, and score in [0, 1]. One numpy array per column keeps thousands of
+    detections compact and cheap to concatenate, shift and sort.
+    """
+    __slots__ = ('start', 'end', 'category', 'score', 'categories')
+
+    def __init__(self, start=(), end=(), category=(), score=(), categories=()):
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.category = np.asarray(category, dtype=np.int32)
+        self.score = np.asarray(score, dtype=np.float32)
+        self.categories = list(categories)
+
+    @classmethod
+    def from_tuples(cls, items, categories=()):
+        """
+        Args:
+            items (iterable): (start, end, category name, score) tuples.
+            categories (list): Categories to report even without spans, in output order;
+                               others are appended as they appear.
+        """
+        categories = list(categories)
+        index = {name: i for i, name in enumerate(categories)}
+        columns = ([], [], [], [])
+        for start, end, name, score in items:
+            if name not in index:
+                index[name] = len(categories)
+                categories.append(name)
+            for column, value in zip(columns, (start, end, index[name], score)):
+                column.append(value)
+        return cls(*columns, categories)
+
+    @classmethod
+    def concat(cls, parts):
+        """Spans of all parts, in order; categories are merged by name."""
+        categories = list(dict.fromkeys(name for part in parts for name in part.categories))
+        index = {name: i for i, name in enumerate(categories)}
+        remap = [np.array([index[name] for name in part.categories] or [0], dtype=np.int32) for part in parts]
+        return cls(
+            np.concatenate([part.start for part in parts] or [[]]),
+            np.concatenate([part.end for part in parts] or [[]]),
+            np.concatenate([m[part.category] for m, part in zip(remap, parts)] or [[]]),
+            np.concatenate([part.score for part in parts] or [[]]),
+            categories,
+        )
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        """(start, end, category name, score) tuples."""
+        names = self.categories
+        for start, end, category, score in zip(self.start.tolist(), self.end.tolist(),
+                                                self.category.tolist(), self.score.tolist()):
+            yield start, end, names[category], score
+
+    def shifted(self, offset):
+        """The same spans, offsets moved by `offset` (e.g. from a chunk into its document)."""
+        return Spans(self.start + offset, self.end + offset, self.category, self.score, self.categories)
+
+    def unique(self):
+        """
+        One span per (start, end, category), with the highest score, sorted by start;
+        overlapping chunks detect the same entities twice.
+        """
+        if len(self) == 0:
+            return self
+        order = np.lexsort((-self.score, self.category, self.end, self.start))
+        start, end, category = self.start[order], self.end[order], self.category[order]
+        keep = np.ones(len(order), bool)
+        keep[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1]) | (category[1:] != category[:-1])
+        order = order[keep]
+        return Spans(self.start[order], self.end[order], self.category[order], self.score[order], self.categories)
+
+    def phrases(self, text):
+        """{category: set of phrases}, the format of the former phrase-based detectors."""
+        result = {name: set() for name in self.categories}
+        for start, end, name, _ in self:
+            result[name].add(text[start:end])
+        return result
@@ -0,0 +1,52 @@
+import time
+from contextlib import contextmanager
+
+class StageTimer:
+    """
+    Wall-clock time per pipeline stage, plus simple counters.
+
+    Stages may nest (e.g. pages are rendered lazily while OCR pulls them); time spent in an
+    inner stage is only attributed to that stage, so the totals add up to the elapsed time.
+    Not thread-safe: stages are entered from the thread driving the pipeline.
+    """
+    def __init__(self):
+        self.totals = {}
+        self.counters = {}
+        self._stack = []    # [name, start, time spent in nested stages]
+
+    @contextmanager
+    def stage(self, name):
+        frame = [name, time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed - frame[2]
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def iter(self, name, iterable):
+        """Pass items through, attributing the time spent producing each one to `name`."""
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds):
+        """Attribute time measured elsewhere (e.g. in a worker thread) to a stage."""
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        return {
+            'stages': {name: round(t, 4) for name, t in self.totals.items()},
+            'counters': dict(self.counters),
+        }
@@ -0,0 +1,94 @@
+import fitz  # PyMuPDF
+import cv2
+import numpy as np
+from .render import RENDER_DPI
+
+# Pages with fewer visible characters in their text layer are treated as scans and OCR'd
+TEXT_LAYER_MIN_CHARS = 20
+
+def extract_text_layer(pdf_path, dpi):
+    """
+    Read text and glyph boxes directly from born-digital pages, without OCR.
+    Args:
+        pdf_path (str): Path of the PDF file.
+        dpi (int): Coordinate space of the returned boxes (same as the OCR results).
+    Returns:
+        dict: {page_index: (boxes, txts)} for pages with a usable text layer, in the format of
+              ROCRProcessor.ocr_image (one box per character, one '\n' per line).
+    """
+    scale = dpi / 72
+    text_layer = {}
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            if page.rotation:   # Glyph and annotation coordinates disagree on rotated pages, use OCR
+                continue
+            boxes, txts = [], []
+            for block in page.get_text("rawdict")["blocks"]:
+                for line in block.get("lines", []):
+                    box = None
+                    for span in line["spans"]:
+                        for char in span["chars"]:
+                            x0, y0, x1, y1 = char["bbox"]
+                            box = [page.number, x0 * scale, y0 * scale, x1 * scale, y1 * scale]
+                            boxes.append(box)
+                            txts.append(char["c"])
+                    if box is not None:
+                        boxes.append(box)
+                        txts.append('\n')
+            if sum(1 for t in txts if t.strip()) >= TEXT_LAYER_MIN_CHARS:
+                text_layer[page.number] = (boxes, txts)
+    return text_layer
+
+class VectorRedactor:
+    """
+    Applies true redactions to born-digital pages of the original PDF: the text under a
+    sensitive box is removed from the content stream, not just painted over.
+    """
+    def __init__(self, pdf_path, dpi=RENDER_DPI):
+        self.doc = fitz.open(pdf_path)
+        self.dpi = dpi  # Resolution used for blur/mosaic patches
+        self.patches = []   # (page_index, rect, png) inserted after the redactions are applied
+        self.redacted_pages = set()
+
+    def redact(self, page_index, rect, method, color=(0, 0, 0), cover=None):
+        """
+        Args:
+            page_index (int): 0-based page.
+            rect (tuple): (x0, y0, x1, y1) in PDF points.
+            method (str): Cover method, see ImageProcessor.COVER_METHODS.
+            color (tuple): RGB fill (0-255) for 'black'.
+            cover (callable): cover(img, x, y, w, h) used for raster effects such as blur and mosaic.
+        """
+        if method == 'empty':
+            return
+        page = self.doc[page_index]
+        rect = fitz.Rect(rect) & page.rect
+        if rect.is_empty:
+            return
+        if method == 'black':
+            page.add_redact_annot(rect, fill=tuple(c / 255 for c in color))
+        else:
+            # Rasterise the area, apply the effect, and put it back on top of the removed text
+            pix = page.get_pixmap(clip=rect, dpi=self.dpi)
+            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR if pix.n == 3 else cv2.COLOR_RGBA2BGR)
+            cover(img, 0, 0, pix.width, pix.height)
+            _, buffer = cv2.imencode(".png", img)
+            self.patches.append((page_index, rect, buffer.tobytes()))
+            page.add_redact_annot(rect, fill=None)
+        self.redacted_pages.add(page_index)
+
+    def replace_pages(self, raster_pdf_path, page_indices):
+        """Replace pages (e.g. scanned ones handled by the OCR path) with the pages of another PDF, in order."""
+        with fitz.open(raster_pdf_path) as raster:
+            for src, page_index in enumerate(page_indices):
+                self.doc.insert_pdf(raster, from_page=src, to_page=src, start_at=page_index)
+                self.doc.delete_page(page_index + 1)
+
+    def save(self, out_path):
+        for page_index in sorted(self.redacted_pages):
+            self.doc[page_index].apply_redactions()
+        for page_index, rect, png in self.patches:
+            self.doc[page_index].insert_image(rect, stream=png)
+        self.doc.save(out_path, garbage=3, deflate=True)
+        self.doc.close()
@@ -0,0 +1,186 @@
+import os
+import struct
+import time
+import zlib
+from .cache import DiskCache, make_key
+
+# Entries, offsets and sizes at or above these limits need zip64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+READ_SIZE = 1024 * 1024
+
+_FLAGS = 0x08 | 0x800   # Sizes and CRC in a data descriptor, UTF-8 names
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1     # 1980-01-01 00:00
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class _Entry:
+    def __init__(self, name, path, st, offset):
+        self.name = name.encode('utf-8')
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.time, self.date = _dos_time(st.st_mtime)
+        self.offset = offset        # Offset of the local header
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.crc = None
+
+    def local_header(self):
+        extra = b''
+        size = 0
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            size = 0xFFFFFFFF
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if self.zip64 else 20, _FLAGS, 0,
+                           self.time, self.date, 0, size, size, len(self.name), len(extra)) + self.name + extra
+
+    def descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def descriptor(self):
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        extra = b''
+        size = self.size
+        offset = self.offset
+        if self.zip64:
+            extra += struct.pack('<QQ', self.size, self.size)
+            size = 0xFFFFFFFF
+        if offset >= ZIP64_LIMIT:
+            extra += struct.pack('<Q', offset)
+            offset = 0xFFFFFFFF
+        if extra:
+            extra = struct.pack('<HH', 0x0001, len(extra)) + extra
+        version = 45 if extra else 20
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, _FLAGS, 0,
+                           self.time, self.date, self.crc, size, size, len(self.name), len(extra),
+                           0, 0, 0, 0o100644 << 16, offset) + self.name + extra
+
+    def central_size(self):
+        n = 46 + len(self.name)
+        extra = (16 if self.zip64 else 0) + (8 if self.offset >= ZIP64_LIMIT else 0)
+        return n + (4 + extra if extra else 0)
+
+class ZipStream:
+    """
+    Uncompressed (ZIP_STORED) archive of files on disk, generated on the fly.
+
+    Sizes and CRCs go into data descriptors after each file, so file data can be
+    sent as it is read, with constant memory. The layout depends only on names and
+    file sizes, so the total size is known up front and any byte range of the
+    archive can be produced without generating what comes before it.
+    """
+    def __init__(self, files, crc_cache=None):
+        """
+        Args:
+            files: (archive name, path) pairs.
+            crc_cache (DiskCache): Optional cache of file CRCs, used when a range starts after a file's data.
+        """
+        self.crc_cache = crc_cache
+        self.entries = []
+        self.segments = []      # (start, length, kind, entry)
+        offset = 0
+        for name, path in files:
+            entry = _Entry(name, path, os.stat(path), offset)
+            self.entries.append(entry)
+            for kind, length in (('header', None), ('data', entry.size), ('descriptor', entry.descriptor_size())):
+                if length is None:
+                    length = len(entry.local_header())
+                self.segments.append((offset, length, kind, entry))
+                offset += length
+        self.cd_offset = offset
+        self.cd_size = sum(e.central_size() for e in self.entries)
+        self.zip64 = (len(self.entries) >= ZIP64_COUNT_LIMIT or self.cd_offset >= ZIP64_LIMIT
+                      or self.cd_size >= ZIP64_LIMIT or any(e.zip64 for e in self.entries))
+        end_size = 22 + (56 + 20 if self.zip64 else 0)
+        self.segments.append((offset, self.cd_size + end_size, 'end', None))
+        self.size = offset + self.cd_size + end_size
+
+    def etag(self):
+        """Validator for If-Range: changes whenever a file or the file list changes."""
+        return make_key('zipstream', [(e.name.decode('utf-8'), e.path, e.size, e.mtime_ns) for e in self.entries])
+
+    def __iter__(self):
+        return self.iter_range(0, self.size - 1)
+
+    def iter_range(self, first, last):
+        """Yield the bytes of the archive from offset `first` to `last` (inclusive)."""
+        for start, length, kind, entry in self.segments:
+            end = start + length
+            if end <= first or start > last:
+                continue
+            lo = max(first, start) - start
+            hi = min(last + 1, end) - start
+            if kind == 'data':
+                yield from self._read(entry, lo, hi)
+            else:
+                data = self._segment(kind, entry)
+                yield data[lo:hi]
+
+    def _segment(self, kind, entry):
+        if kind == 'header':
+            return entry.local_header()
+        if kind == 'descriptor':
+            self._ensure_crc(entry)
+            return entry.descriptor()
+        for e in self.entries:
+            self._ensure_crc(e)
+        return b''.join(e.central_header() for e in self.entries) + self._end_records()
+
+    def _read(self, entry, lo, hi):
+        # The CRC is computed on the way when the whole file is sent
+        crc = 0 if lo == 0 and entry.crc is None else None
+        with open(entry.path, 'rb') as f:
+            f.seek(lo)
+            remaining = hi - lo
+            while remaining:
+                chunk = f.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{entry.path} changed while being archived")
+                if crc is not None:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if crc is not None and hi == entry.size:
+            self._set_crc(entry, crc)
+
+    def _ensure_crc(self, entry):
+        if entry.crc is not None:
+            return
+        key = make_key('crc32', entry.path, entry.size, entry.mtime_ns)
+        crc = self.crc_cache.get(key) if self.crc_cache is not None else None
+        if crc is None:
+            crc = 0
+            with open(entry.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+        self._set_crc(entry, crc)
+
+    def _set_crc(self, entry, crc):
+        entry.crc = crc
+        if self.crc_cache is not None:
+            self.crc_cache.set(make_key('crc32', entry.path, entry.size, entry.mtime_ns), crc)
+
+    def _end_records(self):
+        count = len(self.entries)
+        records = b''
+        if self.zip64:
+            zip64_offset = self.cd_offset + self.cd_size
+            records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                   count, count, self.cd_size, self.cd_offset)
+            records += struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+        records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                               min(count, 0xFFFF), min(count, 0xFFFF),
+                               min(self.cd_size, 0xFFFFFFFF), min(self.cd_offset, 0xFFFFFFFF), 0)
+        return records
+
+def crc_cache():
+    """CRCs of exported files, so resumed downloads do not re-read files they skip."""
+    return DiskCache('zip_crc', max_bytes=16 * 1024 ** 2)
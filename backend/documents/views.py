@@ -11,18 +11,26 @@ import os
 import hashlib
 import json
 import random
-from .models import Document, ProcessedDocument, ProcessingLog
+import tempfile
+import threading
+import numpy as np
+from collections import defaultdict
+from datetime import timedelta
+from django.utils import timezone
+from .models import Document, ProcessedDocument, ProcessingLog, UploadSession, user_document_path
 from .serializers import (
     DocumentSerializer, ProcessedDocumentSerializer, ProcessingLogSerializer,
-    DocumentUploadSerializer, DocumentConfigSerializer
+    DocumentUploadSerializer, DocumentConfigSerializer, UploadInitSerializer
 )
 import fitz  # PyMuPDF
 from .process import process
+from .utils.encode import DEFAULT_OUTPUT
 import asyncio
 from time import time
 import logging
 logger = logging.getLogger(__name__)
 from django.db import IntegrityError, transaction
+from django.db.models import F, Q
 
 def calculate_file_hash(file):
     """计算文件的MD5哈希值"""
@@ -31,6 +39,82 @@ def calculate_file_hash(file):
         hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+def spool_upload(uploaded_file, chunk_size=1024 * 1024):
+    """
+    将上传文件分块写入MEDIA_ROOT下的临时文件，同时增量计算MD5。
+    内存占用与文件大小无关。
+    Returns:
+        (临时文件路径, MD5哈希, 文件大小)
+    """
+    upload_dir = os.path.join(settings.MEDIA_ROOT, '.uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    hash_md5 = hashlib.md5()
+    file_size = 0
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf', dir=upload_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in uploaded_file.chunks(chunk_size):
+                hash_md5.update(chunk)
+                f.write(chunk)
+                file_size += len(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, hash_md5.hexdigest(), file_size
+
+def count_pdf_pages(path):
+    """从磁盘文件读取PDF页数（PyMuPDF按需读取，不整体加载）"""
+    try:
+        with fitz.open(path) as doc:
+            return doc.page_count
+    except Exception:
+        return 0
+
+def store_upload(user, tmp_path, file_name, file_size, file_hash):
+    """
+    将已落盘的上传文件登记为文档：查重、计算页数，并原子重命名到最终存储路径。
+    Returns:
+        (Document, 是否重复)。重复时返回已存在的文档，临时文件保持不动由调用方清理。
+    """
+    # 日志输出，便于多端并发调试
+    logger.warning(f"[UPLOAD] 当前用户: {user.id}, 用户名: {user.username}, 文件hash: {file_hash}, 文件名: {file_name}")
+
+    existing_doc = Document.objects.filter(user=user, file_hash=file_hash).first()
+    if existing_doc:
+        return existing_doc, True
+
+    document = Document(
+        user=user,
+        file_hash=file_hash,
+        filename=file_name,
+        file_size=file_size,
+        page_count=count_pdf_pages(tmp_path),
+        status='uploaded'
+    )
+    relative_path = user_document_path(document, file_name)
+    final_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(tmp_path, final_path)
+    document.original_file.name = relative_path
+    try:
+        with transaction.atomic():
+            document.save()
+    except IntegrityError:
+        # 并发上传了相同文件，保留先完成的那一份
+        os.remove(final_path)
+        return Document.objects.get(user=user, file_hash=file_hash), True
+    return document, False
+
+def duplicate_response(request, document, file_name):
+    doc_serializer = DocumentSerializer(document, context={'request': request})
+    return Response({
+        'success': False,
+        'error': '文件已存在',
+        'message': f'文件 "{file_name}" 已存在于您的文档列表中',
+        'existing_document': doc_serializer.data,
+        'duplicate_reason': 'file_content'
+    }, status=status.HTTP_409_CONFLICT)
+
 def check_duplicate_file(user, file_hash, filename, file_size):
     """检查是否为重复文件"""
     # 检查是否存在相同哈希的文件
@@ -73,71 +157,305 @@ def upload_document(request):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         uploaded_file = serializer.validated_data['file']
-
-        # 先将文件内容读入内存，后续所有操作都用副本
-        uploaded_file.seek(0)
-        file_bytes = uploaded_file.read()
-        file_size = len(file_bytes)
         file_name = uploaded_file.name
-        content_type = uploaded_file.content_type if hasattr(uploaded_file, 'content_type') else 'application/pdf'
 
-        # 计算hash
-        file_hash = hashlib.md5(file_bytes).hexdigest()
-
-        # 计算页数
+        # 流式落盘：边写临时文件边计算hash，不在内存中保留整个文件
+        tmp_path, file_hash, file_size = spool_upload(uploaded_file)
         try:
-            import fitz
-            doc = fitz.open(stream=file_bytes, filetype='pdf')
-            page_count = doc.page_count
-        except Exception:
-            page_count = 0
-
-        # 构造InMemoryUploadedFile用于保存
-        import io
-        from django.core.files.uploadedfile import InMemoryUploadedFile
-        file_stream = io.BytesIO(file_bytes)
-        uploaded_file_for_save = InMemoryUploadedFile(
-            file_stream, None, file_name, content_type, file_size, None
+            document, duplicate = store_upload(request.user, tmp_path, file_name, file_size, file_hash)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if duplicate:
+            return duplicate_response(request, document, file_name)
+        doc_serializer = DocumentSerializer(document, context={'request': request})
+        return Response({
+            'success': True,
+            'message': '文档上传成功',
+            'document': doc_serializer.data
+        }, status=status.HTTP_201_CREATED)
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# 分片上传：init -> PUT 分片(带偏移) -> finalize
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024         # 建议客户端使用的分片大小
+UPLOAD_MAX_CHUNK_SIZE = 16 * 1024 * 1024    # 单个分片的上限
+UPLOAD_SESSION_TTL = timedelta(hours=24)    # 超过该时间未更新的会话视为放弃
+UPLOAD_CLAIM_TIMEOUT = timedelta(minutes=10)    # 认领超过该时间未释放（请求中断）时可被重新认领
+
+# 进程内的增量MD5状态 {upload_id: (已计算的字节数, md5)}。
+# 分片落到其他进程或进程重启后状态会失效，finalize 时回退为重新读取文件计算。
+_upload_hashes = {}
+_upload_hashes_lock = threading.Lock()
+
+def calculate_path_hash(path, chunk_size=1024 * 1024):
+    """计算磁盘文件的MD5哈希值"""
+    hash_md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+def take_upload_hash(upload_id, offset):
+    """取出与当前偏移一致的增量MD5状态，没有则返回None"""
+    with _upload_hashes_lock:
+        state = _upload_hashes.pop(str(upload_id), None)
+    if state is None or state[0] != offset:
+        return None
+    return state[1]
+
+def append_chunk(session, stream, length, chunk_size=1024 * 1024):
+    """
+    将请求体写入会话暂存文件的 session.received 偏移处，并更新增量MD5。
+    Returns:
+        int: 实际写入的字节数。不足 length 时（客户端断开）文件被截回原偏移。
+    """
+    path = session.get_part_path()
+    offset = session.received
+    hash_md5 = take_upload_hash(session.upload_id, offset)
+    if hash_md5 is None and offset == 0:
+        hash_md5 = hashlib.md5()
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+        # 丢弃上次失败请求可能残留的尾部数据
+        f.seek(offset)
+        f.truncate()
+        while written < length:
+            chunk = stream.read(min(chunk_size, length - written)) if stream else b''
+            if not chunk:
+                break
+            f.write(chunk)
+            if hash_md5 is not None:
+                hash_md5.update(chunk)
+            written += len(chunk)
+        if written < length:
+            f.truncate(offset)
+            return 0
+    if hash_md5 is not None:
+        with _upload_hashes_lock:
+            _upload_hashes[str(session.upload_id)] = (offset + written, hash_md5)
+    return written
+
+def discard_upload_session(session, status_value='aborted'):
+    """结束会话并清理暂存文件"""
+    take_upload_hash(session.upload_id, -1)
+    part_path = session.get_part_path()
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    session.status = status_value
+    session.claimed_at = None
+    session.save(update_fields=['status', 'document', 'claimed_at', 'updated_at'])
+
+def expire_upload_sessions(user):
+    """清理用户长时间未更新的上传会话"""
+    deadline = timezone.now() - UPLOAD_SESSION_TTL
+    for session in UploadSession.objects.filter(user=user, status='active', updated_at__lt=deadline):
+        discard_upload_session(session)
+
+def claim_upload_session(upload_id, user, **conditions):
+    """
+    用一条条件UPDATE认领活动会话（未被认领或认领已过期，且满足 conditions），
+    认领期间其他请求不能写入或完成该会话。写入分片时不持有行锁和事务，
+    慢速客户端传输期间不占用数据库连接。
+    Returns:
+        认领时间（释放时用作令牌），认领失败返回None
+    """
+    now = timezone.now()
+    claimed = UploadSession.objects.filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - UPLOAD_CLAIM_TIMEOUT),
+        upload_id=upload_id, user=user, status='active', **conditions
+    ).update(claimed_at=now, updated_at=now)
+    return now if claimed else None
+
+def release_upload_session(session, token, **fields):
+    """
+    释放认领并更新 fields（如新的 received）。
+    Returns:
+        bool: 认领仍属于本请求（未过期被他人接管、会话未被取消）时为True
+    """
+    return UploadSession.objects.filter(pk=session.pk, claimed_at=token, status='active').update(
+        claimed_at=None, updated_at=timezone.now(), **fields) == 1
+
+def unclaimed_session_error(upload_id, user, offset=None):
+    """认领失败时，按会话当前状态返回对应的错误响应"""
+    session = UploadSession.objects.filter(upload_id=upload_id, user=user).first()
+    if session is None:
+        return Response({'success': False, 'error': '上传会话不存在'}, status=status.HTTP_404_NOT_FOUND)
+    if session.status != 'active':
+        return Response({'success': False, 'error': '上传会话已结束'}, status=status.HTTP_409_CONFLICT)
+    if offset is not None and offset != session.received:
+        return Response({
+            'success': False,
+            'error': '分片偏移不一致',
+            'offset': session.received
+        }, status=status.HTTP_409_CONFLICT)
+    if offset is None and session.received != session.file_size:
+        return Response({
+            'success': False,
+            'error': '文件尚未上传完整',
+            'offset': session.received
+        }, status=status.HTTP_409_CONFLICT)
+    return Response({
+        'success': False,
+        'error': '该会话正在被其他请求处理',
+        'offset': session.received
+    }, status=status.HTTP_409_CONFLICT)
+
+def upload_session_response(session, status_code=status.HTTP_200_OK):
+    return Response({
+        'success': True,
+        'upload_id': session.upload_id,
+        'filename': session.filename,
+        'file_size': session.file_size,
+        'offset': session.received,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'status': session.status,
+    }, status=status_code)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_init(request):
+    """
+    分片上传初始化API
+    客户端提供文件MD5时，先做查重：文件已存在直接返回409，不必再传输文件内容；
+    同一文件存在未完成的会话时返回该会话及已接收的偏移，用于断点续传。
+    """
+    try:
+        serializer = UploadInitSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        file_name = serializer.validated_data['filename']
+        file_size = serializer.validated_data['file_size']
+        file_hash = serializer.validated_data.get('file_hash')
+
+        expire_upload_sessions(request.user)
+        if file_hash:
+            existing_doc = Document.objects.filter(user=request.user, file_hash=file_hash).first()
+            if existing_doc:
+                return duplicate_response(request, existing_doc, file_name)
+            session = UploadSession.objects.filter(
+                user=request.user, file_hash=file_hash, file_size=file_size, status='active'
+            ).first()
+            if session:
+                return upload_session_response(session)
+
+        session = UploadSession.objects.create(
+            user=request.user,
+            filename=file_name,
+            file_size=file_size,
+            file_hash=file_hash
         )
+        os.makedirs(os.path.dirname(session.get_part_path()), exist_ok=True)
+        open(session.get_part_path(), 'wb').close()
+        return upload_session_response(session, status.HTTP_201_CREATED)
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # 日志输出，便于多端并发调试
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.warning(f"[UPLOAD] 当前用户: {request.user.id}, 用户名: {request.user.username}, 文件hash: {file_hash}, 文件名: {file_name}")
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_session(request, upload_id):
+    """查询上传进度(GET)或取消上传(DELETE)"""
+    try:
+        session = UploadSession.objects.get(upload_id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return Response({'success': False, 'error': '上传会话不存在'}, status=status.HTTP_404_NOT_FOUND)
+    if request.method == 'DELETE' and session.status == 'active':
+        discard_upload_session(session)
+    return upload_session_response(session)
 
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id):
+    """
+    上传一个分片API
+    请求体为分片的原始字节，查询参数 offset 为分片在文件中的起始位置，必须等于已接收的字节数；
+    偏移不一致时返回409和服务端的当前偏移，客户端从该偏移继续上传。
+    """
+    try:
         try:
-            from django.db import transaction, IntegrityError
-            with transaction.atomic():
-                document, created = Document.objects.get_or_create(
-                    user=request.user,
-                    file_hash=file_hash,
-                    defaults={
-                        'original_file': uploaded_file_for_save,
-                        'filename': file_name,
-                        'file_size': file_size,
-                        'page_count': page_count,
-                        'status': 'uploaded'
-                    }
-                )
-                if not created:
-                    doc_serializer = DocumentSerializer(document, context={'request': request})
-                    return Response({
-                        'success': False,
-                        'error': '文件已存在',
-                        'message': f'文件 "{file_name}" 已存在于您的文档列表中',
-                        'existing_document': doc_serializer.data,
-                        'duplicate_reason': 'file_content'
-                    }, status=status.HTTP_409_CONFLICT)
-        except IntegrityError:
-            document = Document.objects.get(user=request.user, file_hash=file_hash)
-            doc_serializer = DocumentSerializer(document, context={'request': request})
+            offset = int(request.query_params.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response({'success': False, 'error': '无效的偏移或长度'}, status=status.HTTP_400_BAD_REQUEST)
+        if length <= 0 or length > UPLOAD_MAX_CHUNK_SIZE:
             return Response({
                 'success': False,
-                'error': '文件已存在',
-                'message': f'文件 "{file_name}" 已存在于您的文档列表中',
-                'existing_document': doc_serializer.data,
-                'duplicate_reason': 'file_content'
-            }, status=status.HTTP_409_CONFLICT)
+                'error': f'分片大小必须在1到{UPLOAD_MAX_CHUNK_SIZE}字节之间'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # 认领偏移后在事务外写入，写完再提交新的偏移；同一会话同时只有一个请求在写
+        token = claim_upload_session(upload_id, request.user, received=offset)
+        if token is None:
+            return unclaimed_session_error(upload_id, request.user, offset)
+        session = UploadSession.objects.get(upload_id=upload_id, user=request.user)
+        if offset + length > session.file_size:
+            release_upload_session(session, token)
+            return Response({'success': False, 'error': '分片超出文件大小'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            written = append_chunk(session, request.stream, length)
+        except Exception:
+            release_upload_session(session, token)
+            raise
+        if written != length:
+            release_upload_session(session, token)
+            return Response({
+                'success': False,
+                'error': '分片数据不完整',
+                'offset': session.received
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if not release_upload_session(session, token, received=offset + written):
+            # 认领已过期被接管或会话已取消，本次写入作废
+            take_upload_hash(session.upload_id, -1)
+            return unclaimed_session_error(upload_id, request.user, offset + written)
+        session.received = offset + written
+
+        return Response({
+            'success': True,
+            'offset': session.received,
+            'complete': session.received == session.file_size
+        })
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_finalize(request, upload_id):
+    """完成分片上传API：校验MD5并登记为文档"""
+    try:
+        # 认领后在事务外校验和登记，哈希和移动大文件期间不持有行锁
+        token = claim_upload_session(upload_id, request.user, received=F('file_size'))
+        if token is None:
+            return unclaimed_session_error(upload_id, request.user)
+        session = UploadSession.objects.get(upload_id=upload_id, user=request.user)
+        try:
+            part_path = session.get_part_path()
+            hash_md5 = take_upload_hash(session.upload_id, session.received)
+            file_hash = hash_md5.hexdigest() if hash_md5 is not None else calculate_path_hash(part_path)
+            if session.file_hash and session.file_hash != file_hash:
+                discard_upload_session(session)
+                return Response({
+                    'success': False,
+                    'error': '文件校验失败，请重新上传'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            document, duplicate = store_upload(request.user, part_path, session.filename, session.file_size, file_hash)
+        except Exception:
+            release_upload_session(session, token)
+            raise
+        session.document = document
+        discard_upload_session(session, 'completed')
+
+        if duplicate:
+            return duplicate_response(request, document, session.filename)
         doc_serializer = DocumentSerializer(document, context={'request': request})
         return Response({
             'success': True,
@@ -197,7 +515,7 @@ def process_document(request):
     """
     import logging
     logger = logging.getLogger(__name__)
-    from .tasks import process_document_task
+    from .tasks import start_processing, fail_processed_document
     # 验证请求数据
     serializer = DocumentConfigSerializer(data=request.data)
     if not serializer.is_valid():
@@ -218,25 +536,32 @@ def process_document(request):
     config_hash = hashlib.md5(config_str.encode()).hexdigest()
     # 检查是否已有相同配置的处理结果
     existing_processed = ProcessedDocument.objects.filter(document=document, config_hash=config_hash).first()
-    if existing_processed:
+    if existing_processed and existing_processed.status != 'failed':
         logger.warning(f"[PROCESS] 使用缓存结果: processed_id={existing_processed.id}")
         processed_serializer = ProcessedDocumentSerializer(existing_processed, context={'request': request})
         return Response({'success': True, 'message': '使用缓存的处理结果', 'processed_document': processed_serializer.data})
-    # 创建新的处理记录
-    processed_doc = ProcessedDocument.objects.create(
-        document=document,
-        config_hash=config_hash,
-        config_data=config,
-        status='pending'
-    )
-    # 分发Celery异步任务（全部用default队列）
-    task = process_document_task.apply_async(
-        args=[document.id, config, config_hash]
-        # 不指定queue，全部走default
-    )
-    logger.warning(f"[PROCESS] 分发Celery任务: document_id={document.id}, config_hash={config_hash}, queue=default, task_id={task.id}")
-    processed_doc.status = 'pending'
-    processed_doc.save()
+    if existing_processed:
+        # 失败的记录不当作缓存，重新处理
+        processed_doc = existing_processed
+        ProcessedDocument.objects.filter(id=processed_doc.id).update(status='pending')
+        processed_doc.status = 'pending'
+    else:
+        # 创建新的处理记录，状态须在分发前写好：任务开始后会改为 processing，此后不能再覆盖
+        processed_doc = ProcessedDocument.objects.create(
+            document=document,
+            config_hash=config_hash,
+            config_data=config,
+            status='pending'
+        )
+    # 分发Celery异步任务（按阶段拆分的流水线或default队列上的单个任务）
+    try:
+        task = start_processing(document, processed_doc, config, config_hash)
+    except Exception as e:
+        logger.warning(f"[PROCESS] 分发Celery任务失败: processed_id={processed_doc.id}, 错误: {e}")
+        fail_processed_document(processed_doc, e)
+        return Response({'success': False, 'error': f'任务分发失败: {e}', 'processed_document_id': processed_doc.id},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    logger.warning(f"[PROCESS] 分发Celery任务: document_id={document.id}, config_hash={config_hash}, task_id={task.id}")
     return Response({
         'success': True,
         'message': '任务已提交，正在排队处理',
@@ -432,6 +757,7 @@ def processed_document_info(request, processed_id):
             'config': processed.config_data,
             'status': processed.status,
             'process_time': processed.process_time,
+            'metrics': processed.metrics,
             'sensitive_fields': sensitive_fields
         })
     except ProcessedDocument.DoesNotExist:
@@ -439,34 +765,124 @@ def processed_document_info(request, processed_id):
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=500)
 
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from rest_framework.authtoken.models import Token
+from .progress import subscribe, TERMINAL_STAGES
+
+@sync_to_async
+def get_progress_target(user, token_key, processed_id):
+    """按 token(EventSource 无法设置请求头，通过查询参数传递)或会话用户查找处理记录"""
+    if token_key:
+        token = Token.objects.select_related('user').filter(key=token_key).first()
+        user = token.user if token else None
+    if user is None or not user.is_authenticated:
+        return None
+    return ProcessedDocument.objects.filter(id=processed_id, document__user=user).first()
+
+def sse_event(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+async def processing_progress_stream(request, processed_id):
+    """
+    处理进度推送(SSE)，需在 ASGI 下运行
+    连接时查询一次处理记录，之后的进度全部来自 Redis pub/sub，不再查询数据库。
+    Redis 不可用时推送 unavailable 事件，前端回退为轮询 processed-info。
+    """
+    token_key = request.GET.get('token', '')
+    user = None if token_key else await request.auser()
+    processed = await get_progress_target(user, token_key, processed_id)
+    if processed is None:
+        return JsonResponse({'success': False, 'error': '处理记录不存在'}, status=404)
+
+    async def events():
+        if processed.status in TERMINAL_STAGES:
+            yield sse_event({'processed_id': processed_id, 'stage': processed.status})
+            return
+        try:
+            async for event in subscribe(processed_id):
+                # 空闲时发送注释行作为心跳，防止代理断开连接
+                yield ': keepalive\n\n' if event is None else sse_event(event)
+        except Exception as e:
+            logger.warning(f"[PROGRESS] 进度订阅失败: {e}")
+            yield sse_event({'processed_id': processed_id, 'stage': 'unavailable'})
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
-from django.http import StreamingHttpResponse
-import zipfile
-import io
+from django.http import StreamingHttpResponse, HttpResponse
+import re
+from .utils.zipstream import ZipStream, crc_cache
+
+ZIP_CRC_CACHE = crc_cache()
+
+def parse_range(header, size):
+    """
+    解析单个 Range 请求头(bytes=a-b / bytes=a- / bytes=-n)。
+    Returns:
+        (first, last) 闭区间；无 Range 或格式不支持时返回None；范围不可满足时返回False。
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        return False
+    return first, last
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def export_all_processed_documents(request):
-    """导出当前用户所有已完成的处理文档为zip"""
+    """
+    导出当前用户所有已完成的处理文档为zip
+    边读文件边输出的不压缩(ZIP_STORED)归档：PDF本身已压缩，内存占用恒定；
+    总大小可预先计算，支持 Range 断点续传。
+    """
     processed_docs = ProcessedDocument.objects.filter(document__user=request.user, status='completed').select_related('document')
     if not processed_docs.exists():
         return Response({'success': False, 'error': '暂无已完成的处理文档'}, status=404)
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for pd in processed_docs:
-            if pd.processed_file and pd.processed_file.name:
-                file_path = pd.processed_file.path
-                if not os.path.exists(file_path):
-                    continue
-                # 文件名格式: 原文件名-配置hash.pdf
-                base_name = os.path.splitext(pd.document.filename)[0]
-                zip_name = f"{base_name}-{pd.config_hash[:8]}.pdf"
-                with open(file_path, 'rb') as f:
-                    zip_file.writestr(zip_name, f.read())
-    zip_buffer.seek(0)
-    response = StreamingHttpResponse(zip_buffer, content_type='application/zip')
+    files = []
+    for pd in processed_docs.order_by('id'):
+        if pd.processed_file and pd.processed_file.name:
+            file_path = pd.processed_file.path
+            if not os.path.exists(file_path):
+                continue
+            # 文件名格式: 原文件名-配置hash.pdf
+            base_name = os.path.splitext(pd.document.filename)[0]
+            files.append((f"{base_name}-{pd.config_hash[:8]}.pdf", file_path))
+    archive = ZipStream(files, ZIP_CRC_CACHE)
+    etag = f'"{archive.etag()}"'
+
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range == etag:
+        byte_range = parse_range(request.headers.get('Range'), archive.size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{archive.size}'
+        return response
+    if byte_range:
+        first, last = byte_range
+        response = StreamingHttpResponse(archive.iter_range(first, last), status=206, content_type='application/zip')
+        response['Content-Range'] = f'bytes {first}-{last}/{archive.size}'
+        response['Content-Length'] = str(last - first + 1)
+    else:
+        response = StreamingHttpResponse(archive, content_type='application/zip')
+        response['Content-Length'] = str(archive.size)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
     response['Content-Disposition'] = f'attachment; filename="all_processed_documents.zip"'
     return response
 
@@ -571,6 +987,69 @@ def get_dashboard_stats(request):
             'error': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def percentile_summary(values):
+    """p50/p95/平均值，values为非空列表"""
+    arr = np.asarray(values, dtype=np.float64)
+    return {
+        'count': int(arr.size),
+        'p50': round(float(np.percentile(arr, 50)), 4),
+        'p95': round(float(np.percentile(arr, 95)), 4),
+        'mean': round(float(arr.mean()), 4),
+    }
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_stage_stats(request):
+    """
+    处理阶段耗时统计API
+    统计时间窗口内(参数 hours，默认24小时)已完成任务各阶段耗时的 p50/p95，
+    按页数折算的单页耗时，以及 LLM 文本块缓存命中率。管理员可传 all=1 统计所有用户。
+    """
+    try:
+        hours = min(max(float(request.query_params.get('hours', 24)), 0), 24 * 90)
+        processed_docs = ProcessedDocument.objects.filter(
+            status='completed',
+            process_time__gte=timezone.now() - timedelta(hours=hours)
+        )
+        if not (request.user.is_staff and request.query_params.get('all') == '1'):
+            processed_docs = processed_docs.filter(document__user=request.user)
+
+        stages = defaultdict(list)
+        per_page = defaultdict(list)
+        llm_chunks = llm_cache_hits = 0
+        for metrics in processed_docs.exclude(metrics={}).values_list('metrics', flat=True).iterator():
+            pages = metrics.get('counters', {}).get('pages') or 0
+            llm_chunks += metrics.get('counters', {}).get('llm_chunks', 0)
+            llm_cache_hits += metrics.get('counters', {}).get('llm_cache_hits', 0)
+            timings = dict(metrics.get('stages', {}))
+            if 'total' in metrics:
+                timings['total'] = metrics['total']
+            for stage, seconds in timings.items():
+                stages[stage].append(seconds)
+                if pages:
+                    per_page[stage].append(seconds / pages)
+
+        return Response({
+            'success': True,
+            'window_hours': hours,
+            'count': len(stages.get('total', [])),
+            'stages': {stage: percentile_summary(v) for stage, v in stages.items()},
+            'per_page': {stage: percentile_summary(v) for stage, v in per_page.items()},
+            # LLM 文本块缓存命中率(相同文本块不再请求接口)
+            'llm_cache': {
+                'chunks': llm_chunks,
+                'hits': llm_cache_hits,
+                'hit_rate': round(llm_cache_hits / llm_chunks, 4) if llm_chunks else 0.0,
+            },
+        })
+    except ValueError:
+        return Response({'success': False, 'error': '无效的时间窗口'}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_system_config_options(request):
@@ -597,10 +1076,17 @@ def get_system_config_options(request):
                 {'key': 'email', 'label': '邮箱 (正则)', 'description': '识别文档中的邮箱地址'},
                 {'key': 'sens_number', 'label': '长数字字母混合 (正则)', 'description': '识别身份证号、手机号等长数字字母组合'}
             ],
+            'output_profiles': [
+                {'value': 'png', 'label': '无损 PNG', 'description': '与渲染结果完全一致，文件最大'},
+                {'value': 'jpeg', 'label': 'JPEG', 'description': '按输出质量有损压缩，灰度页面按单通道保存'},
+                {'value': 'bilevel', 'label': '黑白 (CCITT G4)', 'description': '所有页面二值化，适合纯文字扫描件，文件最小'},
+                {'value': 'auto', 'label': '自动', 'description': '逐页检测：黑白页面用 CCITT G4，其余页面用 JPEG'}
+            ],
             'defaults': {
                 'compute_mode': 'cpu',
                 'model_type': 'ner',
-                'processing_method': 'black'
+                'processing_method': 'black',
+                **DEFAULT_OUTPUT
             }
         }
         
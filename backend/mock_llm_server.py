@@ -0,0 +1,80 @@
+"""
+Local stand-in for the OpenAI-compatible chat completions API, for load-testing the LLM client offline.
+
+    python mock_llm_server.py
+    FADE_LLM_BASE_URL=http://localhost:8101/v1 python manage.py benchmark_llm
+
+Behaviour is set with environment variables:
+    MOCK_LLM_LATENCY     mean response time in seconds (exponentially distributed)
+    MOCK_LLM_RATE        requests accepted per second before answering 429 with Retry-After (0: unlimited)
+    MOCK_LLM_ERROR_RATE  fraction of requests answered with a 500
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MOCK_LLM_PORT = int(os.environ.get("MOCK_LLM_PORT", 8101))
+MOCK_LLM_LATENCY = float(os.environ.get("MOCK_LLM_LATENCY", 0.8))
+MOCK_LLM_RATE = float(os.environ.get("MOCK_LLM_RATE", 20))
+MOCK_LLM_ERROR_RATE = float(os.environ.get("MOCK_LLM_ERROR_RATE", 0.02))
+
+app = FastAPI()
+
+stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+_window = []    # Start times of the requests accepted in the last second
+
+def _answer(prompt):
+    """A well-formed extraction result; two-character runs after 姓名-like markers count as names."""
+    text = prompt.split("\n\n")[0]
+    names = re.findall(r'(?:先生|女士|姓名[:：]?)\s*([一-龥]{2,3})', text)
+    return json.dumps({"company": [], "address": [], "name": names}, ensure_ascii=False)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats['requests'] += 1
+    now = time.monotonic()
+    if MOCK_LLM_RATE > 0:
+        while _window and now - _window[0] >= 1:
+            _window.pop(0)
+        if len(_window) >= MOCK_LLM_RATE:
+            stats['rate_limited'] += 1
+            retry_after = max(0.1, 1 - (now - _window[0]))
+            return JSONResponse({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                                status_code=429, headers={"Retry-After": f"{retry_after:.2f}"})
+        _window.append(now)
+    stats['in_flight'] += 1
+    stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+    try:
+        await asyncio.sleep(random.expovariate(1 / MOCK_LLM_LATENCY) if MOCK_LLM_LATENCY > 0 else 0)
+    finally:
+        stats['in_flight'] -= 1
+    if random.random() < MOCK_LLM_ERROR_RATE:
+        stats['errors'] += 1
+        return JSONResponse({"error": {"message": "Mock server error", "type": "server_error"}}, status_code=500)
+    prompt = body["messages"][-1]["content"]
+    return {
+        "id": f"chatcmpl-mock-{stats['requests']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": _answer(prompt)},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": len(prompt), "completion_tokens": 0, "total_tokens": len(prompt)},
+    }
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=MOCK_LLM_PORT)
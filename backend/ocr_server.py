@@ -1,48 +1,199 @@
+import asyncio
+import io
 import os
 import time
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
-from rapidocr_paddle import RapidOCR
 from fastapi import Body
 import numpy as np
-from pdf2image import convert_from_path
-import cv2
-import json
+from documents.utils.ocrstore import save_ocr_result
+from documents.utils.render import iter_pages, OCR_DPI
+from documents.utils import rocr
+from documents.utils.cache import make_key
 
 app = FastAPI()
 
-class ROCRProcessor:
-    def __init__(self, gpu=True):
-        self.engine = RapidOCR(det_use_cuda=gpu, cls_use_cuda=gpu, rec_use_cuda=gpu)
+# Number of RapidOCR engine processes on CPU. A GPU has a single engine process.
+OCR_CPU_WORKERS = int(os.environ.get("OCR_CPU_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Pages admitted per pool (queued or being OCR'd). Further pages wait up to OCR_ADMIT_TIMEOUT
+# seconds for a slot, then the request is answered with a 503 so the client can back off.
+OCR_CPU_LIMIT = int(os.environ.get("OCR_CPU_LIMIT", 64))
+OCR_GPU_LIMIT = int(os.environ.get("OCR_GPU_LIMIT", 64))
+OCR_ADMIT_TIMEOUT = float(os.environ.get("OCR_ADMIT_TIMEOUT", 60))
+OCR_RETRY_AFTER = 5     # Seconds suggested to clients in the Retry-After header of a 503
+# Pools built and warmed up at startup ("cpu", "gpu" or both, comma-separated); others start on first use
+OCR_WARM_POOLS = [d for d in os.environ.get("OCR_WARM_POOLS", "cpu").split(",") if d]
+LATENCY_WINDOW = 1000   # Recent pages kept for the latency percentiles of /metrics
 
-    def process_pdf(self, pdf_path, ocr_path):
-        ''' Process a PDF file and save OCR results to a JSON file.'''
-        start_time = time.time()
-        all_boxes, all_txts = [], []
-        # Convert PDF pages to numpy type images
-        imgs = convert_from_path(pdf_path, dpi=150, fmt="png", thread_count=10, use_pdftocairo=True)
-        imgs_bin = [cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR) for image in imgs]
-        for i, img in enumerate(imgs_bin):
-            result = self.engine(img, return_word_box=True)
-            boxes, txts = [], []
-            for line in result[0]:
-                for box in line[3]:
-                    boxes.append(box)
-                for text in line[4]:
-                    txts.append(text)
-                txts.append('\n')
-                boxes.append(box)
-            boxes = [[i, p0[0], p0[1], p2[0], p2[1]] for p0, p1, p2, p3 in boxes]
-            all_boxes.extend(boxes)
-            all_txts.extend(txts)
-        with open(ocr_path, 'w', encoding='utf-8') as f:
-            json.dump({"boxes": all_boxes, "txts": all_txts}, f, ensure_ascii=False)
-        end_time = time.time()
-        print(f"[INFO] RapidOCR processing time: {end_time - start_time:.2f} seconds")
+class PoolBusy(Exception):
+    """No slot of the pool freed up within OCR_ADMIT_TIMEOUT."""
+
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'max': None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 1)
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(values[-1] * 1000, 1)}
+
+class EnginePool:
+    """
+    Page-level work queue feeding a pool of RapidOCR engine processes, for one device and engine config.
+    Pages of all documents share one FIFO queue, so a long document does not
+    block the pages of the documents submitted after it.
+    Engines are built when the pool starts and stay loaded; a pool whose processes died
+    (crash, out of memory) is rebuilt on the next page.
+    """
+    def __init__(self, gpu, workers, limit):
+        self.gpu = gpu
+        self.device = 'gpu' if gpu else 'cpu'
+        self.workers = workers
+        self.limit = limit
+        self.engine_config = rocr.engine_config(gpu)
+        self.executor = self._executor()
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(limit)
+        self.stats = {'pages': 0, 'cache_hits': 0, 'errors': 0, 'rejected': 0, 'restarts': 0, 'in_flight': 0}
+        self.wait_times = deque(maxlen=LATENCY_WINDOW)     # Queued -> picked by an engine
+        self.ocr_times = deque(maxlen=LATENCY_WINDOW)      # Time in the engine
+        self.ready = False
+        self.last_error = None
+        self.dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(workers)]
+        self.warmup_task = asyncio.create_task(self._warmup())
+
+    def _executor(self):
+        return ProcessPoolExecutor(self.workers, initializer=rocr.init_engine, initargs=(self.gpu,))
+
+    async def _warmup(self):
+        """Start every engine process, so the first pages do not wait for the models to load."""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*[loop.run_in_executor(self.executor, rocr.engine_ready) for _ in range(self.workers)])
+            self.ready = True
+            print(f"[INFO] OCR pool {self.device} ready with {self.workers} engines")
+        except Exception as e:
+            self.last_error = f"warm-up: {e}"
+            print(f"[ERROR] Warm-up of OCR pool {self.device} failed: {e}")
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            img, page_index, dpi, future, queued_at = await self.queue.get()
+            started = time.perf_counter()
+            self.wait_times.append(started - queued_at)
+            executor = self.executor
+            try:
+                result = await loop.run_in_executor(executor, rocr.ocr_page, img, page_index, dpi)
+                self.ocr_times.append(time.perf_counter() - started)
+                self.stats['pages'] += 1
+                self.ready = True
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as e:
+                self.stats['errors'] += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                if isinstance(e, BrokenProcessPool) and executor is self.executor:
+                    # Engine processes died: replace the pool once, for all dispatchers
+                    print(f"[ERROR] OCR pool {self.device} broken, restarting: {e}")
+                    self.stats['restarts'] += 1
+                    self.ready = False
+                    self.executor = self._executor()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def submit(self, img, page_index, dpi=OCR_DPI, cache=True):
+        """
+        Queue one page and wait for its (boxes, txts). Pages already in the page cache skip the queue,
+        unless cache is False (benchmarks), in which case the cache is neither read nor written.
+        Raises PoolBusy if the pool stays full for OCR_ADMIT_TIMEOUT seconds.
+        """
+        key = rocr.page_cache_key(img, dpi, self.engine_config) if cache else None
+        if key is not None:
+            cached = await run_in_threadpool(PAGE_CACHE.get, key)
+            if cached is not None:
+                self.stats['cache_hits'] += 1
+                return rocr.from_cache_entry(cached, page_index)
+        try:
+            await asyncio.wait_for(self.slots.acquire(), OCR_ADMIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats['rejected'] += 1
+            raise PoolBusy(f"OCR pool {self.device} is full ({self.limit} pages)")
+        self.stats['in_flight'] += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((img, page_index, dpi, future, time.perf_counter()))
+            boxes, txts = await future
+        finally:
+            self.stats['in_flight'] -= 1
+            self.slots.release()
+        if key is not None:
+            await run_in_threadpool(PAGE_CACHE.set, key, rocr.to_cache_entry(boxes, txts))
+        return boxes, txts
+
+    def metrics(self):
+        if not self.ready:
+            status = 'starting' if self.last_error is None else 'error'
+        else:
+            status = 'ok'
+        return {
+            'status': status,
+            'device': self.device,
+            'engine_config': self.engine_config,
+            'workers': self.workers,
+            'limit': self.limit,
+            'queued': self.queue.qsize(),
+            **self.stats,
+            'last_error': self.last_error,
+            'wait_ms': _percentiles(list(self.wait_times)),
+            'ocr_ms': _percentiles(list(self.ocr_times)),
+        }
+
+    def shutdown(self):
+        for task in self.dispatchers + [self.warmup_task]:
+            task.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+POOLS = {}
+PAGE_CACHE = rocr.page_cache()
+
+def get_pool(gpu):
+    """Pool of the device and engine config a request asks for, created on first use."""
+    key = ('gpu' if gpu else 'cpu', make_key(rocr.engine_config(gpu)))
+    if key not in POOLS:
+        POOLS[key] = EnginePool(gpu, 1 if gpu else OCR_CPU_WORKERS, OCR_GPU_LIMIT if gpu else OCR_CPU_LIMIT)
+    return POOLS[key]
+
+def http_error(e):
+    """503 when a pool is full, which OCRProcessor retries after a backoff; 500 otherwise."""
+    if isinstance(e, PoolBusy):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(OCR_RETRY_AFTER)})
+    return HTTPException(status_code=500, detail=str(e))
+
+@app.on_event("startup")
+async def warm_pools():
+    for device in OCR_WARM_POOLS:
+        get_pool(device.strip() == 'gpu')
 
-LAST_GPU = True
-rocr = ROCRProcessor(gpu=True)
+@app.get("/metrics")
+async def metrics():
+    """Health, load and latency of each engine pool, and page cache hit rate."""
+    return {
+        'pools': {f"{device}/{key[:8]}": pool.metrics() for (device, key), pool in POOLS.items()},
+        'page_cache': PAGE_CACHE.stats(),
+    }
+
+@app.on_event("shutdown")
+def shutdown_pools():
+    for pool in POOLS.values():
+        pool.shutdown()
 
 @app.post("/ocr")
 async def extract_text_with_position(
@@ -52,17 +203,68 @@ async def extract_text_with_position(
         pdf_path = data.get("pdf_path")
         output_dir = data.get("output_dir")
         gpu = data.get("gpu", True)
-        global LAST_GPU
-        global rocr
-        if gpu != LAST_GPU:
-            print(f"Switching GPU setting from {LAST_GPU} to {gpu}")
-            LAST_GPU = gpu
-            rocr = ROCRProcessor(gpu=gpu)
-        rocr.process_pdf(pdf_path, output_dir)
+        pool = get_pool(gpu)
+        # Render in a thread and queue each page as soon as it is ready,
+        # with at most two pages per engine rendered ahead of the OCR
+        window = asyncio.Semaphore(pool.workers * 2)
+
+        async def run(img, page_index):
+            try:
+                return await pool.submit(img, page_index)
+            finally:
+                window.release()
+
+        pages = iter_pages(pdf_path, OCR_DPI)
+        jobs = []
+        while True:
+            await window.acquire()
+            page = await run_in_threadpool(next, pages, None)
+            if page is None:
+                break
+            page_index, img = page
+            jobs.append(asyncio.create_task(run(img, page_index)))
+        all_boxes, all_txts = [], []
+        for boxes, txts in await asyncio.gather(*jobs):
+            all_boxes.extend(boxes)
+            all_txts.extend(txts)
+        await run_in_threadpool(save_ocr_result, output_dir, all_boxes, all_txts, OCR_DPI)
         return JSONResponse(content={"message": "OCR processing completed successfully."})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.post("/ocr_page")
+async def extract_text_from_page(request: Request, page: int = 0, gpu: bool = True, dpi: int = OCR_DPI,
+                                 cache: bool = True):
+    """OCR one page raster rendered by the caller (.npy body) and return its boxes and texts."""
+    try:
+        body = await request.body()
+        img = np.load(io.BytesIO(body))
+        boxes, txts = await get_pool(gpu).submit(img, page, dpi, cache)
+        return JSONResponse(content={"boxes": boxes, "txts": txts})
+    except Exception as e:
+        raise http_error(e)
+
+def read_shared_page(name, shape, dtype):
+    """Copy a page raster out of the caller's shared memory block; the caller unlinks the block."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # Before Python 3.13, attaching registers the block to be unlinked when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return np.ndarray(shape, np.dtype(dtype), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+@app.post("/ocr_shm")
+async def extract_text_from_shared_page(data: dict = Body(...), page: int = 0, gpu: bool = True, dpi: int = OCR_DPI,
+                                        cache: bool = True):
+    """OCR one page raster handed over in shared memory ({"name", "shape", "dtype"} body), see SharedMemoryOCRProcessor."""
+    try:
+        img = read_shared_page(data["name"], tuple(data["shape"]), data["dtype"])
+        boxes, txts = await get_pool(gpu).submit(img, page, dpi, cache)
+        return JSONResponse(content={"boxes": boxes, "txts": txts})
+    except Exception as e:
+        raise http_error(e)
 
 if __name__ == "__main__":
 
-    uvicorn.run(app, host="127.0.0.1", port=30000)
\ No newline at end of file
+    uvicorn.run(app, host="127.0.0.1", port=30000)
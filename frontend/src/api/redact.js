@@ -250,6 +250,40 @@ export async function getProcessedDocumentInfo(processedDocumentId) {
   return await response.json();
 }
 
+// 订阅处理进度（SSE）。EventSource 无法设置请求头，token 通过查询参数传递
+// onEvent 收到每条进度事件；推送不可用时调用 onUnavailable，由调用方回退为轮询
+export function subscribeProcessingProgress(processedDocumentId, onEvent, onUnavailable) {
+  const token = localStorage.getItem('token');
+  if (typeof EventSource === 'undefined') {
+    onUnavailable();
+    return { close() {} };
+  }
+  const source = new EventSource(`/api/documents/progress/${processedDocumentId}/?token=${encodeURIComponent(token)}`);
+  let finished = false;
+  source.onmessage = (e) => {
+    const event = JSON.parse(e.data);
+    if (event.stage === 'unavailable') {
+      finished = true;
+      source.close();
+      onUnavailable();
+      return;
+    }
+    if (event.stage === 'completed' || event.stage === 'failed') {
+      finished = true;
+      source.close();
+    }
+    onEvent(event);
+  };
+  source.onerror = () => {
+    // 连接被关闭（非自动重连中）且任务未结束时，回退为轮询
+    if (!finished && source.readyState === EventSource.CLOSED) {
+      finished = true;
+      onUnavailable();
+    }
+  };
+  return source;
+}
+
 // 批量下载处理后的文档
 export async function downloadBatchProcessedDocuments(documentCodes) {
   const response = await fetch('/api/documents/batch-download/', {
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from "react";
 import { useNavigate, useLocation } from 'react-router-dom';
-import { processDocument, getDocumentDetail, getProcessedDocumentInfo } from "../../api/redact";
+import { processDocument, getDocumentDetail, getProcessedDocumentInfo, subscribeProcessingProgress } from "../../api/redact";
 
 // 配置常量
 const CONFIG_CONSTANTS = {
@@ -26,10 +26,19 @@ const CONFIG_CONSTANTS = {
     { value: "ner", label: "NER" },
     { value: "llm", label: "LLM" },
   ],
+  outputOptions: [
+    { value: "png", label: "无损 PNG" },
+    { value: "jpeg", label: "JPEG" },
+    { value: "bilevel", label: "黑白 (CCITT G4)" },
+    { value: "auto", label: "自动" },
+  ],
+  dpiOptions: [300, 200, 150],
   defaults: {
     computeMode: 'cpu',
     modelType: 'ner',
-    method: 'black'
+    method: 'black',
+    outputProfile: 'png',
+    outputDpi: 300
   }
 };
 
@@ -38,16 +47,37 @@ const MOSAIC_SIZE_DEFAULT = 30; // 百分比
 const BLUR_KERNEL_DEFAULT = 30; // 百分比
 const BLACK_COLOR_DEFAULT = '#000000';
 
+// 处理进度阶段名称
+const PROGRESS_STAGE_LABELS = {
+  started: '已开始',
+  render: '页面渲染',
+  ocr: '文字识别',
+  detect: '敏感信息识别',
+  mask: '页面脱敏',
+  assemble: '生成文档',
+  completed: '处理完成',
+  failed: '处理失败',
+};
+
+function formatProgress(event) {
+  const label = PROGRESS_STAGE_LABELS[event.stage] || event.stage;
+  return event.done != null ? `${label} ${event.done}/${event.total}` : label;
+}
+
 export default function Config() {
   const [fields] = useState(CONFIG_CONSTANTS.fields);
   const [selected, setSelected] = useState({}); // {name: {checked: true, method: 'blur'}}
   const [computeMode, setComputeMode] = useState(CONFIG_CONSTANTS.defaults.computeMode); // CPU/GPU选择
   const [modelType, setModelType] = useState(CONFIG_CONSTANTS.defaults.modelType); // NER/LLM选择
+  const [outputProfile, setOutputProfile] = useState(CONFIG_CONSTANTS.defaults.outputProfile); // 输出格式
+  const [outputDpi, setOutputDpi] = useState(CONFIG_CONSTANTS.defaults.outputDpi); // 输出分辨率
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
   const [documentInfo, setDocumentInfo] = useState(null);
   const [selectedDocuments, setSelectedDocuments] = useState([]);
   const pollingRef = React.useRef(null);
+  const progressSourcesRef = React.useRef([]);
+  const [progress, setProgress] = useState({}); // {processedId: 最近一次进度事件}
   
   const navigate = useNavigate();
   const location = useLocation();
@@ -206,6 +236,8 @@ export default function Config() {
     // 添加处理配置选项
     config.compute_mode = computeMode;
     config.model_type = modelType;
+    config.output_profile = outputProfile;
+    config.output_dpi = outputDpi;
     return config;
   }
 
@@ -283,33 +315,9 @@ export default function Config() {
         processedId: r.data.processed_document?.id
       })).filter(r => r.processedId);
 
-      // 启动轮询
-      if (pollingRef.current) clearInterval(pollingRef.current);
+      // 订阅处理进度推送
       if (processingList.length > 0) {
-        pollingRef.current = setInterval(async () => {
-          try {
-            // 并发请求所有文档状态
-            const statusArr = await Promise.all(
-              processingList.map(item => getProcessedDocumentInfo(item.processedId))
-            );
-            // 检查是否全部完成
-            const allCompleted = statusArr.every(info => info.status === 'completed');
-            if (allCompleted) {
-              clearInterval(pollingRef.current);
-              pollingRef.current = null;
-              alert(`成功处理 ${processingList.length} 个文档！`);
-              // 跳转，无论单个还是批量都跳转到Preview
-              navigate('/preview', {
-                state: {
-                  documentCode: processingList[0].documentCode,
-                  processedDocumentId: processingList[0].processedId
-                }
-              });
-            }
-          } catch {
-            // 失败时不终止轮询
-          }
-        }, 3000);
+        watchProcessing(processingList);
       }
     } catch (err) {
       setError(err.message || '处理失败');
@@ -318,6 +326,70 @@ export default function Config() {
     }
   }
 
+  // 全部完成后提示并跳转，无论单个还是批量都跳转到Preview
+  function finishProcessing(processingList) {
+    alert(`成功处理 ${processingList.length} 个文档！`);
+    navigate('/preview', {
+      state: {
+        documentCode: processingList[0].documentCode,
+        processedDocumentId: processingList[0].processedId
+      }
+    });
+  }
+
+  function stopWatching() {
+    progressSourcesRef.current.forEach(source => source.close());
+    progressSourcesRef.current = [];
+    if (pollingRef.current) {
+      clearInterval(pollingRef.current);
+      pollingRef.current = null;
+    }
+  }
+
+  // 订阅服务端推送的处理进度，全部结束后跳转
+  function watchProcessing(processingList) {
+    stopWatching();
+    setProgress({});
+    const finished = {};
+    progressSourcesRef.current = processingList.map(item =>
+      subscribeProcessingProgress(item.processedId, (event) => {
+        setProgress(prev => ({ ...prev, [item.processedId]: event }));
+        if (event.stage !== 'completed' && event.stage !== 'failed') return;
+        finished[item.processedId] = event.stage;
+        if (Object.keys(finished).length < processingList.length) return;
+        stopWatching();
+        if (Object.values(finished).every(stage => stage === 'completed')) {
+          finishProcessing(processingList);
+        } else {
+          setError('部分文档处理失败');
+        }
+      }, () => startPolling(processingList))
+    );
+  }
+
+  // 推送不可用时回退为轮询
+  function startPolling(processingList) {
+    if (pollingRef.current) return;
+    progressSourcesRef.current.forEach(source => source.close());
+    progressSourcesRef.current = [];
+    pollingRef.current = setInterval(async () => {
+      try {
+        // 并发请求所有文档状态
+        const statusArr = await Promise.all(
+          processingList.map(item => getProcessedDocumentInfo(item.processedId))
+        );
+        // 检查是否全部完成
+        const allCompleted = statusArr.every(info => info.status === 'completed');
+        if (allCompleted) {
+          stopWatching();
+          finishProcessing(processingList);
+        }
+      } catch {
+        // 失败时不终止轮询
+      }
+    }, 3000);
+  }
+
   // 全部勾选并处理
   async function handleSelectAllAndProcess() {
     // 获取要处理的文档代码
@@ -354,6 +426,8 @@ export default function Config() {
     });
     allConfig.compute_mode = computeMode;
     allConfig.model_type = modelType;
+    allConfig.output_profile = outputProfile;
+    allConfig.output_dpi = outputDpi;
 
     if (Object.keys(allConfig).length === 0) {
       setError('没有可处理的字段');
@@ -417,14 +491,9 @@ export default function Config() {
     }
   }
 
-  // 清理定时器
+  // 清理定时器和进度订阅
   useEffect(() => {
-    return () => {
-      if (pollingRef.current) {
-        clearInterval(pollingRef.current);
-        pollingRef.current = null;
-      }
-    };
+    return () => stopWatching();
   }, []);
 
   // 字段渲染函数，避免重复
@@ -514,6 +583,14 @@ export default function Config() {
         </div>
       )}
 
+      {Object.keys(progress).length > 0 && (
+        <div className="config-progress">
+          {Object.entries(progress).map(([processedId, event]) => (
+            <div key={processedId}>文档 #{processedId}: {formatProgress(event)}</div>
+          ))}
+        </div>
+      )}
+
       {selectedDocuments.length > 0 && (
         <div className="config-selected-docs">
           <strong>选中的文档 ({selectedDocuments.length} 个):</strong>
@@ -559,6 +636,30 @@ export default function Config() {
               ))}
             </select>
           </div>
+          <div className="config-option-group">
+            <label className="config-option-label">输出格式:</label>
+            <select 
+              className="config-option-select" 
+              value={outputProfile} 
+              onChange={e => setOutputProfile(e.target.value)}
+            >
+              {CONFIG_CONSTANTS.outputOptions.map(opt => (
+                <option value={opt.value} key={opt.value}>{opt.label}</option>
+              ))}
+            </select>
+          </div>
+          <div className="config-option-group">
+            <label className="config-option-label">输出分辨率:</label>
+            <select 
+              className="config-option-select" 
+              value={outputDpi} 
+              onChange={e => setOutputDpi(Number(e.target.value))}
+            >
+              {CONFIG_CONSTANTS.dpiOptions.map(dpi => (
+                <option value={dpi} key={dpi}>{dpi} dpi</option>
+              ))}
+            </select>
+          </div>
         </div>
       </div>
       